@@ -91,6 +91,15 @@ namespace namedstruct {
     static int inline requiredBits(int number) {
         return (number == 0)? 0 : (static_cast<int>(log2(number)) + 1);
     }
+
+    /**
+     returns the data following the 8 byte schema fingerprint that namedstruct.packWithFingerprint puts in front of
+     the packed data, or nullptr if the data was packed with a schema with a different fingerprint. The fingerprint
+     of a header is declared as <NAME>_SCHEMA_FINGERPRINT. */
+    static inline const void* skipFingerprint(const void* pData, uint64_t fingerprint) {
+        return (*static_cast<const uint64_t*>(pData) == fingerprint)
+            ? static_cast<const uint8_t*>(pData) + sizeof(uint64_t) : nullptr;
+    }
     
     class BitReader {
     public:
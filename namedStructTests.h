@@ -160,9 +160,7 @@ namespace namedStructTest {
     
     typedef struct __attribute__((packed)) testStruct3 {
         int8_t  four;
-        int8_t  paddingByte0;
-        int8_t  paddingByte1;
-        int8_t  paddingByte2;
+        uint8_t paddingBytes0[3];
         int32_t nestedMemberByteOffset;
     
         /** Returns testNestedStruct0-pointer to member nestedMember.
@@ -208,9 +206,7 @@ namespace namedStructTest {
     
     typedef struct __attribute__((packed)) testStruct7 {
         int8_t   anInt8;
-        int8_t   paddingByte0;
-        int8_t   paddingByte1;
-        int8_t   paddingByte2;
+        uint8_t  paddingBytes0[3];
         int32_t  anInt32;
         uint32_t anUint32;
         int32_t  aStringByteOffset;
@@ -317,16 +313,11 @@ namespace namedStructTest {
     
     typedef struct __attribute__((packed)) testStruct13 {
         int8_t            x;
-        int8_t            paddingByte0;
-        int8_t            paddingByte1;
-        int8_t            paddingByte2;
+        uint8_t           paddingBytes0[3];
         testNestedStruct2 immediateStruct;
         
                     bool operator==(const testStruct13& other) const {
                         return (    x == other.x
-                    and paddingByte0 == other.paddingByte0
-                    and paddingByte1 == other.paddingByte1
-                    and paddingByte2 == other.paddingByte2
                     and immediateStruct == other.immediateStruct);
                     }
                     
@@ -369,9 +360,7 @@ namespace namedStructTest {
     typedef struct __attribute__((packed)) elementStruct0 {
         int32_t nameByteOffset;
         int8_t  x;
-        int8_t  paddingByte0;
-        int8_t  paddingByte1;
-        int8_t  paddingByte2;
+        uint8_t paddingBytes0[3];
     
         /** Returns char-pointer to member name.
          *  If name is null/void then the result is undefined. */
@@ -393,16 +382,11 @@ namespace namedStructTest {
     
     
     typedef struct __attribute__((packed)) elementStruct1 {
-        int8_t foo;
-        int8_t paddingByte0;
-        int8_t paddingByte1;
-        int8_t paddingByte2;
+        int8_t  foo;
+        uint8_t paddingBytes0[3];
         
                     bool operator==(const elementStruct1& other) const {
-                        return (    foo == other.foo
-                    and paddingByte0 == other.paddingByte0
-                    and paddingByte1 == other.paddingByte1
-                    and paddingByte2 == other.paddingByte2);
+                        return foo == other.foo;
                     }
                     
                     bool operator!=(const elementStruct1& other) const {
@@ -809,13 +793,12 @@ namespace namedStructTest {
     
     typedef struct __attribute__((packed)) testStruct34 {
         bitField1 flags;
-        int8_t    paddingByte0;
+        uint8_t   paddingBytes0[1];
         bitField2 smallInts;
         int32_t   terminal;
         
                     bool operator==(const testStruct34& other) const {
                         return (    flags == other.flags
-                    and paddingByte0 == other.paddingByte0
                     and smallInts == other.smallInts
                     and terminal == other.terminal);
                     }
@@ -1706,9 +1689,7 @@ namespace namedStructTest {
     
     typedef struct __attribute__((packed)) testStruct42 {
         uint8_t genderEnumValue;
-        int8_t  paddingByte0;
-        int8_t  paddingByte1;
-        int8_t  paddingByte2;
+        uint8_t paddingBytes0[3];
         int32_t partyEnumValue;
         char    nationEnumValue;
     
@@ -1729,9 +1710,6 @@ namespace namedStructTest {
         
                     bool operator==(const testStruct42& other) const {
                         return (    genderEnumValue == other.genderEnumValue
-                    and paddingByte0 == other.paddingByte0
-                    and paddingByte1 == other.paddingByte1
-                    and paddingByte2 == other.paddingByte2
                     and partyEnumValue == other.partyEnumValue
                     and nationEnumValue == other.nationEnumValue);
                     }
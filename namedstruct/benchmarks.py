@@ -0,0 +1,113 @@
+from __future__ import print_function
+from __future__ import absolute_import
+import gc
+import io
+import sys
+import time
+import tracemalloc
+
+import namedstruct.n_types
+import namedstruct.namedstruct
+import namedstruct.values
+
+# benchmarks for building and packing large value trees. Run with
+#   python -m namedstruct.benchmarks [numNodes]
+
+
+# returns the number of bytes allocated per value node by makeNodes(numNodes), which creates numNodes value nodes
+def measureMemory(makeNodes, numNodes):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = makeNodes(numNodes)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del nodes
+    return (after - before) / numNodes
+
+
+def makeInts(numNodes):
+    return [namedstruct.values.Int(i % 1000) for i in range(numNodes)]
+
+
+def makeReferences(numNodes):
+    return [namedstruct.values.Reference(namedstruct.values.Int(i % 1000)) for i in range(numNodes // 2)]
+
+
+# structs with 3 members and a padding run, i.e. 5 value nodes per struct
+def makeStructs(numNodes):
+    return [namedstruct.values.Struct("benchmarkStruct").addInt8("x", i % 100).addInt32("y", i).addInt16("z", 1)
+            for i in range(numNodes // 5)]
+
+
+# the bytes per node measured by benchmarkMemory (100000 nodes, python 3.11) before values and types had __slots__
+# and shared primitive types
+baselineBytesPerNode = {"Int": 271.8, "Reference to Int": 312.4, "Struct with 3 members": 476.6}
+
+
+def benchmarkMemory(numNodes=100000):
+    print("memory per value node (%d nodes):" % numNodes)
+    for name, makeNodes in [("Int", makeInts), ("Reference to Int", makeReferences),
+                            ("Struct with 3 members", makeStructs)]:
+        print("  %-22s %6.1f bytes per node (before __slots__: %6.1f)"
+              % (name, measureMemory(makeNodes, numNodes), baselineBytesPerNode[name]))
+
+
+def benchmarkBuildTime(numNodes=100000):
+    start = time.time()
+    makeStructs(numNodes)
+    print("building %d struct nodes: %.3fs" % (numNodes, time.time() - start))
+
+
+# returns a struct whose header declares 15 types per copy, with the kinds of types used in tests.generateTests:
+# structs with constants, nested, immediate and recursive structs, strings, blobs, arrays, reference arrays,
+# bit fields, bit field arrays and enums
+def makeHeaderSchema(numCopies):
+    values = namedstruct.values
+    root = values.Struct("benchmarkHeaderRoot")
+    for i in range(numCopies):
+        suffix = str(i)
+        genderEnum = namedstruct.n_types.EnumType("GenderEnum" + suffix, namedstruct.n_types.UINT8,
+                                                  {"MALE": 0, "FEMALE": 1, "OTHER": 2})
+        partyEnum = namedstruct.n_types.IntEnumType("PartyEnum" + suffix, {"CONSERVATIVE": -1, "GREEN": -4})
+        element = values.Struct("Element" + suffix).addInt32("x", i).addString("label", "element").finalize()
+        struct = (values.Struct("Record" + suffix)
+                  .addInt32Constant("EVERYTHING", 42)
+                  .addConstant("LABEL", "a label")
+                  .addInt8("a", 1).addUInt32("b", i).addChar("c", "c").addInt64("d", -i)
+                  .addString("name", "record %d" % i)
+                  .addBlob("blob", [0, 1, 1, 0, 1])
+                  .addArray("numbers", [1, 2, 3])
+                  .addArray("elements", [element])
+                  .addReferenceArray("strings", ["a", "b"])
+                  .addReferenceArray("elementReferences", [element, element])
+                  .add("nested", values.Struct("Nested" + suffix).addInt8("x", 1).add("next", None))
+                  .addImmediate("immediate", values.Struct("Immediate" + suffix).addInt16("y", 2).finalize())
+                  .add("next", values.Struct("Record" + suffix + "Child").addInt32("value", 1).add("next", None))
+                  .add("bits", values.BitField("Bits" + suffix, 16).add("flag", 1).addSigned("delta", -2, 4)
+                       .addEnum("gender", genderEnum.OTHER))
+                  .add("bitFieldArray", values.BitFieldArray("BitFieldArray" + suffix, "p", "q", "r").add([1, 2, 3]))
+                  .add("party", partyEnum.GREEN))
+        root.add("record" + suffix, struct)
+    return root
+
+
+# times generating the header of makeHeaderSchema(numCopies), and writing it to a file object
+def benchmarkHeader(numCopies=200):
+    root = makeHeaderSchema(numCopies)
+    numTypes = len(namedstruct.namedstruct.getAllTypes([root.getType()]))
+    start = time.time()
+    header = namedstruct.namedstruct.generateHeader(root, includeSetters=True)
+    print("generating header of %d types (%d bytes): %.3fs" % (numTypes, len(header), time.time() - start))
+    out = io.StringIO()
+    start = time.time()
+    namedstruct.namedstruct.writeHeader(out, root, includeSetters=True)
+    print("writing header of %d types to a file object: %.3fs" % (numTypes, time.time() - start))
+    assert out.getvalue() == header
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    benchmarkMemory(n)
+    benchmarkBuildTime(n)
+    benchmarkHeader()
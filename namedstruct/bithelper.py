@@ -2,7 +2,9 @@ from __future__ import absolute_import
 from builtins import str
 from builtins import range
 from builtins import bytes
+import itertools
 import math
+import operator
 import struct
 import unittest
 
@@ -67,6 +69,50 @@ def packBitsToChars(bits):
     return arrayOfIndividualBytes
 
 
+_bitDigits = bytes.maketrans(b"\x00\x01", b"01")  # bit values -> binary digits
+_bitValues = bytes.maketrans(b"01", b"\x00\x01")  # binary digits -> bit values
+
+
+# takes a bytes object with one 0/1 value per byte, and returns the bits packed into bytes, least significant bit
+# first, like packBitsToChars. The bits are packed using int.from_bytes style integer conversions, not bit by bit
+def packBitBytes(bitBytes):
+    if bitBytes.count(0) + bitBytes.count(1) != len(bitBytes):
+        raise Exception("blobs can only be made from sequences of 0,1 values")
+    if len(bitBytes) == 0:
+        return b""
+    return int(bitBytes[::-1].translate(_bitDigits), 2).to_bytes((len(bitBytes) + 7) // 8, "little")
+
+
+# the inverse of packBitBytes, returns the first numBits bits of the data as a bytes object with one 0/1 value per byte
+def unpackBitBytes(data, numBits):
+    if numBits == 0:
+        return b""
+    digits = format(int.from_bytes(data, "little"), "0%db" % (len(data) * 8))
+    return bytes(digits, "ascii").translate(_bitValues)[::-1][:numBits]
+
+
+# packs rows of bit fields into bytes: every row stores columns[i][row] in fieldLengths[i] bits, least significant
+# bit first, right after the previous field, and the rows are stored one after the other. The values have to fit
+# into their fields. Returns the same bytes as packing the bits of every value (see toBits) with packBitsToChars,
+# but works on whole columns with map, and on groups of 8 rows, which always end at a byte boundary
+def packBitFieldColumns(columns, fieldLengths):
+    numRows = len(columns[0]) if len(columns) > 0 else 0
+    rowBits = sum(fieldLengths)
+    if numRows == 0 or rowBits == 0:
+        return b""
+    rows = list(columns[0])
+    shift = fieldLengths[0]
+    for column, length in zip(columns[1:], fieldLengths[1:]):
+        rows = list(map(operator.or_, rows, map(operator.lshift, column, itertools.repeat(shift))))
+        shift += length
+    rows.extend([0] * (-numRows % 8))  # complete the last group
+    groups = rows[0::8]
+    for k in range(1, 8):
+        groups = list(map(operator.or_, groups, map(operator.lshift, rows[k::8], itertools.repeat(k * rowBits))))
+    data = b"".join(map(operator.methodcaller("to_bytes", rowBits, "little"), groups))
+    return data[:(numRows * rowBits + 7) // 8]
+
+
 def zigZagEncode(v):
     if v < 0:
         return ~int(v) * 2 + 1
@@ -100,6 +146,23 @@ class TestBitHelper(unittest.TestCase):
             for v in [1 << shift, (1 << shift) - 1, - (1 << shift), -((1 << shift) - 1)]:
                 self.assertEqual(zigZagDecode(zigZagEncode(v)), v)
 
+    def testPackBitBytes(self):
+        for numBits in [0, 1, 7, 8, 9, 30]:
+            bits = [(i * 7 + 3) % 5 % 2 for i in range(numBits)]
+            self.assertEqual(packBitBytes(bytes(bits)), b"".join(packBitsToChars(bits)))
+            self.assertEqual(unpackBitBytes(packBitBytes(bytes(bits)), numBits), bytes(bits))
+
+    def testPackBitFieldColumns(self):
+        for numRows in [0, 1, 7, 8, 9, 20]:
+            fieldLengths = [3, 0, 13, 1]
+            columns = [[(row * 37 + i) % (1 << length) for row in range(numRows)]
+                       for i, length in enumerate(fieldLengths)]
+            bits = []
+            for row in range(numRows):
+                for column, length in zip(columns, fieldLengths):
+                    bits.extend(toBits(column[row], length))
+            self.assertEqual(packBitFieldColumns(columns, fieldLengths), b"".join(packBitsToChars(bits)))
+
 
 def runTests():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestBitHelper)
@@ -6,6 +6,8 @@ import re
 
 # an object that has the add constant functions - they all get dispatched to "addConstant"
 class AddConstantFunctions(object):
+    __slots__ = ()
+
     def addConstant(self, name, value):  # should return self
         raise Exception("not implemented")
     
@@ -36,20 +38,18 @@ class ConstantPool(AddConstantFunctions):
         return self.constants[name]
     
     def getConstantDeclarations(self):
-        result = ""
+        result = []  # one line per constant
         typeWidth = max([len(v.getType().getName()) for v in list(self.constants.values())] + [0])
         for name, value in list(self.constants.items()):
-            name = name
             declarationNameSuffix = value.getType().getDeclarationNameSuffix()
             typeName = value.getType().getName()
             space = " " * (typeWidth - len(typeName))
             literal = value.getLiteral()
-            result = (result
-                      + "static constexpr " + typeName
-                      + " " + space
-                      + name + declarationNameSuffix
-                      + " = " + literal + ";\n")
-        return result[:-1]
+            result.append("static constexpr " + typeName
+                          + " " + space
+                          + name + declarationNameSuffix
+                          + " = " + literal + ";")
+        return "\n".join(result)
     
     def getNumConstants(self):
         return len(self.constants)
@@ -36,7 +36,12 @@ def _typeEqualAssert(typeA, typeB, *keys):
                     + repr(valueA) + " vs " + repr(valueB))
 
 
+_noType = object()  # sentinel for the end of child types
+
+
 class Type(object):
+    __slots__ = ("name",)  # types may occur millions of times, so they don't have a __dict__
+
     # the type name that is used in C to represent this type
     def __init__(self):
         self.name = None
@@ -53,11 +58,17 @@ class Type(object):
         return []
 
     # returns, a generater of all the types that are referred/stored in this type (i.e. returns the whole type tree)
+    # the types are returned children first. Uses an explicit stack, so arbitrarily deep type trees are supported
     def getAllContainedTypes(self):
-        for t in self.getContainedTypes():
-            for t2 in t.getAllContainedTypes():
-                yield t2
-        yield self
+        stack = [(self, iter(self.getContainedTypes()))]
+        while len(stack) > 0:
+            t, children = stack[-1]
+            child = next(children, _noType)
+            if child is _noType:
+                stack.pop()
+                yield t
+            else:
+                stack.append((child, iter(child.getContainedTypes())))
 
     # returns a c++ declaration of the type. If the type does not need to be declared (e.g. int32_t), returns None
     def getDeclaration(self, indent=namedstruct.stringhelper.indent, includeSetters=False):
@@ -66,6 +77,11 @@ class Type(object):
     def getForwardDeclaration(self):
         return None
 
+    # returns a description of the type's layout, which is used to compute schema fingerprints (see
+    # namedstruct.getSchemaFingerprint). By default types are described by their unique name
+    def getSchemaDescription(self):
+        return type(self).__name__ + " " + self.getUniqueName()
+
     def getAccessorFunction(self, memberName, indent=namedstruct.stringhelper.indent):
         return None
 
@@ -106,19 +122,21 @@ class Type(object):
         raise Exception("unimplemented for " + repr(self))
 
     def dotGraph(self, parent=None):
-        result = ""
-        if parent is None:
-            result += "graph {\n"
-        else:
-            result += "%s -- %s;\n" % (parent.getName(), self.getName())
-        for childType in self.getContainedTypes():
-            result += childType.dotGraph(self)
+        result = []
+        stack = [(parent, self)]
+        while len(stack) > 0:
+            parentType, t = stack.pop()
+            if parentType is not None:
+                result.append("%s -- %s;\n" % (parentType.getName(), t.getName()))
+            stack.extend((t, childType) for childType in reversed(t.getContainedTypes()))
         if parent is None:
-            result += "}"
-        return result
+            return "graph {\n" + "".join(result) + "}"
+        return "".join(result)
 
 
 class PrimitiveType(Type):
+    __slots__ = ()
+
     def getAlignment(self):  # by default the primtive type width=alignment
         return self.getWidth()
 
@@ -134,6 +152,10 @@ class PrimitiveType(Type):
         formatChar = self.getFormatChar()
         return struct.pack(f + formatChar, aPythonValue)
 
+    # writes the primitive into the pack buffer at the given offset
+    def packInto(self, buffer, offset, aPythonValue):
+        buffer.packInto("<" + self.getFormatChar(), offset, aPythonValue)
+
     def hasEqualMethod(self):
         return True
 
@@ -146,6 +168,7 @@ class PrimitiveType(Type):
 
 
 class IntType(PrimitiveType):
+    __slots__ = ("unsigned", "bitWidth")
     formats = {8: 'b', 16: 'h', 32: 'i', 64: 'q'}  # map from bit width -> format chars
 
     def __init__(self, unsigned, bitWidth):
@@ -190,11 +213,61 @@ UINT8 = IntType(True, 8)
 UINT16 = IntType(True, 16)
 UINT32 = IntType(True, 32)
 UINT64 = IntType(True, 64)
-PADDING = INT8
+_intTypes = dict(((t.unsigned, t.bitWidth), t) for t in [INT8, INT16, INT32, INT64, UINT8, UINT16, UINT32, UINT64])
+
+
+# returns the shared int type with the given signedness and bit width, types are immutable so values can share them
+def getIntType(unsigned, bitWidth):
+    intType = _intTypes.get((unsigned, bitWidth))
+    return intType if intType is not None else IntType(unsigned, bitWidth)
+
+
+# a run of padding bytes in a struct, declared as a single uint8_t array
+class PaddingType(Type):
+    __slots__ = ("numBytes",)
+
+    def __init__(self, numBytes):
+        super(PaddingType, self).__init__()
+        self.name = UINT8.getName()
+        self.numBytes = numBytes
+
+    def getUniqueName(self):
+        return "padding[" + str(self.numBytes) + "]"
+
+    def getDeclarationNameSuffix(self):
+        return "[" + str(self.numBytes) + "]"
+
+    def isImmediate(self):
+        return True
+
+    def getAlignment(self):
+        return 1
+
+    def getWidth(self):
+        return self.numBytes
+
+    def hasEqualMethod(self):
+        return True  # padding bytes are ignored when comparing structs
+
+    def merge(self, other):
+        _typeEqualAssert(self, other, "numBytes")
+        return self
+
+
+_paddingTypes = {}  # numBytes -> shared padding type
+
+
+def getPaddingType(numBytes):
+    paddingType = _paddingTypes.get(numBytes)
+    if paddingType is None:
+        paddingType = _paddingTypes[numBytes] = PaddingType(numBytes)
+    return paddingType
 
 
 # chars are used to represent strings and blobs, and are unsigned 1 byte values
 class CharType(IntType):
+    __slots__ = ()
+
     def __init__(self):
         IntType.__init__(self, False, 8)
         self.name = "char"
@@ -216,10 +289,11 @@ Field = collections.namedtuple("Field", ["name", "type", "bitWidth"])
 
 # bit fields
 class BitFieldType(Type):
+    __slots__ = ("dataType", "fields", "fieldArray", "bitWidth")
     Field = Field
     def __init__(self, name, totalBitWidth=32):
         super(BitFieldType, self).__init__()
-        self.dataType = IntType(True, totalBitWidth)
+        self.dataType = getIntType(True, totalBitWidth)
         self.name = name
         self.fields = {}  # field name -> member index
         # self.fieldWidths = []
@@ -288,16 +362,16 @@ class BitFieldType(Type):
         return "struct " + self.getName() + ";"
 
     def getDeclaration(self, indent=namedstruct.stringhelper.indent, includeSetters=False):
-        result = "typedef struct __attribute__((packed)) %s {\n" % self.getName()
+        result = ["typedef struct __attribute__((packed)) %s {\n" % self.getName()]  # chunks of the declaration
         # add member
-        result = result + indent + self.dataType.getName() + " bits;\n"
+        result.append(indent + self.dataType.getName() + " bits;\n")
         # add accessor functions
         shift = 0
 
         def getTypeName(field):
             return "int" if field.type in {"i", "u"} else field.type.getUniqueName()
 
-        setters = ""
+        setters = []
         if len(self.fieldArray) > 0:
             fieldNameWidth = max(len(field.name) + len(getTypeName(field)) for field in self.fieldArray)
             maskChars = (max(field.bitWidth for field in self.fieldArray) + 3) // 4
@@ -314,17 +388,17 @@ class BitFieldType(Type):
                                   indent=namedstruct.stringhelper.indent, fieldName=namedstruct.stringhelper.capitalizeFirst(fieldName),
                                   shift=shift, mask=mask, s=s, space=space, bitWidth=fieldWidth,
                                   fieldNameWidthSpaces=' ' * fieldNameWidth)
-                result += (
+                result.append((
                     "{indent}/** {bitWidth:2} bit{s} */ inline {fieldType} get{fieldName}() {space}const {{" +
                     " auto v = " + (
                         "(bits >> {shift:2}) & {mask}" if fieldWidth > 0 else ' ' * (16 + int(maskChars)) + "0") + "; "
                                                                                                               " return static_cast<{fieldType}>(" +
                     ("(v >> 1) ^ (-(v & 1))" if useZigZag else "v") +
                     "); " +
-                    "}}\n").format(**formatDict)
+                    "}}\n").format(**formatDict))
                 storageType = self.dataType.getName()
-                intType = (IntType(unsigned=False, bitWidth=self.dataType.bitWidth).getName() + " ") if useZigZag else storageType
-                setters += ("{indent}\n"
+                intType = (getIntType(False, self.dataType.bitWidth).getName() + " ") if useZigZag else storageType
+                setters.append(("{indent}\n"
                             "{indent}inline void set{fieldName}({fieldType} v) {{\n"
                             "{indent}{indent}{intType} intValue = static_cast<{intType}>(v);\n"
                             "{indent}{indent}{storageType} bitValue = " +
@@ -335,13 +409,13 @@ class BitFieldType(Type):
                         intType=intType,
                         storageType=storageType,
                         bitfieldBitsMinus1=self.dataType.bitWidth - 1,
-                        **formatDict)
+                        **formatDict))
                 shift = shift + fieldWidth
 
             if includeSetters:
-                result += setters
+                result.extend(setters)
             mask = "0x%X" % ((1 << self.getNumUsedBits()) - 1)
-            result += """{indent}
+            result.append("""{indent}
 {indent}inline bool operator==(const {name} other) const {{
 {indent}{indent}return (bits & {mask}) == (other.bits & {mask});
 {indent}}}
@@ -350,16 +424,24 @@ class BitFieldType(Type):
 {indent}{indent}return not (*this == other);
 {indent}}}
 }} {name};
-""".format(name=self.getName(), indent=indent, mask=mask)
-            return result
+""".format(name=self.getName(), indent=indent, mask=mask))
+            return "".join(result)
 
     def merge(self, other):
         _typeEqualAssert(self, other, "name", "fieldArray")
         return self
 
+    def getSchemaDescription(self):
+        return (Type.getSchemaDescription(self) + " " + self.dataType.getName() + " "
+                + ",".join("%s:%s:%d" % (field.name, field.type if field.type in {"i", "u"}
+                                         else field.type.getUniqueName(), field.bitWidth)
+                           for field in self.fieldArray))
+
 
 # a type that represents null/none values
 class NullType(Type):
+    __slots__ = ()
+
     def __init__(self):
         super(NullType, self).__init__()
 
@@ -379,13 +461,18 @@ class NullType(Type):
 # A reference type to None may be merged with any other reference type, if the reference bit width is the same.
 # if the reference bit width is 8, will use unsigned references, otherwise the references are signed.
 class ReferenceType(Type):
+    __slots__ = ("targetType", "referenceBitWidth", "referenceType")
     formats = {8: True, 16: False, 32: False}  # bit width -> isUnsigned?
 
     def __init__(self, targetType, referenceBitWidth=32):
         super(ReferenceType, self).__init__()
-        self.referenceBitWidth = referenceBitWidth
         self.targetType = targetType
-        self.referenceType = IntType(ReferenceType.formats[referenceBitWidth], referenceBitWidth)
+        self.setReferenceBitWidth(referenceBitWidth)
+
+    # changes the bit width of the byte offset, only used to choose automatic widths (see values.Struct.addAutoRef)
+    def setReferenceBitWidth(self, referenceBitWidth):
+        self.referenceBitWidth = referenceBitWidth
+        self.referenceType = getIntType(ReferenceType.formats[referenceBitWidth], referenceBitWidth)
         self.name = self.referenceType.name
 
     def __repr__(self):
@@ -436,6 +523,8 @@ class ConstCharPointerType(Type):
     """
     This type should only be used to refer to static constants.
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
 
@@ -458,6 +547,8 @@ class ConstCharPointerType(Type):
 
 
 class ArrayType(Type):
+    __slots__ = ("elementType",)
+
     def __init__(self, elementType):
         super(ArrayType, self).__init__()
         if elementType.isMutable():
@@ -477,6 +568,8 @@ class ArrayType(Type):
 # array types
 # simple arrays are c arrays
 class SimpleArrayType(ArrayType):
+    __slots__ = ("fixedSize", "suffix", "alignment")
+
     # a fixed size of None means array type doesn't have a fixed size
     # we can override alignment (in bytes)
     def __init__(self, elementType, fixedSize=None, byteAlignment=None):
@@ -532,19 +625,36 @@ class SimpleArrayType(ArrayType):
         return self
 
 
+_charArrayTypes = {}  # fixedSize -> shared char array type
+
+
+# returns the shared type of char arrays (strings) with the given fixed size
+def getCharArrayType(fixedSize=None):
+    charArrayType = _charArrayTypes.get(fixedSize)
+    if charArrayType is None:
+        charArrayType = _charArrayTypes[fixedSize] = SimpleArrayType(CHAR, fixedSize)
+    return charArrayType
+
+
 # array of references - modelled as a struct
 class ReferenceArrayType(ArrayType):
+    __slots__ = ("fixedSize", "referenceBitWidth", "uniqueName")
     infix = {8: "8", 16: "16", 32: ""}  # infix used to denote the array
 
     def __init__(self, elementType, fixedSize=None, referenceBitWidth=32):
         ArrayType.__init__(self, ReferenceType(elementType, referenceBitWidth))
-        self.referenceBitWidth = referenceBitWidth
         self.fixedSize = fixedSize
+        self.setReferenceBitWidth(referenceBitWidth)
+
+    # changes the bit width of the element byte offsets, see ReferenceType.setReferenceBitWidth
+    def setReferenceBitWidth(self, referenceBitWidth):
+        self.elementType.setReferenceBitWidth(referenceBitWidth)
+        self.referenceBitWidth = referenceBitWidth
         arraySuffix = "Ref" + ReferenceArrayType.infix[referenceBitWidth] + "Array"
-        if fixedSize is not None:
-            arraySuffix = "Size" + str(fixedSize) + arraySuffix
-        self.name = elementType.getName() + arraySuffix
-        self.uniqueName = elementType.getUniqueName() + arraySuffix
+        if self.fixedSize is not None:
+            arraySuffix = "Size" + str(self.fixedSize) + arraySuffix
+        self.name = self.elementType.targetType.getName() + arraySuffix
+        self.uniqueName = self.elementType.targetType.getUniqueName() + arraySuffix
 
     def getCointainedTypes(self):
         return [self.elementType.targetType]
@@ -599,10 +709,12 @@ class ReferenceArrayType(ArrayType):
 
 # Create an integer enum with the given name and mapping. Just calls the constructor of EnumType
 def IntEnumType(name, mapping, bitWidth=32, unsigned=False):
-    return EnumType(name, IntType(unsigned=unsigned, bitWidth=bitWidth), mapping)
+    return EnumType(name, getIntType(unsigned, bitWidth), mapping)
 
 
 class EnumType(Type):
+    # no __slots__, the enum values are also stored as attributes
+
     # Create an enum with the given type name, underlying type and name->value mapping.
     # The underlying type should be a primitive type (integer, char)
     # the mapping should either be a dictionary (names will be sorted), or a list of name->value pairs
@@ -664,6 +776,10 @@ class EnumType(Type):
     def getForwardDeclaration(self):
         return "enum class {name} : {type};".format(name=self.uniqueName, type=self.name)
 
+    def getSchemaDescription(self):
+        return (Type.getSchemaDescription(self) + " " + self.name + " "
+                + ",".join("%s=%s" % (name, value.getLiteral()) for name, value in self.mapping.items()))
+
     def getAccessorFunction(self, memberName, indent=namedstruct.stringhelper.indent):
         functionName = "get" + namedstruct.stringhelper.capitalizeFirst(memberName)
         functionCode = (
@@ -721,6 +837,8 @@ class IncompleteType(Type):
     """
     Create an incomplete type (forward declaration only) based on another namedstruct data type
     """
+    __slots__ = ("underlying_value",)
+
     def __init__(self, underlying_value):
         super(IncompleteType, self).__init__()
         self.underlying_value = underlying_value
@@ -731,6 +849,9 @@ class IncompleteType(Type):
 
 
 class StructType(Type, namedstruct.constants.AddConstantFunctions):
+    __slots__ = ("constantPool", "mutable", "alignment", "members", "names", "offsets", "types", "numPadBytes",
+                 "compatibilityBoundary", "hasValues")
+
     def __init__(self, name):
         super(StructType, self).__init__()
         self.constantPool = namedstruct.constants.ConstantPool()
@@ -742,6 +863,8 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
         self.offsets = []  # list of member offsets
         self.types = []  # list of member types
         self.numPadBytes = 0  # the total number of padding bytes in struct
+        self.compatibilityBoundary = None  # number of non-padding members that packOptimized may reorder
+        self.hasValues = False  # whether a struct value stores its member values in this type's order
 
     def addConstant(self, name, value):
         self.constantPool.addConstant(name, value)
@@ -757,11 +880,10 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
         padding = 0
         currentWidth = self.getCurrentWidth()
         if currentWidth > 0:
-            while (-currentWidth) % byteAlignment != 0:
-                self.addMember("paddingByte" + str(self.numPadBytes), PADDING)
-                self.numPadBytes += 1
-                currentWidth += 1
-                padding += 1
+            padding = (-currentWidth) % byteAlignment
+            if padding > 0:
+                self.addMember("paddingBytes" + str(self.numPadBytes), getPaddingType(padding))
+                self.numPadBytes += padding
         return padding
 
     # returns how many padding bytes were added before adding the member
@@ -782,6 +904,51 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
         self.alignment = max(self.alignment, memberType.getAlignment())
         return padding
 
+    # returns whether the member at the given index holds padding bytes added by addPadding
+    def isPaddingMember(self, index):
+        return isinstance(self.types[index], PaddingType)
+
+    # marks the members added so far as the ones whose order may be changed by packOptimized. Members added
+    # afterwards keep their declared order, and are placed after them. Returns self.
+    def addCompatibilityBoundary(self):
+        if not self.mutable:
+            raise Exception("cannot add compatibility boundary to finalized struct " + self.name)
+        self.compatibilityBoundary = sum(1 for i in range(len(self.names)) if not self.isPaddingMember(i))
+        return self
+
+    # returns the indices of the non-padding members, in the order that minimizes padding bytes: the members before
+    # the compatibility boundary sorted by decreasing alignment, followed by the remaining ones in declared order.
+    # Without a compatibility boundary, all members may be reordered.
+    def getOptimizedOrder(self):
+        indices = [i for i in range(len(self.names)) if not self.isPaddingMember(i)]
+        boundary = len(indices) if self.compatibilityBoundary is None else self.compatibilityBoundary
+        reordered = sorted(indices[:boundary], key=lambda i: -self.types[i].getAlignment())  # sort is stable
+        return reordered + indices[boundary:]
+
+    # removes all the padding bytes, and re-adds the members at the given indices in the given order.
+    # Returns a list of the number of padding bytes added before each of the members.
+    def setMemberOrder(self, indices):
+        if not self.mutable:
+            raise Exception("cannot change the layout of finalized struct " + self.name)
+        members = [(self.names[i], self.types[i]) for i in indices]
+        self.members = {}
+        self.names = []
+        self.offsets = []
+        self.types = []
+        self.numPadBytes = 0
+        self.alignment = 1
+        return [self.addMember(name, memberType) for name, memberType in members]
+
+    # reorders the members to minimize the padding bytes (see getOptimizedOrder).
+    # Returns the number of bytes saved. The type of a struct value can't be reordered this way, as the member values
+    # would not be reordered with it - use Struct.packOptimized instead.
+    def packOptimized(self):
+        if self.hasValues:
+            raise Exception("cannot reorder the type of struct value %s, use Struct.packOptimized" % self.name)
+        width = self.getCurrentWidth()
+        self.setMemberOrder(self.getOptimizedOrder())
+        return width - self.getCurrentWidth()
+
     # returns the byte offset,type,name for the member at the given index
     def getMember(self, index):
         return self.offsets[index], self.types[index], self.names[index]
@@ -810,6 +977,51 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
         self.mutable = False
         return paddingBytes
 
+    # finalizes the struct type if necessary, and returns a values.StructSchema that builds and packs records of
+    # this type. Only struct types with int and char members can be compiled.
+    def compile(self, byteAlignment=4):
+        if self.mutable:
+            self.finalize(byteAlignment)
+        return namedstruct.values.StructSchema(self)
+
+    # methods to build struct types like values, e.g. StructType("foo").int32("x").uint8("y").char("c").
+    # They add a member of the given primitive type, and return self.
+    def int8(self, name):
+        self.addMember(name, INT8)
+        return self
+
+    def uint8(self, name):
+        self.addMember(name, UINT8)
+        return self
+
+    def int16(self, name):
+        self.addMember(name, INT16)
+        return self
+
+    def uint16(self, name):
+        self.addMember(name, UINT16)
+        return self
+
+    def int32(self, name):
+        self.addMember(name, INT32)
+        return self
+
+    def uint32(self, name):
+        self.addMember(name, UINT32)
+        return self
+
+    def int64(self, name):
+        self.addMember(name, INT64)
+        return self
+
+    def uint64(self, name):
+        self.addMember(name, UINT64)
+        return self
+
+    def char(self, name):
+        self.addMember(name, CHAR)
+        return self
+
     def isImmediate(self):
         return not self.mutable
 
@@ -845,18 +1057,22 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
         result.constantPool = self.constantPool  # FIXME - This is a hack! Properly deal with constant pools!
         return result
 
+    # describes the members with their offsets and types, and the constants of the struct
+    def getSchemaDescription(self):
+        return (Type.getSchemaDescription(self) + (" mutable " if self.mutable else " ")
+                + ",".join("%s@%d:%s" % (name, offset, memberType.getUniqueName())
+                           for name, offset, memberType in zip(self.names, self.offsets, self.types))
+                + " " + self.constantPool.getConstantDeclarations())
+
     def getForwardDeclaration(self):
         return "struct " + self.getName() + ";"
 
     def getDeclaration(self, indent=namedstruct.stringhelper.indent, includeSetters=False):
-        indent = indent
-        result = "typedef struct __attribute__((packed)) %s {\n" % self.getName()
+        result = ["typedef struct __attribute__((packed)) %s {\n" % self.getName()]  # chunks of the declaration
 
         # add constants
         if self.constantPool.getNumConstants() > 0:
-            result = (result
-                      + indent
-                      + self.constantPool.getConstantDeclarations().replace("\n", "\n" + indent) + "\n")
+            result.append(indent + self.constantPool.getConstantDeclarations().replace("\n", "\n" + indent) + "\n")
 
         # add members
         typeWidth = max([0] + [len(memberType.getName()) for memberType in self.types])
@@ -868,27 +1084,27 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
             memberTypeDesclarationNameSuffix = memberType.getDeclarationNameSuffix()
             space = " " * (typeWidth + 1 - len(memberTypeName))
             comment = ""  # comment comes from struct or from type
-            result = (result
-                      + indent
-                      + memberTypeName + space
-                      + memberName + memberTypeDesclarationNameSuffix + ";"
-                      + comment
-                      + "\n")
-
-        # add accessor functions
-        functions = ""
+            result.append(indent
+                          + memberTypeName + space
+                          + memberName + memberTypeDesclarationNameSuffix + ";"
+                          + comment
+                          + "\n")
+
+        # add accessor functions, each one surrounded by empty lines - the indent of the last one is dropped
+        functions = []
         for i, memberName in enumerate(self.names):
             memberType = self.types[i]
             accessorFunction = memberType.getAccessorFunction(memberName, indent=namedstruct.stringhelper.indent)
             if accessorFunction is not None:
-                accessorFunction = ("\n" + accessorFunction + "\n").replace("\n", "\n" + indent)
-                functions += accessorFunction
+                functions.append(("\n" + accessorFunction + "\n").replace("\n", "\n" + indent))
         if len(functions) > 0:
-            result = result + functions[:-len(indent)]
+            functions[-1] = functions[-1][:-len(indent)]
+            result.extend(functions)
 
-        # add equal
+        # add equal, padding bytes are not compared
         if self.hasEqualMethod():
-            result += """{indent}
+            compared = [i for i in range(len(self.names)) if not self.isPaddingMember(i)]
+            result.append("""{indent}
             {indent}bool operator==(const {name}& other) const {{
             {indent}{indent}return {prefix}{comparisonExpression}{postfix};
             {indent}}}
@@ -898,19 +1114,21 @@ class StructType(Type, namedstruct.constants.AddConstantFunctions):
             {indent}}}
             """.format(name=self.getName(),
                        indent=indent,
-                       prefix="(    " if len(self.names) > 1 else "",
-                       postfix=")" if len(self.names) > 1 else "",
+                       prefix="(    " if len(compared) > 1 else "",
+                       postfix=")" if len(compared) > 1 else "",
                        comparisonExpression=(("\n{i}{i}        and ".format(i=indent))
                                              .join("{name}{suffix} == other.{name}{suffix}"
-                                                   .format(name=n, suffix=self.types[i].getNameSuffix())
-                                                   for i, n in enumerate(self.names))))
+                                                   .format(name=self.names[i], suffix=self.types[i].getNameSuffix())
+                                                   for i in compared))))
         # finish
-        result = result + "} " + self.getName() + ";"
-        return result
+        result.append("} " + self.getName() + ";")
+        return "".join(result)
 
 
 # a special struct type, an array of bitfield values
 class BitFieldArrayType(Type):
+    __slots__ = ("fields",)
+
     def __init__(self, name, fields):
         super(BitFieldArrayType, self).__init__()
         self.name = name
@@ -934,17 +1152,17 @@ class BitFieldArrayType(Type):
         return "struct " + self.getName() + ";"
 
     def getDeclaration(self, indent=namedstruct.stringhelper.indent, includeSetters=False):
-        result = "typedef struct __attribute__((packed)) %s {\n" % self.getName()
+        result = ["typedef struct __attribute__((packed)) %s {\n" % self.getName()]  # chunks of the declaration
 
         # add members
-        result += indent + "uint16_t bitFieldArrayEntryBits;\n"
+        result.append(indent + "uint16_t bitFieldArrayEntryBits;\n")
         for i, field in enumerate(self.fields):
-            result += indent + "uint16_t %sBitOffset;\n" % field
-        result += indent + "uint16_t endOffset;"
+            result.append(indent + "uint16_t %sBitOffset;\n" % field)
+        result.append(indent + "uint16_t endOffset;")
 
         # add accessor functions
         # by index accessors:
-        result += """{indent}
+        result.append("""{indent}
 {indent}
 {indent}/** returns the number of fields stored in this. Incoming data may have fewer
 {indent}    or more than the defined number of fields, in which case it's still valid to
@@ -970,14 +1188,14 @@ class BitFieldArrayType(Type):
 {indent}{indent}const int nextBitOffset = ((uint16_t*)(this))[2+fieldIndex];
 {indent}{indent}const int bitOffset = thisBitOffset + elementIndex*bitFieldArrayEntryBits;
 {indent}{indent}return namedstruct::readBits(this, bitOffset, nextBitOffset-thisBitOffset);
-{indent}}}""".format(indent=namedstruct.stringhelper.indent)
+{indent}}}""".format(indent=namedstruct.stringhelper.indent))
         # by name accessors:
         for i, field in enumerate(self.fields):
             if i == len(self.fields) - 1:
                 nextBitOffset = "endOffset"
             else:
                 nextBitOffset = self.fields[i + 1] + "BitOffset"
-            result += """{indent}
+            result.append("""{indent}
 {indent}
 {indent}/** returns the bit offset of field {field} at the given index, assuming it is present */
 {indent}inline int get{Field}BitOffset(int index) const {{
@@ -1005,16 +1223,19 @@ class BitFieldArrayType(Type):
 {indent}inline uint32_t get{Field}OrDefault(int index, int defaultValue = 0) const {{
 {indent}{indent}return has{Field}() ? get{Field}(index) : defaultValue;
 {indent}}}""".format(i=i, field=field, indent=namedstruct.stringhelper.indent, nextBitOffset=nextBitOffset,
-                     Field=namedstruct.stringhelper.capitalizeFirst(field))
+                     Field=namedstruct.stringhelper.capitalizeFirst(field)))
 
         # finish
-        result = result + "\n} " + self.getName() + ";"
-        return result
+        result.append("\n} " + self.getName() + ";")
+        return "".join(result)
 
     def merge(self, other):
         _typeEqualAssert(self, other, "fields")
         return self
 
+    def getSchemaDescription(self):
+        return Type.getSchemaDescription(self) + " " + ",".join(self.fields)
+
     def isImmediate(self):
         return False
 
@@ -1,8 +1,13 @@
 from __future__ import absolute_import
 import collections
+import hashlib
+import os
+import numbers
 
 import namedstruct.values
 import namedstruct.n_types
+import namedstruct.packing
+import namedstruct.pythonmodule
 import namedstruct.stringhelper
 
 
@@ -44,6 +49,7 @@ import namedstruct.stringhelper
 # value.pack(last struct offset, offset where referred data starts)
 #   returns (packed data, referred offseted data)
 # - if referred offset is None, just appends all referred data
+# value.packInto(buffer, offset, base) - writes the value directly into a single pack buffer, see packing.py
 # struc.pack, array.pack - complicated
 # intvalue.pack - easy
 # getImmediateDataSize() - the size of the data as stored immediately, i.e. excluiding referred data
@@ -115,7 +121,8 @@ import namedstruct.stringhelper
 #
 #
 # pack() -> simple, tree traversal creation of data
-# packOptimized() -> will attempt to minimize the padding bytes used, or store data in padding?
+# packOptimized() -> reorders the members of a mutable struct by alignment to minimize the padding bytes used,
+#                    members after the compatibility boundary keep their declared order
 #
 #
 #
@@ -182,37 +189,39 @@ import namedstruct.stringhelper
 # headText can be used to add license/author etc.
 # structs may be a value or a sequence of structs/bitfield values/enum type
 # constantPools may be a single constantPool or a sequence of constant Pools
+# If fingerprint is true, the schema fingerprint (see getSchemaFingerprint) is declared as a constant
+# <NAME>_SCHEMA_FINGERPRINT, where NAME is the name of the first struct.
 def generateHeader(valuesOrEnumTypes, constantPools=None, namespace=None, define=None, headText="",
-                   indent=namedstruct.stringhelper.indent, includeSetters=False):
-    from . import constants  # Avoid circular dependencies
+                   indent=namedstruct.stringhelper.indent, includeSetters=False, fingerprint=False):
+    chunks = []
+    writeHeader(chunks, valuesOrEnumTypes, constantPools, namespace, define, headText, indent, includeSetters,
+                fingerprint)
+    return "".join(chunks)
+
+
+# writes the c++ header file text that generateHeader returns to the given file object, or appends its chunks to
+# the given list. The header is written declaration by declaration, so the time is linear in the header size.
+def writeHeader(out, valuesOrEnumTypes, constantPools=None, namespace=None, define=None, headText="",
+                indent=namedstruct.stringhelper.indent, includeSetters=False, fingerprint=False):
+    write = out.append if isinstance(out, list) else out.write
 
     # massage arguments
     if isinstance(valuesOrEnumTypes, namedstruct.values.Value):
         valuesOrEnumTypes = [valuesOrEnumTypes]
-    if constantPools is None:
-        constantPools = []
-    if isinstance(constantPools, constants.ConstantPool):
-        constantPools = [constantPools]
+    constantPools = _getConstantPools(constantPools)
+    rootName = valuesOrEnumTypes[0].getType().getName().upper()
     if define is None:
-        define = "__" + valuesOrEnumTypes[0].getType().getName().upper() + "__"
+        define = "__" + rootName + "__"
     namespaceString = ""
     if namespace is not None:
         namedstruct.stringhelper.assertIsValidIdentifier(namespace)
         namespaceString = "namespace %s {\n" % namespace
     
     # get all types
-    allTypes = []
-    for s in valuesOrEnumTypes:
-        if isinstance(s, namedstruct.n_types.EnumType):
-            allTypes.append(s)
-        elif isinstance(s, (namedstruct.values.Struct, namedstruct.values.BitField, namedstruct.values.EnumValue,)):
-            allTypes.append(s.type)
-        else:
-            raise Exception("cannot generated header for value: %s" % s)
-    allTypes = getAllTypes(allTypes)  # recursively get contained types
+    allTypes = getHeaderTypes(valuesOrEnumTypes)
     
     # start header
-    result = headText + """
+    write(headText + """
 // Code generated by namedstruct.py
 
 #ifndef {define}
@@ -220,61 +229,140 @@ def generateHeader(valuesOrEnumTypes, constantPools=None, namespace=None, define
 #include <stdint.h>
 #include <namedstruct/bits.h>
 
-{namespaceString}""".format(define=define, namespaceString=namespaceString)
+{namespaceString}""".format(define=define, namespaceString=namespaceString))
     currentIndent = "" if namespace is None else indent
     
     # put constants
-    constant = ""
-    if len(constantPools) > 0:
-        for pool in constantPools:
-            if pool.getNumConstants() > 0:
-                constant = (constant
-                            + "\n" + indent
-                            + pool.getConstantDeclarations().replace("\n", "\n" + indent))
-    if len(constant) > 0:
-        result = (result
-                  + currentIndent + "\n" + currentIndent
-                  + "// *** constants *****************************"
-                  + constant
-                  + "\n" + currentIndent + "\n")
+    constantDeclarations = [pool.getConstantDeclarations() for pool in constantPools if pool.getNumConstants() > 0]
+    if len(constantDeclarations) > 0:
+        write(currentIndent + "\n" + currentIndent + "// *** constants *****************************")
+        for declarations in constantDeclarations:
+            write("\n" + indent + declarations.replace("\n", "\n" + indent))
+        write("\n" + currentIndent + "\n")
+    
+    # put schema fingerprint
+    if fingerprint:
+        write(currentIndent + "\n" + currentIndent + "// *** schema fingerprint ********************\n"
+              + currentIndent + "static constexpr uint64_t %s_SCHEMA_FINGERPRINT = 0x%016xULL;\n"
+              % (rootName, _computeSchemaFingerprint(allTypes)))
     
     # put forward declaration of all types - todo put only necessary ones...
-    forwardDeclarations = ""
-    for cppType in list(allTypes.values()):
+    write(currentIndent + "\n" + currentIndent + "// *** forward declarations ******************\n")
+    for cppType in allTypes.values():
         forwardDeclaration = cppType.getForwardDeclaration()
-        if forwardDeclaration is None:
-            continue
-        forwardDeclarations = forwardDeclarations + currentIndent + forwardDeclaration + "\n"
-    if len(forwardDeclarations) >= 0:
-        result = (result
-                  + currentIndent + "\n" + currentIndent
-                  + "// *** forward declarations ******************\n"
-                  + forwardDeclarations)
+        if forwardDeclaration is not None:
+            write(currentIndent + forwardDeclaration + "\n")
     
-    # put declaration of all types
-    typeDeclarations = ""
-    for name, cppType in list(allTypes.items()):
+    # put declaration of all types, indenting every line
+    write(currentIndent + "\n" + currentIndent + "\n" + currentIndent + "// *** type declarations *********************")
+    for cppType in allTypes.values():
         declaration = cppType.getDeclaration(indent=indent, includeSetters=includeSetters)
-        if declaration is None:
-            continue
-        typeDeclarations = (typeDeclarations
-                            + "\n" + currentIndent
-                            + (declaration
-                               + "\n").replace("\n", "\n" + currentIndent)
-                            + "\n" + currentIndent)
-
-    result = result
-    if len(typeDeclarations) >= 0:
-        result = (result + currentIndent + "\n" + currentIndent + "\n"
-                  + currentIndent + "// *** type declarations *********************"
-                  + typeDeclarations)
-        
-        # finish header
-    result = (result
-              + "\n"
-              + ("" if not namespace else "}\n")
-              + "#endif /* defined(%s) */\n" % define)
-    return result
+        if declaration is not None:
+            write("\n" + currentIndent + (declaration + "\n").replace("\n", "\n" + currentIndent)
+                  + "\n" + currentIndent)
+
+    # finish header
+    write("\n"
+          + ("" if not namespace else "}\n")
+          + "#endif /* defined(%s) */\n" % define)
+
+
+# writes the header (see writeHeader) with the schema fingerprint to the file at the given path, unless the file
+# was already written for the same schema fingerprint and header arguments. An unchanged header file keeps its
+# modification time, so the c++ code that includes it doesn't get recompiled. Returns whether the file was written.
+def writeHeaderFile(path, valuesOrEnumTypes, constantPools=None, namespace=None, define=None, headText="",
+                    indent=namedstruct.stringhelper.indent, includeSetters=False):
+    if isinstance(valuesOrEnumTypes, namedstruct.values.Value):
+        valuesOrEnumTypes = [valuesOrEnumTypes]
+    constantPools = _getConstantPools(constantPools)
+    # the first line of the header identifies everything the header text depends on
+    key = hashlib.sha1(repr((_headerFormatVersion, getSchemaFingerprint(valuesOrEnumTypes),
+                             [pool.getConstantDeclarations() for pool in constantPools],
+                             namespace, define, headText, indent, includeSetters)).encode("utf-8"))
+    keyLine = "// namedstruct header %s\n" % key.hexdigest()
+    try:
+        with open(path) as f:
+            if f.readline() == keyLine:
+                return False
+    except IOError:
+        pass
+    with open(path + ".tmp", "w") as f:  # the header is replaced once it's complete
+        f.write(keyLine)
+        writeHeader(f, valuesOrEnumTypes, constantPools, namespace, define, headText, indent, includeSetters,
+                    fingerprint=True)
+    os.replace(path + ".tmp", path)
+    return True
+
+
+# returns a stable 64 bit fingerprint of the schema of the given structs/bitfield values/enum types, i.e. of all
+# the types that a header generated for them declares. The fingerprint changes when the names, member order,
+# widths or reference widths of any of the types change.
+def getSchemaFingerprint(valuesOrEnumTypes):
+    return _computeSchemaFingerprint(getHeaderTypes(valuesOrEnumTypes))
+
+
+# returns the data packed from the struct (see 'pack'), prefixed with the 8 byte schema fingerprint.
+# The c++ code can check the prefix with namedstruct::skipFingerprint when loading the data.
+# schema is what the header was generated from: the structs/bitfield values/enum types passed to generateHeader, or
+# their precomputed fingerprint (see getSchemaFingerprint). It defaults to the struct itself.
+def packWithFingerprint(struct, addPadding=True, padExtra=True, paddingAlignment=4, schema=None):
+    if schema is None:
+        schema = struct
+    fingerprint = schema if isinstance(schema, numbers.Integral) else getSchemaFingerprint(schema)
+    return (fingerprint.to_bytes(8, "little")
+            + pack(struct, addPadding=addPadding, padExtra=padExtra, paddingAlignment=paddingAlignment))
+
+
+# returns the packed data following the fingerprint prefix written by packWithFingerprint, as a memoryview.
+# Raises an exception if the data was packed with a different schema.
+def skipFingerprint(data, fingerprint):
+    if len(data) < 8 or int.from_bytes(data[:8], "little") != fingerprint:
+        raise Exception("the data was not packed with the schema with fingerprint 0x%016x" % fingerprint)
+    return memoryview(data)[8:]
+
+
+# returns the source of a python module that reads data packed from the given structs/bitfield values/enum
+# types, the python equivalent of the header. It has a class per struct, bit field, reference array and bit field
+# array type, reading the members at fixed offsets with precompiled struct formats, see pythonmodule.
+def generatePythonModule(valuesOrEnumTypes):
+    return namedstruct.pythonmodule.getModuleSource(getHeaderTypes(valuesOrEnumTypes))
+
+
+_headerFormatVersion = 1  # increment whenever the generated header text changes, to invalidate cached headers
+
+
+def _getConstantPools(constantPools):
+    from . import constants  # Avoid circular dependencies
+    if constantPools is None:
+        return []
+    if isinstance(constantPools, constants.ConstantPool):
+        return [constantPools]
+    return constantPools
+
+
+# returns the ordered dict of unique name -> type of all the types declared in the header of the given
+# structs/bitfield values/enum types, see getAllTypes
+def getHeaderTypes(valuesOrEnumTypes):
+    if isinstance(valuesOrEnumTypes, namedstruct.values.Value):
+        valuesOrEnumTypes = [valuesOrEnumTypes]
+    namedstruct.packing.resolveAutoWidths(valuesOrEnumTypes)
+    allTypes = []
+    for s in valuesOrEnumTypes:
+        if isinstance(s, namedstruct.n_types.EnumType):
+            allTypes.append(s)
+        elif isinstance(s, (namedstruct.values.Struct, namedstruct.values.BitField, namedstruct.values.EnumValue,)):
+            allTypes.append(s.type)
+        else:
+            raise Exception("cannot generated header for value: %s" % s)
+    return getAllTypes(allTypes)  # recursively get contained types
+
+
+# the fingerprint are the first 8 bytes of the sha1 of the types' schema descriptions, sorted by unique name
+def _computeSchemaFingerprint(allTypes):
+    digest = hashlib.sha1()
+    for name in sorted(allTypes.keys()):
+        digest.update((allTypes[name].getSchemaDescription() + "\n").encode("utf-8"))
+    return int.from_bytes(digest.digest()[:8], "little")
 
 
 # pad will pad the given dat string value to 4-byte sizes -- except if it it's already 4-byte aligned, it will add
@@ -282,33 +370,148 @@ def generateHeader(valuesOrEnumTypes, constantPools=None, namespace=None, define
 # will interact with blob or bitfield-array data at the end of files. Padding can be disabled if the last
 # element in the resulting structure is known to not be some bit-data value.
 def pad(data, padExtra=True, paddingAlignment=4):
-    numPaddingBytes = paddingAlignment - (len(data) % paddingAlignment)
+    data += b'\0' * getNumPaddingBytes(len(data), padExtra, paddingAlignment)
+    return data
+
+
+# returns the number of bytes 'pad' would add to data of the given length
+def getNumPaddingBytes(length, padExtra=True, paddingAlignment=4):
+    numPaddingBytes = paddingAlignment - (length % paddingAlignment)
     if not padExtra and numPaddingBytes == paddingAlignment:
         numPaddingBytes = 0
-    data += b'\0' * numPaddingBytes
-    return data
+    return numPaddingBytes
 
 
 # packs a struct into a string, storing all contained values inside it
 # addPadding will call 'pad' on the result with the given arguments
-def pack(struct, addPadding=True, padExtra=True, paddingAlignment=4):
-    data, offsetedData = struct.pack(None)
-    assert (len(offsetedData) == 0)
+# workers allows packing in parallel, dedupe allows packing identical subtrees only once, memoize allows packing
+# unmodified subtrees again cheaply, see 'pack_into'
+# If trackChanges is true, the layout of the packed data is kept, and the changes made with Struct.overwrite to the
+# structs in it get recorded, so the data can be updated cheaply using 'repack'.
+def pack(struct, addPadding=True, padExtra=True, paddingAlignment=4, workers=None, dedupe=False, statistics=None,
+         memoize=False, trackChanges=False, executor=None):
+    packBuffer = namedstruct.packing.PackBuffer()
+    _packInto(packBuffer, struct, addPadding, padExtra, paddingAlignment, workers, dedupe, statistics, memoize,
+              trackChanges, executor)
+    return bytes(packBuffer.data)
+
+
+# packs a struct into the given buffer starting at the given offset, writing every value exactly once at its
+# final position. The buffer may be a bytearray, which will grow as needed, or any other writable buffer
+# (e.g. memoryview, mmap), which has to be large enough. A bytearray shorter than the offset gets zero-filled up to
+# it. Returns the number of bytes written.
+# If workers is more than 1, the referred subtrees get packed in parallel, using a process pool with that many
+# workers. The result is identical to packing serially. If an executor (e.g. a concurrent.futures.ProcessPoolExecutor)
+# is given, the subtrees get packed by it instead, and it is not shut down, so it can be reused for packing many
+# values - workers is then the number of workers to split the work for, and defaults to the number of CPUs. The
+# subtrees then get pickled to be sent to it, while the workers of an own pool are forked and inherit them.
+# If dedupe is true, identical referred subtrees get packed only once where possible, with all the references
+# pointing to the same copy (see packing.packValueDeduplicated). Packing statistics, like the number of bytes
+# saved by dedupe or by interned strings (see packing.StringPool), get added to the statistics dict, if given.
+# If memoize is true, copies of the packed data of large subtrees are kept, and used when the same subtrees get
+# packed again, as long as they were not modified since (see packing.packValueMemoized). This uses extra memory
+# for the copies, but makes packing mostly unmodified data again cheap.
+# The padding arguments are the same as for 'pack'.
+def pack_into(buffer, struct, offset=0, addPadding=True, padExtra=True, paddingAlignment=4, workers=None,
+              dedupe=False, statistics=None, memoize=False, executor=None):
+    packBuffer = namedstruct.packing.PackBuffer(buffer, offset)
+    _packInto(packBuffer, struct, addPadding, padExtra, paddingAlignment, workers, dedupe, statistics, memoize,
+              False, executor)
+    return packBuffer.getNumBytes()
+
+
+def _packInto(packBuffer, struct, addPadding, padExtra, paddingAlignment, workers, dedupe, statistics, memoize,
+              trackChanges, executor):
+    if executor is not None and workers is None:
+        workers = os.cpu_count() or 1
+    parallel = executor is not None or (workers is not None and workers > 1)
+    if memoize and (dedupe or parallel):
+        raise Exception("packing with memoize cannot be combined with dedupe or workers")
+    if trackChanges and (memoize or dedupe or parallel):
+        raise Exception("packing with trackChanges cannot be combined with memoize, dedupe or workers")
+    namedstruct.packing.resolveAutoWidths(struct)
+    if trackChanges:
+        namedstruct.packing.packValueTracked(packBuffer, struct, statistics)
+    elif dedupe:
+        if parallel:
+            raise Exception("packing with dedupe cannot be done in parallel")
+        namedstruct.packing.packValueDeduplicated(packBuffer, struct, statistics)
+    elif parallel:
+        namedstruct.packing.packValueParallel(packBuffer, struct, workers, statistics=statistics, executor=executor)
+    else:
+        namedstruct.packing.packValue(packBuffer, struct, statistics=statistics, memoize=memoize)
     if addPadding:
-        data = pad(data, padExtra=padExtra, paddingAlignment=paddingAlignment)
-    return data
+        packBuffer.reserve(packBuffer.end + getNumPaddingBytes(packBuffer.getNumBytes(), padExtra, paddingAlignment))
+
+
+# packs a struct and streams the data to the given (binary) file object, without holding the packed data
+# in memory. Byte offsets of references are back-patched by seeking in the file. If the file object is
+# not seekable (e.g. a pipe), a dry run of the packing determines the byte offsets first, so the data can be
+# written strictly sequentially. Returns the number of bytes written.
+# The padding arguments are the same as for 'pack'.
+def pack_to(fileobj, struct, addPadding=True, padExtra=True, paddingAlignment=4):
+    namedstruct.packing.resolveAutoWidths(struct)
+    patches = None
+    if not namedstruct.packing.StreamBuffer.canSeek(fileobj):
+        dryRun = namedstruct.packing.DryRunBuffer()
+        namedstruct.packing.packValue(dryRun, struct)
+        patches = dryRun.patches
+    packBuffer = namedstruct.packing.StreamBuffer(fileobj, patches)
+    namedstruct.packing.packValue(packBuffer, struct)
+    if addPadding:
+        packBuffer.reserve(packBuffer.end + getNumPaddingBytes(packBuffer.getNumBytes(), padExtra, paddingAlignment))
+    packBuffer.flush()
+    return packBuffer.getNumBytes()
+
+
+# returns the data packed from the struct (using 'pack' with trackChanges, and the same padding arguments), updated
+# to reflect the changes made with Struct.overwrite since. Only the overwritten members get packed again, and
+# overwritten references only if their referred data still has the same size - otherwise the struct gets packed
+# from scratch, with trackChanges, so the result can be repacked in turn.
+# Changes are tracked per top level struct, so only the data of the most recent tracked pack of a struct can be
+# updated. Other changes than overwrites (e.g. adding members) are not tracked, the struct has to be packed again.
+def repack(previousData, struct, addPadding=True, padExtra=True, paddingAlignment=4):
+    data = bytearray(previousData)
+    if not namedstruct.packing.repackInto(data, struct):
+        return pack(struct, addPadding=addPadding, padExtra=padExtra, paddingAlignment=paddingAlignment,
+                    trackChanges=True)
+    return bytes(data)
+
+
+# computes the offsets and sizes of all the values in the struct, as they would be packed, without producing
+# any data. Returns a Layout, which allows querying offsets, immediate and referred sizes of values.
+# The total size (without padding, see 'pack') is layout(struct).getSize()
+def layout(struct):
+    namedstruct.packing.resolveAutoWidths(struct)
+    return namedstruct.packing.computeLayout(struct)
 
 
 # returns an ordered dict of unique name -> type of all the unique types that are contained in the list
 # of types. The types with the same name are merged, which may result in exceptions if the types
-# are inconsistent. Thus this validates all the types contained in the type list
+# are inconsistent. Thus this validates all the types contained in the type list.
+# Every type object is visited once: types shared by several parents (e.g. the type of a value that is
+# referenced many times) are merged once, and their contained types are not walked again. The types are
+# visited children first, like getAllContainedTypes.
 def getAllTypes(typeList):
     types = collections.OrderedDict()  # name -> type
+    visited = set()  # ids of the visited types - the types are kept alive by the type list
     for root in typeList:
-        for t in root.getAllContainedTypes():
-            name = t.getUniqueName()
-            if name in types:
-                types[name] = types[name].merge(t)
-            else:
-                types[name] = t
+        if id(root) in visited:
+            continue
+        visited.add(id(root))
+        stack = [(root, iter(root.getContainedTypes()))]
+        while len(stack) > 0:
+            t, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                name = t.getUniqueName()
+                existing = types.get(name)
+                if existing is None:
+                    types[name] = t
+                elif existing is not t:
+                    types[name] = existing.merge(t)
+            elif id(child) not in visited:
+                visited.add(id(child))
+                stack.append((child, iter(child.getContainedTypes())))
     return types
@@ -0,0 +1,886 @@
+from __future__ import absolute_import
+import struct
+import collections
+import concurrent.futures
+import multiprocessing
+import weakref
+
+import namedstruct.values
+
+
+# the packing engine
+# Values are packed by writing them directly at their final offset into a single buffer, rather than
+# by concatenating the bytes of every subtree. Every value has a method
+#   value.packInto(buffer, offset, base)
+# which writes the immediate data of the value at the given absolute 'offset'. Byte offsets of references
+# are stored relative to the absolute position 'base'. The immediate data of a value has to be reserved
+# (via buffer.reserve) by the caller.
+# Instead of packing referred values recursively, packInto returns the list of (reference, offset, base)
+# tuples of all contained non-null references, in the order their targets have to be packed. The
+# targets get appended at the end of the buffer by 'packReferences', which uses an explicit stack, so
+# the depth of the packed tree is not limited by the python stack.
+# Interned strings are collected in a StringPool instead, and get packed after all other data of the top level value.
+
+
+# a growable byte buffer that values get packed into
+# data may be a bytearray, which will grow as needed, or any other writable buffer (e.g. a memoryview or
+# mmap), in which case the data has to fit. Packing will start at the given offset. A bytearray that ends before
+# the offset gets zero-filled up to it.
+class PackBuffer(object):
+    def __init__(self, data=None, offset=0):
+        if data is None:
+            data = bytearray()
+        if offset < 0:
+            raise Exception("cannot pack at negative offset %d" % offset)
+        self.growable = isinstance(data, bytearray)
+        if self.growable and offset > len(data):
+            data.extend(bytes(offset - len(data)))
+        self.data = data if self.growable else memoryview(data).cast('B')
+        if not self.growable and self.data.readonly:
+            raise Exception("cannot pack into a read-only buffer")
+        self.start = offset
+        self.end = offset  # the end of the data that was reserved so far
+
+    # ensures the data is reserved up to the given (absolute) end offset, zero-filling the new bytes
+    def reserve(self, end):
+        if end <= self.end:
+            return
+        if not self.growable and end > len(self.data):
+            raise Exception("buffer too small, need at least %d bytes, but only have %d" % (end, len(self.data)))
+        self.data[self.end:end] = bytes(end - self.end)
+        self.end = end
+
+    # writes the given bytes at the given (absolute) offset, which must have been reserved
+    def write(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+
+    # packs the values using the struct format at the given (absolute) offset, which must have been reserved
+    def packInto(self, formatString, offset, *values):
+        struct.pack_into(formatString, self.data, offset, *values)
+
+    def getNumBytes(self):
+        return self.end - self.start
+
+
+# packs the value at the end of the buffer, as a top level value. Its references will be relative to itself.
+# returns the offset where the value was packed
+# Statistics about interned strings get added to the statistics dict, if given (see StringPool.pack).
+# If memoize is true, the packed data of large subtrees gets memoized, see packValueMemoized.
+def packValue(buffer, value, statistics=None, memoize=False):
+    if memoize:
+        return packValueMemoized(buffer, value, statistics)
+    offset = buffer.end
+    pool = StringPool()
+    buffer.reserve(offset + value.getImmediateDataSize())
+    packReferences(buffer, value.packInto(buffer, offset, offset), pool)
+    pool.pack(buffer, statistics=statistics)
+    return offset
+
+
+# packs the given values as top level values, returns the list of their packed data.
+# This is the job that gets run by the workers of packValueParallel, which can't pack values that refer to interned
+# strings, as those have to end up in the pool of the whole tree - for those, None is returned if allowInterned
+# is false. The values get pickled to be sent to the workers, see packForkedValues to avoid that.
+def packValues(values, allowInterned=True):
+    result = []
+    for value in values:
+        buffer = PackBuffer()
+        statistics = {}
+        packValue(buffer, value, statistics=statistics)
+        if not allowInterned and statistics.get("internedReferences", 0) > 0:
+            result.append(None)
+        else:
+            result.append(bytes(buffer.data))
+    return result
+
+
+# the subtrees that packValueParallel splits off, while it packs them in forked workers, which inherit them
+_forkedValues = None
+
+
+# packs the values at the given index range of _forkedValues, like packValues. This is the job that gets run by
+# forked workers, so only the indices and the packed data are sent between the processes.
+def packForkedValues(start, end):
+    return packValues(_forkedValues[start:end], allowInterned=False)
+
+
+# packs the value at the end of the buffer like packValue, but packs the referred subtrees in parallel, using
+# a process pool with the given number of workers, or the given executor (which is not shut down, so it may be
+# reused for packing several values).
+# A subtree packs to the same bytes wherever it is placed, since all its byte offsets and padding are relative
+# to itself. So the tree is split into a frontier of independent subtrees (by expanding it level by level, until
+# there are enough of them), which get packed by the workers in consecutive batches. The values above the
+# frontier get packed as usual, and the packed subtrees get copied in when their reference is reached.
+# Where processes can be forked, the pool is created for this call after the subtrees are stored in _forkedValues,
+# so the workers inherit them, and only get sent the index ranges of their batches. The workers of a given executor
+# already exist, so the subtrees of the batches get pickled and sent to them instead.
+def packValueParallel(buffer, value, workers, batchesPerWorker=4, statistics=None, executor=None):
+    global _forkedValues
+    frontier = [(None, value)]
+    while len(frontier) < workers * batchesPerWorker:
+        expanded = []
+        for reference, target in frontier:
+            references = [r for r in target.packInto(DryRunBuffer(), 0, 0) if not r[0].interned]
+            if len(references) > 0:
+                expanded.extend((r, r.targetValue) for r, _, _ in references)
+            else:
+                expanded.append((reference, target))
+        if len(expanded) == len(frontier) and all(r is e[0] for (r, _), e in zip(frontier, expanded)):
+            break  # there are only leaves left
+        frontier = expanded
+    if frontier[0][0] is None:  # nothing to split
+        return packValue(buffer, value, statistics=statistics)
+
+    numBatches = min(len(frontier), workers * batchesPerWorker)
+    ranges = [(len(frontier) * i // numBatches, len(frontier) * (i + 1) // numBatches) for i in range(numBatches)]
+    jobIndices = {}  # id(reference) -> (batch index, index in batch)
+    for batchIndex, (batchStart, batchEnd) in enumerate(ranges):
+        for i in range(batchStart, batchEnd):
+            jobIndices[id(frontier[i][0])] = (batchIndex, i - batchStart)
+
+    ownExecutor = executor is None
+    forked = ownExecutor and "fork" in multiprocessing.get_all_start_methods()
+    if forked:
+        _forkedValues = [target for _, target in frontier]
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+        jobs = [executor.submit(packForkedValues, batchStart, batchEnd) for batchStart, batchEnd in ranges]
+    else:
+        if ownExecutor:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        jobs = [executor.submit(packValues, [target for _, target in frontier[batchStart:batchEnd]], False)
+                for batchStart, batchEnd in ranges]
+    try:
+        start = buffer.end
+        pool = StringPool()
+        buffer.reserve(start + value.getImmediateDataSize())
+        stack = list(reversed(value.packInto(buffer, start, start)))
+        while len(stack) > 0:
+            reference, offset, base = stack.pop()
+            if reference.interned:
+                pool.add(reference, offset, base)
+                continue
+            target = reference.targetValue
+            targetOffset = reference.packOffsetInto(buffer, offset, base)
+            data = None
+            if id(reference) in jobIndices:
+                batchIndex, i = jobIndices[id(reference)]
+                data = jobs[batchIndex].result()[i]
+            if data is not None:
+                buffer.reserve(targetOffset + len(data))
+                buffer.write(targetOffset, data)
+            else:  # not split off, or refers to interned strings
+                buffer.reserve(targetOffset + target.getImmediateDataSize())
+                stack.extend(reversed(target.packInto(buffer, targetOffset, targetOffset)))
+        pool.pack(buffer, statistics=statistics)
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+        else:
+            for job in jobs:
+                job.cancel()
+        if forked:
+            _forkedValues = None
+    return start
+
+
+# packs the targets of the given (reference, offset, base) tuples at the end of the buffer, depth first
+# Interned strings get added to the given StringPool.
+def packReferences(buffer, references, pool):
+    stack = list(reversed(references))
+    while len(stack) > 0:
+        reference, offset, base = stack.pop()
+        if reference.interned:
+            pool.add(reference, offset, base)
+            continue
+        target = reference.targetValue
+        targetOffset = reference.packOffsetInto(buffer, offset, base)
+        buffer.reserve(targetOffset + target.getImmediateDataSize())
+        stack.extend(reversed(target.packInto(buffer, targetOffset, targetOffset)))
+
+
+# the interned strings of a top level value (see values.InternedReference), which get packed after all its other
+# data, so the byte offsets of all the references to them are positive. Strings with the same content get packed
+# only once.
+class StringPool(object):
+    def __init__(self):
+        self.references = []  # (reference, offset, base) of the interned strings, in pack order
+
+    def __len__(self):
+        return len(self.references)
+
+    def add(self, reference, offset, base):
+        self.references.append((reference, offset, base))
+
+    # packs the strings at the end of the buffer, and sets the byte offsets of all the references to them.
+    # If a layout is given, the strings get added to it. If a statistics dict is given, the number of references
+    # to interned strings, how many of them could reuse an already packed string, and the number of bytes saved
+    # that way get added to it, as 'internedReferences', 'internedHits' and 'internedBytes', as well as the
+    # overall 'internedHitRate'.
+    def pack(self, buffer, layout=None, statistics=None):
+        offsets = {}  # packed string -> offset
+        numHits = 0
+        savedBytes = 0
+        for reference, offset, base in self.references:
+            target = reference.targetValue
+            data = packValues([target])[0]
+            if data in offsets:
+                reference.type.referenceType.packInto(buffer, offset, offsets[data] - base)
+                numHits += 1
+                savedBytes += len(data)
+                if layout is not None:
+                    layout.getEntry(reference).referredSize = 0
+                continue
+            start = buffer.end
+            targetOffset = reference.packOffsetInto(buffer, offset, base)
+            buffer.reserve(targetOffset + len(data))
+            buffer.write(targetOffset, data)
+            offsets[data] = targetOffset
+            if layout is not None:
+                layout.add(target, targetOffset)
+                layout.getEntry(reference).referredSize = buffer.end - start
+        if statistics is not None and len(self.references) > 0:
+            for key, count in [("internedReferences", len(self.references)), ("internedHits", numHits),
+                               ("internedBytes", savedBytes)]:
+                statistics[key] = statistics.get(key, 0) + count
+            statistics["internedHitRate"] = statistics["internedHits"] / statistics["internedReferences"]
+        self.references = []
+
+
+# returns a dict of id(value) -> subtree id for the value and all the values referred from it, where two
+# values get the same subtree id exactly if they pack to the same data (as top level values).
+def computeSubtreeIds(value):
+    subtreeIds = {}
+    keys = {}  # (immediate data, references) -> subtree id
+    stack = [(value, None)]
+    while len(stack) > 0:
+        value, packed = stack.pop()
+        if id(value) in subtreeIds:
+            continue
+        if packed is None:  # pack the immediate data now, assign the id once all the referred values have theirs
+            buffer = PackBuffer()
+            buffer.reserve(value.getImmediateDataSize())
+            references = value.packInto(buffer, 0, 0)
+            stack.append((value, (bytes(buffer.data), references)))
+            stack.extend((reference.targetValue, None) for reference, _, _ in references)
+            continue
+        data, references = packed
+        key = (data, tuple((offset, base, reference.type.referenceType.getFormatChar(),
+                            reference.type.targetType.getAlignment(), subtreeIds[id(reference.targetValue)])
+                           for reference, offset, base in references))
+        subtreeIds[id(value)] = keys.setdefault(key, len(keys))
+    return subtreeIds
+
+
+# packs the value at the end of the buffer like packValue, but packs identical referred subtrees only once:
+# a reference to a subtree that was already packed will point to the existing copy, as long as it lies after
+# the base of the reference (so the byte offset is positive) and is aligned properly. The result is not a tree
+# anymore, but readers can't tell the difference.
+# If a statistics dict is given, the number of references pointing to existing copies and the number of bytes
+# saved get added to it, as 'dedupedReferences' and 'dedupedBytes'. The bytes saved are the difference to the size
+# of the data packed without deduplication, which includes the padding the skipped copies would have needed.
+def packValueDeduplicated(buffer, value, statistics=None):
+    subtreeIds = computeSubtreeIds(value)
+    packed = {}  # subtree id -> offset of the packed copy
+    numDeduped = 0
+    pool = StringPool()
+    start = buffer.end
+    buffer.reserve(start + value.getImmediateDataSize())
+    stack = list(reversed(value.packInto(buffer, start, start)))
+    while len(stack) > 0:
+        item = stack.pop()
+        if len(item) == 2:  # the subtree is fully packed
+            subtreeId, targetOffset = item
+            packed[subtreeId] = targetOffset  # later copies are usable by more references
+            continue
+        reference, offset, base = item
+        if reference.interned:
+            pool.add(reference, offset, base)
+            continue
+        target = reference.targetValue
+        subtreeId = subtreeIds[id(target)]
+        if subtreeId in packed:
+            targetOffset = packed[subtreeId]
+            if targetOffset >= base and (targetOffset - base) % reference.type.targetType.getAlignment() == 0:
+                reference.type.referenceType.packInto(buffer, offset, targetOffset - base)
+                numDeduped += 1
+                continue
+        targetOffset = reference.packOffsetInto(buffer, offset, base)
+        buffer.reserve(targetOffset + target.getImmediateDataSize())
+        stack.append((subtreeId, targetOffset))
+        stack.extend(reversed(target.packInto(buffer, targetOffset, targetOffset)))
+    pool.pack(buffer, statistics=statistics)
+    if statistics is not None:
+        statistics["dedupedReferences"] = statistics.get("dedupedReferences", 0) + numDeduped
+        dedupedBytes = computeLayout(value, start).getSize() - (buffer.end - start)
+        statistics["dedupedBytes"] = statistics.get("dedupedBytes", 0) + dedupedBytes
+    return start
+
+
+# memoization
+# A subtree packs to the same data wherever it is placed, so when packing with memoize=True, the packed data of
+# large subtrees gets copied and kept, and copied in whenever the subtree gets packed again, as long as none of the
+# mutable values in it (structs, reference arrays and bit field arrays) were modified since, i.e. their versions
+# (see values.markModified) are the same. Only structs, reference arrays and bit field arrays get memoized.
+
+# packed subtrees of at least this many bytes get memoized, if they are at least twice as large as the largest
+# memoized subtree within them, so the copies of nested subtrees take at most about twice the size of the data
+memoizeMinSize = 1024
+
+# value -> Memo of the memoized subtrees, which are kept as long as their values are
+memos = weakref.WeakKeyDictionary()
+
+
+# returns whether the value is mutable, i.e. it has a version that gets incremented when it's modified
+def isMutableValue(value):
+    return isinstance(value, (namedstruct.values.Struct, namedstruct.values.ReferenceArray,
+                              namedstruct.values.BitFieldArray))
+
+
+# returns the mutable values stored in the immediate data of the value (e.g. immediate structs), not the value itself
+def getImmediateMutableValues(value):
+    result = []
+    stack = [v for v, _ in value.getImmediateValues(0)]
+    while len(stack) > 0:
+        value = stack.pop()
+        if isLeafValue(value):
+            continue
+        if isMutableValue(value):
+            result.append(value)
+        stack.extend(v for v, _ in value.getImmediateValues(0))
+    return result
+
+
+# the memoized packed data of a subtree, with the versions of the mutable values in it at the time it was packed.
+# The memos of the memoized subtrees within it are kept as children, rather than their values, so checking whether
+# a memo is still valid visits every mutable value once. A memo doesn't refer to the value of its subtree, so it
+# doesn't keep it alive.
+class Memo(object):
+    __slots__ = ("data", "version", "values", "versions", "children")
+
+    def __init__(self, data, value, values, children):
+        self.data = data
+        self.version = value.version
+        self.values = values  # the mutable values in the subtree, except the ones in memoized children
+        self.versions = [v.version for v in values]
+        self.children = children  # (value, memo) of the memoized subtrees within the subtree
+
+    # returns whether the memo is still valid for its value, i.e. none of the values in the subtree were modified
+    def isValid(self, value):
+        stack = [(value, self)]
+        while len(stack) > 0:
+            value, memo = stack.pop()
+            if value.version != memo.version:
+                return False
+            for v, version in zip(memo.values, memo.versions):
+                if v.version != version:
+                    return False
+            stack.extend(memo.children)
+        return True
+
+
+# a subtree that is being packed by packValueMemoized
+class _MemoSpan(object):
+    __slots__ = ("value", "start", "poolSize", "values", "children", "largestChild")
+
+    def __init__(self, value, start, poolSize):
+        self.value = value
+        self.start = start
+        self.poolSize = poolSize  # the number of interned strings before the subtree got packed
+        self.values = getImmediateMutableValues(value)
+        self.children = []
+        self.largestChild = 0
+
+    def addChild(self, value, memo):
+        self.children.append((value, memo))
+        self.largestChild = max(self.largestChild, len(memo.data))
+
+    # memoizes the subtree that was packed at the end of the buffer, if it qualifies, or merges it into the parent
+    # span otherwise. Subtrees containing interned references depend on the pool of the top level value they are
+    # packed in, so they never get memoized - neither does a top level value together with its pool, which is the
+    # same condition, as the pool is only non-empty if the value contains interned references.
+    def close(self, buffer, parent, poolSize):
+        size = buffer.end - self.start
+        if (isMutableValue(self.value) and size >= memoizeMinSize and size >= 2 * self.largestChild
+                and poolSize == self.poolSize):
+            memo = Memo(bytes(buffer.data[self.start:buffer.end]), self.value, self.values, self.children)
+            memos[self.value] = memo
+            if parent is not None:
+                parent.addChild(self.value, memo)
+        elif parent is not None:
+            parent.values.extend(self.values)
+            if isMutableValue(self.value):
+                parent.values.append(self.value)
+            for value, memo in self.children:
+                parent.addChild(value, memo)
+
+
+# packs the value at the given offset (the end of the buffer) by copying its memoized packed data, if it is
+# still valid. Returns the memo, or None if the value has to be packed.
+def packMemoized(buffer, value, offset):
+    if not isMutableValue(value):
+        return None
+    memo = memos.get(value)
+    if memo is None:
+        return None
+    if not memo.isValid(value):
+        del memos[value]
+        return None
+    buffer.reserve(offset + len(memo.data))
+    buffer.write(offset, memo.data)
+    return memo
+
+
+# packs the value at the end of the buffer like packValue, memoizing the packed data of large subtrees, and using
+# the memoized data of subtrees that were not modified since they were memoized
+def packValueMemoized(buffer, value, statistics=None):
+    start = buffer.end
+    if packMemoized(buffer, value, start) is not None:
+        return start
+    pool = StringPool()
+    spans = [_MemoSpan(value, start, 0)]
+    buffer.reserve(start + value.getImmediateDataSize())
+    stack = list(reversed(value.packInto(buffer, start, start)))
+    while len(stack) > 0:
+        item = stack.pop()
+        if item is None:  # the subtree of the innermost span is fully packed
+            span = spans.pop()
+            span.close(buffer, spans[-1], len(pool))
+            continue
+        reference, offset, base = item
+        if reference.interned:
+            pool.add(reference, offset, base)
+            continue
+        target = reference.targetValue
+        targetOffset = reference.packOffsetInto(buffer, offset, base)
+        memo = packMemoized(buffer, target, targetOffset)
+        if memo is not None:
+            spans[-1].addChild(target, memo)
+            continue
+        buffer.reserve(targetOffset + target.getImmediateDataSize())
+        spans.append(_MemoSpan(target, targetOffset, len(pool)))
+        stack.append(None)
+        stack.extend(reversed(target.packInto(buffer, targetOffset, targetOffset)))
+    poolSize = len(pool)  # packing the pool empties it
+    pool.pack(buffer, statistics=statistics)
+    spans[0].close(buffer, None, poolSize)
+    return start
+
+
+# a pack buffer that doesn't store any data, used to do a dry run of the packing. It records all the writes
+# that go to regions that were reserved before the most recent one - i.e. the byte offsets of references,
+# which are only known once the referred value gets packed - as a list of (offset, bytes) patches.
+class DryRunBuffer(object):
+    def __init__(self, offset=0, recordPatches=True):
+        self.start = offset
+        self.end = offset
+        self.writable = offset  # start of the most recently reserved region
+        self.patches = [] if recordPatches else None
+
+    def reserve(self, end):
+        if end <= self.end:
+            return
+        self.writable = self.end
+        self.end = end
+
+    def write(self, offset, data):
+        if offset < self.writable and self.patches is not None:
+            self.patches.append((offset, bytes(data)))
+
+    def packInto(self, formatString, offset, *values):
+        if offset < self.writable and self.patches is not None:
+            self.patches.append((offset, struct.pack(formatString, *values)))
+
+    def getNumBytes(self):
+        return self.end - self.start
+
+
+# a dry run buffer that records the offsets of all the values that don't fit into the format they get packed with
+class OverflowCheckingBuffer(DryRunBuffer):
+    def __init__(self, offset=0):
+        DryRunBuffer.__init__(self, offset, recordPatches=False)
+        self.overflows = set()
+
+    def packInto(self, formatString, offset, *values):
+        try:
+            struct.pack(formatString, *values)
+        except struct.error:
+            self.overflows.add(offset)
+
+
+# a pack buffer that streams the packed data to a file object, only holding on to the data that may still
+# be written to, i.e. the most recently reserved region, plus up to chunkSize bytes before it.
+# Writes behind the data that was already streamed out (i.e. byte offsets of references) are back-patched
+# by seeking in the file. If the file is not seekable (e.g. a pipe), the patches have to be supplied
+# up front, as recorded by a DryRunBuffer, and get applied while streaming the data.
+class StreamBuffer(object):
+    def __init__(self, fileobj, patches=None, chunkSize=1 << 16):
+        self.file = fileobj
+        self.seekable = patches is None
+        self.filePosition = fileobj.tell() if self.seekable else None
+        self.patches = sorted(patches) if patches is not None else []
+        self.numAppliedPatches = 0
+        self.chunkSize = chunkSize
+        self.pending = bytearray()  # the data from flushed to end, which hasn't been written to the file yet
+        self.start = 0
+        self.end = 0
+        self.writable = 0  # start of the most recently reserved region
+        self.flushed = 0
+
+    # returns whether packed data can be back-patched in the given file object
+    @staticmethod
+    def canSeek(fileobj):
+        try:
+            return fileobj.seekable() and 'a' not in getattr(fileobj, 'mode', '')
+        except AttributeError:
+            return False
+
+    def reserve(self, end):
+        if end <= self.end:
+            return
+        self.writable = self.end
+        self.pending += bytes(end - self.end)
+        self.end = end
+        if self.writable - self.flushed >= self.chunkSize:
+            self.flush(self.writable)
+
+    # writes out all the data before the given end offset (or all data) to the file
+    def flush(self, end=None):
+        if end is None:
+            end = self.end
+        while self.numAppliedPatches < len(self.patches) and self.patches[self.numAppliedPatches][0] < end:
+            offset, data = self.patches[self.numAppliedPatches]
+            self.write(offset, data)
+            self.numAppliedPatches += 1
+        self.file.write(self.pending[:end - self.flushed])
+        del self.pending[:end - self.flushed]
+        self.flushed = end
+
+    def write(self, offset, data):
+        if offset >= self.flushed:
+            self.pending[offset - self.flushed:offset - self.flushed + len(data)] = data
+        else:
+            self.writeFlushed(offset, data)
+
+    def packInto(self, formatString, offset, *values):
+        if offset >= self.flushed:
+            struct.pack_into(formatString, self.pending, offset - self.flushed, *values)
+        else:
+            self.writeFlushed(offset, struct.pack(formatString, *values))
+
+    def writeFlushed(self, offset, data):
+        if not self.seekable:
+            return  # the data was already patched in before it got flushed
+        self.file.seek(self.filePosition + offset)
+        self.file.write(data)
+        self.file.seek(self.filePosition + self.flushed)
+
+    def getNumBytes(self):
+        return self.end - self.start
+
+
+# returns whether the value is a primitive, i.e. it has no immediate values and never refers to any data
+def isLeafValue(value):
+    return isinstance(value, (namedstruct.values.PrimitiveValue, namedstruct.values.EnumValue,
+                              namedstruct.values.BitField, namedstruct.values.Padding))
+
+
+# the offsets and sizes of the values of a packed tree, as computed by computeLayout.
+# Every value has an immediate size, and a referred size, which is the size of all the data that is referred
+# from the immediate data (including padding bytes), which is stored after it. The entries are memoized
+# for all values except primitive ones, which have no referred data.
+# Values that appear multiple times in the tree will use the first occurrence. The entries keep their values, so
+# the ids they are keyed by can't be reused by other values while the layout exists.
+class Layout(object):
+    class Entry(object):
+        def __init__(self, value, offset, immediateSize):
+            self.value = value
+            self.offset = offset
+            self.immediateSize = immediateSize
+            self.referredSize = None  # computed lazily, except for references
+            self.version = getattr(value, "version", None)  # of mutable values when they were added, see markModified
+
+    def __init__(self, offset=0):
+        self.start = offset
+        self.end = offset
+        self.entries = {}  # id(value) -> Entry
+        self.changes = []  # (struct, member index, replaced value) for tracked layouts, see packValueTracked
+
+    # records that the member with the given index of the struct was overwritten, see values.Struct.overwrite,
+    # which has already incremented the struct's version. Changes to structs that are no longer part of the layout
+    # get ignored.
+    def addChange(self, struct, index, replaced):
+        if struct in self:
+            self.changes.append((struct, index, replaced))
+            self.getEntry(struct).version = struct.version
+
+    # returns whether any of the mutable values in the layout was modified since it was added, other than by the
+    # changes recorded with addChange
+    def isModified(self):
+        return any(getattr(entry.value, "version", None) != entry.version for entry in self.entries.values())
+
+    # adds the entries for the value packed at the given offset, and all the values in its immediate data
+    def add(self, value, offset):
+        stack = [(value, offset)]
+        while len(stack) > 0:
+            value, offset = stack.pop()
+            if isLeafValue(value) or id(value) in self.entries:
+                continue
+            self.entries[id(value)] = Layout.Entry(value, offset, value.getImmediateDataSize())
+            stack.extend(value.getImmediateValues(offset))
+
+    # removes the entries of the value and all the values referred from it
+    def remove(self, value):
+        stack = [value]
+        while len(stack) > 0:
+            value = stack.pop()
+            if isLeafValue(value) or self.entries.pop(id(value), None) is None:
+                continue
+            if isinstance(value, namedstruct.values.Reference) and value.targetValue is not None:
+                stack.append(value.targetValue)
+            stack.extend(v for v, _ in value.getImmediateValues(0))
+
+    def __contains__(self, value):
+        return id(value) in self.entries
+
+    def getEntry(self, value):
+        try:
+            return self.entries[id(value)]
+        except KeyError:
+            raise Exception("value %r is not part of the layout" % (value,))
+
+    # returns the absolute offset of the immediate data of the value
+    def getOffset(self, value):
+        return self.getEntry(value).offset
+
+    def getImmediateSize(self, value):
+        if isLeafValue(value):
+            return value.getImmediateDataSize()
+        return self.getEntry(value).immediateSize
+
+    def getReferredSize(self, value):
+        if isLeafValue(value):
+            return 0
+        entry = self.getEntry(value)
+        if entry.referredSize is None:
+            entry.referredSize = sum(self.getReferredSize(v) for v, _ in value.getImmediateValues(entry.offset))
+        return entry.referredSize
+
+    # returns the total size of the value (immediate and referred data), or the size of the whole tree
+    def getSize(self, value=None):
+        if value is None:
+            return self.end - self.start
+        return self.getImmediateSize(value) + self.getReferredSize(value)
+
+
+# computes the layout of the given value packed at the given offset, without producing any data
+# The dry run is done using the given buffer, if any - which produces the packed data if it is a PackBuffer.
+# statistics are the same as for packValue.
+def computeLayout(value, offset=0, buffer=None, statistics=None):
+    layout = Layout(offset)
+    pool = StringPool()
+    if buffer is None:
+        buffer = DryRunBuffer(offset, recordPatches=False)
+    buffer.reserve(offset + value.getImmediateDataSize())
+    layout.add(value, offset)
+    stack = list(reversed(value.packInto(buffer, offset, offset)))
+    while len(stack) > 0:
+        item = stack.pop()
+        if len(item) == 2:  # all the referred data of the reference is packed
+            reference, start = item
+            layout.getEntry(reference).referredSize = buffer.end - start
+            continue
+        reference, offset, base = item
+        if reference.interned:
+            pool.add(reference, offset, base)
+            continue
+        start = buffer.end
+        target = reference.targetValue
+        targetOffset = reference.packOffsetInto(buffer, offset, base)
+        buffer.reserve(targetOffset + target.getImmediateDataSize())
+        layout.add(target, targetOffset)
+        stack.append((reference, start))
+        stack.extend(reversed(target.packInto(buffer, targetOffset, targetOffset)))
+    pool.pack(buffer, layout, statistics)
+    layout.end = buffer.end
+    return layout
+
+
+# packs the struct at the end of the buffer like packValue, and keeps the layout of the packed data in
+# struct.packedLayout, so that the data can be updated by repackInto. The layout records the changes made with
+# Struct.overwrite to the structs in it.
+def packValueTracked(buffer, struct, statistics=None):
+    offset = buffer.end
+    layout = computeLayout(struct, offset, buffer, statistics)
+    for entry in layout.entries.values():
+        if isinstance(entry.value, namedstruct.values.Struct):
+            entry.value.addTracker(layout)
+    struct.packedLayout = layout
+    return offset
+
+
+# updates the data (a bytearray) that the value was last packed to with trackChanges (as a top level value, at
+# offset 0) to reflect all the changes made with Struct.overwrite since, by only re-packing the overwritten members.
+# Overwritten references get their referred data re-packed in place, as long as it still has the same size.
+# Returns False if that is not possible (e.g. the size changed, the changes were not tracked, or values were modified
+# other than by Struct.overwrite), in which case the value has to be packed again.
+def repackInto(data, value):
+    layout = value.packedLayout
+    if layout is None or layout.getSize() > len(data) or layout.isModified():
+        return False
+    changes = {}  # (id(struct), member index) -> (struct, member index, value the member had when packed)
+    for struct, index, replaced in layout.changes:
+        changes.setdefault((id(struct), index), (struct, index, replaced))
+
+    buffer = PackBuffer(data, len(data))
+    targets = []  # (replaced reference, reference, layout of the new target)
+    for struct, index, replaced in changes.values():
+        memberValue, offset = struct.getImmediateValues(layout.getOffset(struct))[index]
+        if isLeafValue(memberValue) and isLeafValue(replaced):
+            memberValue.packInto(buffer, offset, offset)
+        elif (isinstance(memberValue, namedstruct.values.Reference)
+              and isinstance(replaced, namedstruct.values.Reference)
+              and not memberValue.interned and not replaced.interned):
+            if replaced.targetValue is None or memberValue.targetValue is None:
+                if replaced.targetValue is not memberValue.targetValue:
+                    return False
+                memberValue.packInto(buffer, offset, offset)
+                continue
+            targetLayout = computeLayout(memberValue.targetValue, layout.getOffset(replaced.targetValue))
+            if targetLayout.getSize() != layout.getSize(replaced.targetValue):
+                return False
+            targets.append((replaced, memberValue, targetLayout))
+        else:
+            return False
+
+    # overwritten members may lie within the old referred data of other overwritten references, so the
+    # referred data is packed last, from the innermost to the outermost. The entries of the replaced data get
+    # removed, so the replaced values can be released, and the structs of the new data start being tracked.
+    for replaced, reference, targetLayout in sorted(targets, key=lambda target: target[2].getSize()):
+        buffer.write(targetLayout.start, packValues([reference.targetValue])[0])
+        entry = layout.getEntry(replaced)
+        layout.remove(replaced)
+        layout.entries[id(reference)] = Layout.Entry(reference, entry.offset, entry.immediateSize)
+        layout.entries[id(reference)].referredSize = entry.referredSize
+        layout.entries.update(targetLayout.entries)
+        for targetEntry in targetLayout.entries.values():
+            if isinstance(targetEntry.value, namedstruct.values.Struct):
+                targetEntry.value.addTracker(layout)
+    layout.changes = []
+    return True
+
+
+# the automatic reference widths chosen for the tree of a top level struct, see resolveAutoWidths. They stay valid
+# until any of the mutable values in the tree gets modified. Like Memo, it doesn't refer to the top level struct,
+# so it doesn't keep it alive.
+class AutoWidths(object):
+    __slots__ = ("widths", "version", "values", "versions")
+
+    def __init__(self, widths, struct, values):
+        self.widths = widths  # key -> chosen width, for the keys of the automatic width values in the tree
+        self.version = struct.version
+        self.values = [value for value in values if value is not struct]  # the mutable values in the tree
+        self.versions = [value.version for value in self.values]
+
+    def isValid(self, struct):
+        return (struct.version == self.version
+                and all(value.version == version for value, version in zip(self.values, self.versions)))
+
+
+# top level struct -> AutoWidths chosen for its tree
+autoWidths = weakref.WeakKeyDictionary()
+
+
+# returns the references and reference arrays with automatic width in the tree of the value. Values that occur
+# several times in the tree are visited once.
+def getAutoWidthValues(value):
+    result = []
+    visited = set()
+    stack = [value]
+    while len(stack) > 0:
+        value = stack.pop()
+        if isLeafValue(value) or id(value) in visited:
+            continue
+        visited.add(id(value))
+        if getattr(value, "autoWidthKey", None) is not None:
+            result.append(value)
+        if isinstance(value, namedstruct.values.Reference) and value.targetValue is not None:
+            stack.append(value.targetValue)
+        stack.extend(v for v, _ in value.getImmediateValues(0))
+    return result
+
+
+# chooses the reference bit widths of the references and reference arrays with automatic width in the trees of
+# the given structs (a struct or a list of them, see values.Struct.addAutoRef). Values with the same key (i.e. the
+# same member of all the structs with the same name) share their width, across all the given trees, so a header
+# generated for them declares the widths used by all of them. Starting with the narrowest width, the widths of all
+# values whose byte offsets don't fit get widened, until all fit - which may take a few iterations, as widening moves
+# the data after the widened values. The widths are kept until a tree gets modified.
+# Raises an exception if the widths chosen for several trees together differ from the still valid widths chosen for
+# one of them before (i.e. when it was packed on its own), as its packed data would not match a header generated for
+# all of them.
+def resolveAutoWidths(structs):
+    if len(namedstruct.values.autoWidthValues) == 0:
+        return
+    if isinstance(structs, namedstruct.values.Value):
+        structs = [structs]
+    structs = [struct for struct in structs if isinstance(struct, namedstruct.values.Struct)]
+    previous = [autoWidths.get(struct) for struct in structs]
+    previous = [(struct, state) for struct, state in zip(structs, previous)
+                if state is not None and state.isValid(struct)]
+    if len(previous) == len(structs):
+        widths = {}
+        if all(widths.setdefault(key, width) == width for _, state in previous for key, width in state.widths.items()):
+            return
+
+    groups = collections.OrderedDict()  # key -> auto width values in the trees
+    keys = []  # the keys of the auto width values, for every tree
+    for struct in structs:
+        keys.append(collections.OrderedDict())
+        for autoValue in getAutoWidthValues(struct):
+            groups.setdefault(autoValue.autoWidthKey, []).append(autoValue)
+            keys[-1][autoValue.autoWidthKey] = True
+    if len(groups) == 0:
+        return
+    widths = dict((key, 8) for key in groups)
+    layouts = []
+    while True:
+        owners = collections.OrderedDict()
+        for key, autoValues in groups.items():
+            for autoValue in autoValues:
+                if autoValue.type.referenceBitWidth != widths[key]:
+                    autoValue.setReferenceBitWidth(widths[key])
+                    if autoValue.autoWidthOwner is not None:
+                        owners[id(autoValue.autoWidthOwner)] = autoValue.autoWidthOwner
+        for owner in owners.values():
+            owner.relayout()
+
+        widened = collections.OrderedDict()
+        layouts = []
+        for struct in structs:
+            buffer = OverflowCheckingBuffer()
+            layout = computeLayout(struct, buffer=buffer)
+            layouts.append(layout)
+            for key, autoValues in groups.items():
+                if widths[key] == 32 or key in widened:
+                    continue
+                for autoValue in autoValues:
+                    references = autoValue.values if isinstance(autoValue, namedstruct.values.Array) else [autoValue]
+                    if any(reference in layout and layout.getOffset(reference) in buffer.overflows
+                           for reference in references):
+                        widened[key] = True
+                        break
+        if len(widened) == 0:
+            break
+        for key in widened:
+            widths[key] *= 2
+
+    for struct, state in previous:
+        for key, width in state.widths.items():
+            if widths.get(key, width) != width:
+                raise Exception("the automatic reference widths chosen for %s on its own differ from the ones needed "
+                                "together with the other values, so its packed data would not match - choose the "
+                                "widths for all the values together (e.g. with getHeaderTypes) before packing"
+                                % struct.getName())
+    for struct, structKeys, layout in zip(structs, keys, layouts):
+        values = [entry.value for entry in layout.entries.values() if isMutableValue(entry.value)]
+        autoWidths[struct] = AutoWidths(dict((key, widths[key]) for key in structKeys), struct, values)
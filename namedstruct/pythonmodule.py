@@ -0,0 +1,312 @@
+from __future__ import absolute_import
+import inspect
+import keyword
+
+import namedstruct.bithelper
+import namedstruct.n_types
+import namedstruct.reader
+import namedstruct.stringhelper
+
+
+# generating python modules
+# The generated module is the python equivalent of the c++ header: it has a class per struct, bit field, reference
+# array and bit field array type, whose properties read the members straight from the packed data, using
+# precompiled struct formats at fixed offsets. The module doesn't depend on namedstruct.
+# Example:
+#   module source = namedstruct.generatePythonModule(s)  # write it to myStruct.py
+#   import myStruct
+#   print(myStruct.MyStruct(data).bla)
+
+# the classes that the generated classes use to read primitives and simple arrays, see _getPrelude for the helpers
+_prelude = '''
+import struct as _struct
+
+
+# reads primitive values, via _read(data, offset) like the generated classes
+class _Primitive(_struct.Struct):
+    __slots__ = ()
+
+    def _read(self, data, offset):
+        return self.unpack_from(data, offset)[0]
+
+
+# reads simple arrays, with elements of the given width, read via elementReader._read
+class _ArrayType(object):
+    __slots__ = ("elementReader", "width", "fixedSize", "elementFormat")
+
+    def __init__(self, elementReader, width, fixedSize, elementFormat=None):
+        self.elementReader = elementReader
+        self.width = width
+        self.fixedSize = fixedSize
+        self.elementFormat = elementFormat  # the memoryview format of int elements
+
+    def _read(self, data, offset):
+        return _Array(self, data, offset)
+
+
+# a simple array. The length of variable size arrays is not stored, so like in c++ only fixed size arrays have a
+# length, and the indexes of variable size arrays are not checked.
+class _Array(object):
+    __slots__ = ("_type", "_data", "_offset")
+
+    def __init__(self, arrayType, data, offset):
+        self._type = arrayType
+        self._data = data
+        self._offset = offset
+
+    def __len__(self):
+        if self._type.fixedSize is None:
+            raise TypeError("the length of variable size arrays is not stored")
+        return self._type.fixedSize
+
+    def __getitem__(self, index):
+        if self._type.fixedSize is not None:
+            index = range(self._type.fixedSize)[index]
+        offset = self._offset + index * self._type.width
+        return self._type.elementReader._read(self._data, offset)
+
+    # returns a memoryview of the first numElements int elements (all elements of fixed size arrays)
+    def getElements(self, numElements=None):
+        numElements = len(self) if numElements is None else numElements
+        data = memoryview(self._data).cast("B")[self._offset:self._offset + numElements * self._type.width]
+        return data.cast(self._type.elementFormat)
+
+    # returns the chars up to the terminating null char (or the end of a fixed size array)
+    def getBytes(self):
+        data = memoryview(self._data).cast("B")
+        end = len(data) if self._type.fixedSize is None else self._offset + self._type.fixedSize
+        return _readBytes(data, self._offset, end)
+
+    def getString(self):
+        return self.getBytes().decode("utf-8")
+'''
+
+_indent = namedstruct.stringhelper.indent
+
+# the names used by the generated classes themselves, members with these names get a trailing underscore
+_structNames = frozenset(["_data", "_offset", "_read"])
+_bitFieldNames = frozenset(["bits", "_read"])
+
+
+# returns the prelude, followed by the helpers that are shared with the reader, so they're only written once
+def _getPrelude():
+    helpers = [inspect.getsource(namedstruct.reader._readBytes), inspect.getsource(namedstruct.reader._readBits),
+               inspect.getsource(namedstruct.bithelper.zigZagDecode).replace("def zigZagDecode(", "def _zigZagDecode(")]
+    return _prelude + "".join("\n\n" + helper for helper in helpers)
+
+
+# returns the source of a python module with classes to read the data of the given types (see getAllTypes)
+def getModuleSource(allTypes):
+    lines = ["# Code generated by namedstruct.py", _getPrelude()]
+    primitives = set()
+    arrays = []  # the simple array types, their readers are created after all the classes
+    classes = []
+    for t in allTypes.values():
+        if isinstance(t, namedstruct.n_types.StructType):
+            classes.append(_getStructClass(t, primitives, arrays))
+        elif isinstance(t, namedstruct.n_types.BitFieldType):
+            classes.append(_getBitFieldClass(t, primitives))
+        elif isinstance(t, namedstruct.n_types.ReferenceArrayType):
+            classes.append(_getReferenceArrayClass(t, primitives, arrays))
+        elif isinstance(t, namedstruct.n_types.BitFieldArrayType):
+            classes.append(_getBitFieldArrayClass(t, primitives))
+        elif isinstance(t, namedstruct.n_types.EnumType):
+            classes.append(_getEnumClass(t))
+    readers = []
+    emitted = set()
+    for arrayType in arrays:  # may grow while the readers are created, arrays can contain arrays
+        _addArrayReader(arrayType, readers, emitted, primitives, arrays)
+    lines.extend("%s = _Primitive(%r)" % (_getPrimitiveName(p), "<" + p.getFormatChar())
+                 for p in sorted(primitives, key=_getPrimitiveName))
+    lines.extend("\n\n" + c for c in classes)
+    if len(readers) > 0:
+        lines.append("\n\n# simple array readers")
+        lines.extend(readers)
+    return "\n".join(lines) + "\n"
+
+
+# adds the reader of the given simple array type to readers, after the reader of its element type, if it is an array
+def _addArrayReader(arrayType, readers, emitted, primitives, arrays):
+    if arrayType in emitted:
+        return
+    emitted.add(arrayType)
+    elementType = arrayType.getElementType()
+    if isinstance(elementType, namedstruct.n_types.SimpleArrayType):
+        _addArrayReader(elementType, readers, emitted, primitives, arrays)
+    elementFormat = repr(elementType.getFormatChar()) if type(elementType) is namedstruct.n_types.IntType else "None"
+    readers.append("%s = _ArrayType(%s, %d, %s, %s)" % (
+        _getArrayReaderName(arrayType, arrays), _getReader(elementType, primitives, arrays), elementType.getWidth(),
+        arrayType.fixedSize, elementFormat))
+
+
+def _getPrimitiveName(primitiveType):
+    return "_" + primitiveType.getName()
+
+
+def _getArrayReaderName(arrayType, arrays):
+    if arrayType not in arrays:
+        arrays.append(arrayType)
+    return "_array%d" % arrays.index(arrayType)
+
+
+def _getClassName(t):
+    return t.getUniqueName() if isinstance(t, namedstruct.n_types.EnumType) else t.getName()
+
+
+# member names that are python keywords, or one of the given names used by the class itself, get a trailing underscore
+def _getPropertyName(name, reservedNames=()):
+    return name + "_" if keyword.iskeyword(name) or name in reservedNames else name
+
+
+# returns the expression of the object that reads values of the given type via _read(data, offset)
+def _getReader(t, primitives, arrays):
+    if isinstance(t, namedstruct.n_types.EnumType):
+        t = t.getEnumType()
+    if isinstance(t, namedstruct.n_types.PrimitiveType):
+        primitives.add(t)
+        return _getPrimitiveName(t)
+    if isinstance(t, namedstruct.n_types.SimpleArrayType):
+        return _getArrayReaderName(t, arrays)
+    if isinstance(t, (namedstruct.n_types.StructType, namedstruct.n_types.BitFieldType,
+                      namedstruct.n_types.ReferenceArrayType, namedstruct.n_types.BitFieldArrayType)):
+        return _getClassName(t)
+    raise Exception("cannot read values of type %s in python" % repr(t))
+
+
+# returns the expression that reads the value of the given type at the given offset of the data
+def _getReadExpression(t, offsetExpression, primitives, arrays):
+    if isinstance(t, namedstruct.n_types.EnumType):
+        t = t.getEnumType()
+    if isinstance(t, namedstruct.n_types.PrimitiveType):
+        primitives.add(t)
+        return "%s.unpack_from(self._data, %s)[0]" % (_getPrimitiveName(t), offsetExpression)
+    if isinstance(t, (namedstruct.n_types.StructType, namedstruct.n_types.ReferenceArrayType,
+                      namedstruct.n_types.BitFieldArrayType)):
+        return "%s(self._data, %s)" % (_getClassName(t), offsetExpression)
+    return "%s._read(self._data, %s)" % (_getReader(t, primitives, arrays), offsetExpression)
+
+
+def _getOffsetExpression(offset):
+    return "self._offset + %d" % offset if offset != 0 else "self._offset"
+
+
+# the constructor of classes that read from data at an offset
+def _getViewMethods(name):
+    return ['''class {name}(object):
+    __slots__ = ("_data", "_offset")
+
+    def __init__(self, data, offset=0):
+        self._data = data
+        self._offset = offset
+
+    @classmethod
+    def _read(cls, data, offset):
+        return cls(data, offset)'''.format(name=name)]
+
+
+def _getStructClass(structType, primitives, arrays):
+    result = _getViewMethods(structType.getName())
+    for name, offset, memberType in zip(structType.names, structType.offsets, structType.types):
+        if isinstance(memberType, namedstruct.n_types.PaddingType):
+            continue
+        result.append("\n%s@property\n%sdef %s(self):" % (_indent, _indent, _getPropertyName(name, _structNames)))
+        offsetExpression = _getOffsetExpression(offset)
+        if isinstance(memberType, namedstruct.n_types.ReferenceType):
+            # references are relative to the struct, like in the c++ accessors
+            primitives.add(memberType.referenceType)
+            result.append("%sbyteOffset = %s.unpack_from(self._data, %s)[0]"
+                          % (_indent * 2, _getPrimitiveName(memberType.referenceType), offsetExpression))
+            targetExpression = ("None" if memberType.targetType is None
+                                or isinstance(memberType.targetType, namedstruct.n_types.NullType)
+                                else _getReadExpression(memberType.targetType, "self._offset + byteOffset",
+                                                        primitives, arrays))
+            result.append("%sreturn None if byteOffset == 0 else %s" % (_indent * 2, targetExpression))
+        else:
+            result.append("%sreturn %s" % (_indent * 2,
+                                           _getReadExpression(memberType, offsetExpression, primitives, arrays)))
+    return "\n".join(result)
+
+
+def _getReferenceArrayClass(arrayType, primitives, arrays):
+    referenceType = arrayType.getElementType()
+    primitives.add(referenceType.referenceType)
+    targetType = referenceType.targetType
+    targetExpression = ("None" if isinstance(targetType, namedstruct.n_types.NullType)
+                        else _getReadExpression(targetType, "self._offset + byteOffset", primitives, arrays))
+    result = _getViewMethods(arrayType.getName())
+    if arrayType.fixedSize is not None:
+        result.append("\n%sdef __len__(self):\n%sreturn %d" % (_indent, _indent * 2, arrayType.fixedSize))
+    result.append("""
+    # returns the element at the given index, elements are relative to the array, like in the c++ accessors
+    def __getitem__(self, index):""")
+    if arrayType.fixedSize is not None:
+        result.append("%sindex = range(%d)[index]" % (_indent * 2, arrayType.fixedSize))
+    result.append("""        byteOffset = {reference}.unpack_from(self._data, self._offset + {width} * index)[0]
+        return None if byteOffset == 0 else {target}""".format(
+        reference=_getPrimitiveName(referenceType.referenceType), width=referenceType.getWidth(),
+        target=targetExpression))
+    return "\n".join(result)
+
+
+def _getBitFieldArrayClass(arrayType, primitives):
+    primitives.add(namedstruct.n_types.UINT16)
+    result = _getViewMethods(arrayType.getName())
+    result.append('''
+    # returns the number of fields stored in the data, which may differ from the number of defined fields
+    def getNumFields(self):
+        return (_uint16_t.unpack_from(self._data, self._offset + 2)[0] >> 4) - 2
+
+    # returns the number of bits used by the field with the given field index
+    def getNumBitsByFieldIndex(self, fieldIndex):
+        offsets = _uint16_t.unpack_from(self._data, self._offset + 2 + 2 * fieldIndex)[0]
+        return _uint16_t.unpack_from(self._data, self._offset + 4 + 2 * fieldIndex)[0] - offsets
+
+    # returns the value of the field with the given field index at the given element index
+    def getByFieldIndex(self, fieldIndex, index):
+        entryBits = _uint16_t.unpack_from(self._data, self._offset)[0]
+        bitOffset = _uint16_t.unpack_from(self._data, self._offset + 2 + 2 * fieldIndex)[0]
+        return _readBits(self._data, self._offset, bitOffset + index * entryBits,
+                         self.getNumBitsByFieldIndex(fieldIndex))''')
+    for i, field in enumerate(arrayType.getFields()):
+        result.append('''
+    def has{Field}(self):
+        return self.getNumFields() > {i}
+
+    def get{Field}NumBits(self):
+        return self.getNumBitsByFieldIndex({i})
+
+    def get{Field}(self, index):
+        return self.getByFieldIndex({i}, index)'''.format(i=i, Field=namedstruct.stringhelper.capitalizeFirst(field)))
+    return "\n".join(result)
+
+
+def _getBitFieldClass(bitFieldType, primitives):
+    primitives.add(bitFieldType.dataType)
+    result = ['''class {name}(object):
+    __slots__ = ("bits",)
+
+    def __init__(self, bits):
+        self.bits = bits
+
+    @classmethod
+    def _read(cls, data, offset):
+        return cls({dataType}.unpack_from(data, offset)[0])'''.format(
+        name=bitFieldType.getName(), dataType=_getPrimitiveName(bitFieldType.dataType))]
+    shift = 0
+    for field in bitFieldType.fieldArray:
+        value = "(self.bits >> %d) & 0x%x" % (shift, (1 << field.bitWidth) - 1)
+        zigZag = (field.type == 'i') if field.type in {'i', 'u'} else field.type.hasNegativeValues()
+        result.append("\n%s@property\n%sdef %s(self):\n%sreturn %s"
+                      % (_indent, _indent, _getPropertyName(field.name, _bitFieldNames), _indent * 2,
+                         "_zigZagDecode(%s)" % value if zigZag else value))
+        shift += field.bitWidth
+    return "\n".join(result)
+
+
+def _getEnumClass(enumType):
+    result = ["class %s(object):" % _getClassName(enumType)]
+    for name, value in enumType.mapping.items():
+        result.append("%s%s = %r" % (_indent, _getPropertyName(name), value.getPythonValue()))
+    if len(enumType.mapping) == 0:
+        result.append(_indent + "pass")
+    return "\n".join(result)
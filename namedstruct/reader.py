@@ -0,0 +1,339 @@
+from __future__ import absolute_import
+import pickle
+import struct
+
+import namedstruct.bithelper
+import namedstruct.n_types
+
+
+# reading packed data
+# The views in this module read packed data in place, from any buffer (bytes, bytearray, memoryview, mmap), given
+# the types that were used to pack it, e.g. the types collected by namedstruct.getAllTypes, or a schema that was
+# serialized with dumpSchema. Nothing is read or copied when a view is created, only when a member or element
+# is accessed. References are resolved the same way the generated c++ accessors resolve them: the byte offset is
+# relative to the start of the struct (or reference array) that stores it, and a byte offset of 0 is null.
+# Example:
+#   with open("data.bin", "rb") as f:
+#       data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+#   root = namedstruct.reader.read(data, namedstruct.reader.loadSchema(schemaData)["MyStruct"])
+#   print(root.bla, root.greet.getString())
+# With numpy, arrays of structs can be read as structured numpy arrays, see getDtype and ArrayView.getRecords:
+#   trips = root.trips.getRecords(numTrips)  # no copy, trips["id"] is a column
+
+
+# returns a view of the value of the given type, packed at the given byte offset of the data
+def read(data, valueType, offset=0):
+    memory = memoryview(data)
+    if memory.format != "B":
+        memory = memory.cast("B")
+    return getView(valueType, memory, offset)
+
+
+# returns the serialized types of the header of the given structs/bitfield values/enum types, which can be stored
+# next to the packed data, and read back with loadSchema. The schema is pickled, so only load trusted schemas.
+def dumpSchema(valuesOrEnumTypes):
+    return pickle.dumps(namedstruct.getHeaderTypes(valuesOrEnumTypes))
+
+
+# returns the ordered dict of unique name -> type of a schema serialized by dumpSchema
+def loadSchema(data):
+    return pickle.loads(data)
+
+
+# returns the view of a value of the given type that is stored at the given offset. Primitive values and enums
+# are read right away, structs and arrays return views.
+def getView(valueType, memory, offset):
+    if isinstance(valueType, namedstruct.n_types.StructType):
+        return StructView(valueType, memory, offset)
+    if isinstance(valueType, namedstruct.n_types.ReferenceArrayType):
+        return ReferenceArrayView(valueType, memory, offset)
+    if isinstance(valueType, namedstruct.n_types.SimpleArrayType):
+        return ArrayView(valueType, memory, offset)
+    if isinstance(valueType, namedstruct.n_types.BitFieldArrayType):
+        return BitFieldArrayView(valueType, memory, offset)
+    return _readImmediate(valueType, memory, offset, offset)
+
+
+# reads the immediate value of the given type at the given offset, references are relative to base
+def _readImmediate(valueType, memory, offset, base):
+    if isinstance(valueType, namedstruct.n_types.ReferenceType):
+        byteOffset = struct.unpack_from("<" + valueType.referenceType.getFormatChar(), memory, offset)[0]
+        if byteOffset == 0 or valueType.targetType is None:
+            return None
+        return getView(valueType.targetType, memory, base + byteOffset)
+    if isinstance(valueType, namedstruct.n_types.PrimitiveType):  # ints and chars
+        return struct.unpack_from("<" + valueType.getFormatChar(), memory, offset)[0]
+    if isinstance(valueType, namedstruct.n_types.EnumType):
+        return _getEnumValue(valueType, _readImmediate(valueType.getEnumType(), memory, offset, base))
+    if isinstance(valueType, namedstruct.n_types.BitFieldType):
+        return BitFieldView(valueType, _readImmediate(valueType.dataType, memory, offset, base))
+    if isinstance(valueType, namedstruct.n_types.PaddingType):
+        return bytes(memory[offset:offset + valueType.numBytes])
+    if isinstance(valueType, (namedstruct.n_types.StructType, namedstruct.n_types.ArrayType,
+                              namedstruct.n_types.BitFieldArrayType)):
+        return getView(valueType, memory, offset)  # immediate structs, fixed size arrays and bit field arrays
+    raise Exception("cannot read values of type " + repr(valueType))
+
+
+# returns the description of the numpy structured dtype of the given finalized struct type, i.e. the dict of names,
+# formats, offsets and itemsize that numpy.dtype accepts, without requiring numpy. Padding bytes are void members,
+# references are their byte offsets, enums and bit fields are their underlying ints, immediate structs are nested.
+def getDtypeDescription(structType):
+    if structType.isMutable():
+        raise Exception("cannot get the dtype of struct type %s - it's not finalized" % structType.name)
+    return {"names": list(structType.names),
+            "formats": [_getDtypeFormat(memberType) for _, memberType in zip(structType.names, structType.types)],
+            "offsets": list(structType.offsets),
+            "itemsize": structType.getWidth()}
+
+
+# returns the numpy structured dtype of the given finalized struct type, see getDtypeDescription
+def getDtype(structType):
+    return _importNumpy().dtype(getDtypeDescription(structType))
+
+
+# returns the numpy dtype format of values of the given immediate type
+def _getDtypeFormat(valueType):
+    if isinstance(valueType, namedstruct.n_types.EnumType):
+        valueType = valueType.getEnumType()
+    elif isinstance(valueType, namedstruct.n_types.BitFieldType):
+        valueType = valueType.dataType
+    elif isinstance(valueType, namedstruct.n_types.ReferenceType):
+        valueType = valueType.referenceType
+    if isinstance(valueType, namedstruct.n_types.CharType):
+        return "S1"
+    if isinstance(valueType, namedstruct.n_types.IntType):
+        return "<%s%d" % ("u" if valueType.unsigned else "i", valueType.getWidth())
+    if isinstance(valueType, namedstruct.n_types.PaddingType):
+        return "V%d" % valueType.numBytes
+    if isinstance(valueType, namedstruct.n_types.StructType):
+        return getDtypeDescription(valueType)
+    if isinstance(valueType, namedstruct.n_types.ArrayType) and valueType.fixedSize is not None:
+        if isinstance(valueType.getElementType(), namedstruct.n_types.CharType):
+            return "S%d" % valueType.fixedSize  # fixed size strings
+        return _getDtypeFormat(valueType.getElementType()), (valueType.fixedSize,)
+    raise Exception("values of type %s have no numpy dtype" % valueType.getUniqueName())
+
+
+def _importNumpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("numpy is required for numpy dtypes and arrays, install it with pip install numpy")
+    return numpy
+
+
+# returns the enum value of the enum type with the given python value, or the python value itself if it's unknown
+def _getEnumValue(enumType, pythonValue):
+    for name, value in enumType.mapping.items():
+        if value.getPythonValue() == pythonValue:
+            return enumType.values[name]
+    return pythonValue
+
+
+# the helpers below are also copied into the modules generated by pythonmodule, so they may only use builtins
+
+# returns the bytes from the given offset up to the first null char (or the end offset) of a memoryview of bytes.
+# Copies chunks until the null char, rather than the rest of the buffer.
+def _readBytes(memory, offset, end):
+    chunks = []
+    position = offset
+    while position < end:
+        chunk = memory[position:min(position + 256, end)].tobytes()
+        terminal = chunk.find(b"\0")
+        if terminal >= 0:
+            chunks.append(chunk[:terminal])
+            break
+        chunks.append(chunk)
+        position += len(chunk)
+    return b"".join(chunks)
+
+
+# returns numBits bits at the given bit offset from the given byte offset
+def _readBits(data, offset, bitOffset, numBits):
+    start = offset + bitOffset // 8
+    bits = int.from_bytes(bytes(data[start:start + (bitOffset % 8 + numBits + 7) // 8]), "little")
+    return (bits >> (bitOffset % 8)) & ((1 << numBits) - 1)
+
+
+# a view of a packed struct, whose members are accessed as attributes (or via _get). The attributes of the view
+# itself start with an underscore, so they don't hide members with the same names.
+class StructView(object):
+    __slots__ = ("_type", "_memory", "_offset")
+
+    def __init__(self, structType, memory, offset):
+        self._type = structType
+        self._memory = memory
+        self._offset = offset
+
+    def __repr__(self):
+        return "<StructView:%s at %d>" % (self._type.name, self._offset)
+
+    def __getattr__(self, name):
+        try:
+            return self._get(name)
+        except KeyError:
+            raise AttributeError("struct %s has no member %s" % (self._type.name, name))
+
+    def __dir__(self):
+        return list(self._type.names)
+
+    # returns the value of the member with the given name, references are followed
+    def _get(self, name):
+        index = self._type.members[name]
+        return _readImmediate(self._type.types[index], self._memory, self._offset + self._type.offsets[index],
+                              self._offset)
+
+    # returns the member values as a dict, excluding padding bytes
+    def _toDict(self):
+        return dict((name, self._get(name))
+                    for i, name in enumerate(self._type.names) if not self._type.isPaddingMember(i))
+
+
+# a view of a packed simple array. The packed data doesn't store the length of variable size arrays, so like in
+# c++, only fixed size arrays have a length, and indexes are not checked otherwise.
+class ArrayView(object):
+    __slots__ = ("type", "memory", "offset")
+
+    def __init__(self, arrayType, memory, offset):
+        self.type = arrayType
+        self.memory = memory
+        self.offset = offset
+
+    def __repr__(self):
+        return "<ArrayView:%s at %d>" % (self.type.getUniqueName(), self.offset)
+
+    def __len__(self):
+        if self.type.fixedSize is None:
+            raise Exception("the length of the variable size array %s is not stored" % self.type.getUniqueName())
+        return self.type.fixedSize
+
+    def __getitem__(self, index):
+        if self.type.fixedSize is not None:
+            index = range(self.type.fixedSize)[index]
+        elif index < 0:
+            raise IndexError("negative index into variable size array")
+        elementType = self.type.getElementType()
+        elementOffset = self.offset + index * elementType.getWidth()
+        return _readImmediate(elementType, self.memory, elementOffset, elementOffset)
+
+    # returns a memoryview of the first numElements int elements, without copying them. By default returns all
+    # elements of a fixed size array.
+    def getElements(self, numElements=None):
+        elementType = self.type.getElementType()
+        if type(elementType) is not namedstruct.n_types.IntType:
+            raise Exception("can only get the elements of int arrays, not " + self.type.getUniqueName())
+        numElements = len(self) if numElements is None else numElements
+        data = self.memory[self.offset:self.offset + numElements * elementType.getWidth()]
+        formatChar = elementType.getFormatChar()
+        return data.cast(formatChar) if struct.calcsize(formatChar) == elementType.getWidth() else data
+
+    # returns the first numElements elements (all elements of a fixed size array) as a numpy array that shares the
+    # memory of the data, e.g. the records of an array of structs with the struct's dtype (see getDtype).
+    def getRecords(self, numElements=None):
+        numpy = _importNumpy()
+        numElements = len(self) if numElements is None else numElements
+        return numpy.frombuffer(self.memory, numpy.dtype(_getDtypeFormat(self.type.getElementType())), numElements,
+                                self.offset)
+
+    # returns the bytes of a char array up to the terminating null char (or the end of a fixed size array)
+    def getBytes(self):
+        end = len(self.memory) if self.type.fixedSize is None else self.offset + self.type.fixedSize
+        return _readBytes(self.memory, self.offset, end)
+
+    # returns the string of a char array, see getBytes
+    def getString(self):
+        return self.getBytes().decode("utf-8")
+
+
+# a view of a packed reference array, whose elements are resolved relative to the start of the array
+class ReferenceArrayView(object):
+    __slots__ = ("type", "memory", "offset")
+
+    def __init__(self, arrayType, memory, offset):
+        self.type = arrayType
+        self.memory = memory
+        self.offset = offset
+
+    def __repr__(self):
+        return "<ReferenceArrayView:%s at %d>" % (self.type.getUniqueName(), self.offset)
+
+    def __len__(self):
+        if self.type.fixedSize is None:
+            raise Exception("the length of the variable size array %s is not stored" % self.type.getUniqueName())
+        return self.type.fixedSize
+
+    # returns the view of the element at the given index, or None for null elements
+    def __getitem__(self, index):
+        if self.type.fixedSize is not None:
+            index = range(self.type.fixedSize)[index]
+        elif index < 0:
+            raise IndexError("negative index into variable size array")
+        referenceType = self.type.getElementType()
+        return _readImmediate(referenceType, self.memory, self.offset + index * referenceType.getWidth(), self.offset)
+
+
+# a view of a packed bit field array, see values.BitFieldArray
+class BitFieldArrayView(object):
+    __slots__ = ("type", "memory", "offset")
+
+    def __init__(self, arrayType, memory, offset):
+        self.type = arrayType
+        self.memory = memory
+        self.offset = offset
+
+    def __repr__(self):
+        return "<BitFieldArrayView:%s at %d>" % (self.type.name, self.offset)
+
+    # returns the number of fields stored in the data, which may differ from the fields of the type
+    def getNumFields(self):
+        return (self._getHeader(1) >> 4) - 2
+
+    # returns the number of bits used by the field with the given name
+    def getNumBits(self, fieldName):
+        fieldIndex = self.type.getFields().index(fieldName)
+        return self._getHeader(fieldIndex + 2) - self._getHeader(fieldIndex + 1)
+
+    # returns the value of the field with the given name at the given index
+    def get(self, fieldName, index):
+        fieldIndex = self.type.getFields().index(fieldName)
+        if fieldIndex >= self.getNumFields():
+            raise Exception("field %s is not stored in the data" % fieldName)
+        fieldOffset = self._getHeader(fieldIndex + 1)
+        numBits = self._getHeader(fieldIndex + 2) - fieldOffset
+        return _readBits(self.memory, self.offset, fieldOffset + index * self._getHeader(0), numBits)
+
+    def _getHeader(self, index):
+        return struct.unpack_from("<H", self.memory, self.offset + 2 * index)[0]
+
+
+# a view of a bit field, whose fields are accessed as attributes (or via _get), see StructView
+class BitFieldView(object):
+    __slots__ = ("_type", "_bits")
+
+    def __init__(self, bitFieldType, bits):
+        self._type = bitFieldType
+        self._bits = bits
+
+    def __repr__(self):
+        return "<BitFieldView:%s %s>" % (self._type.name, hex(self._bits))
+
+    def __getattr__(self, name):
+        try:
+            return self._get(name)
+        except KeyError:
+            raise AttributeError("bit field %s has no field %s" % (self._type.name, name))
+
+    # returns the value of the field with the given name, unpacking signed fields and enums like values.BitField
+    def _get(self, name):
+        index = self._type.fields[name]
+        shift = sum(field.bitWidth for field in self._type.fieldArray[:index])
+        field = self._type.fieldArray[index]
+        value = (self._bits >> shift) & ((1 << field.bitWidth) - 1)
+        if field.type == 'u':
+            return value
+        if field.type == 'i':
+            return namedstruct.bithelper.zigZagDecode(value)
+        if field.type.hasNegativeValues():
+            value = namedstruct.bithelper.zigZagDecode(value)
+        return _getEnumValue(field.type, value)
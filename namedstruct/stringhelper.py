@@ -18,7 +18,7 @@ def stringToChars(string):
 
 
 def stringToCString(string):
-    return bytes(string, 'utf-8') + b'\0'
+    return (string if isinstance(string, bytes) else bytes(string, 'utf-8')) + b'\0'
 
 
 # ********** creating types/headers *****************************************
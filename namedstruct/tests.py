@@ -3,14 +3,18 @@ from __future__ import absolute_import
 
 import unittest
 
+import concurrent.futures
+import gc
+import io
 import os
 
 import sys
+import weakref
 
 print(sys.path)
 
 from namedstruct.values import *
-from namedstruct import values, n_types, constants
+from namedstruct import values, n_types, constants, packing
 from namedstruct.namedstruct import pack
 
 TEST_CONSTANTS = {
@@ -28,7 +32,6 @@ class NamedstructTestCase(unittest.TestCase):
     def test_namedstruct(self):
         genDir = os.path.dirname(
             os.path.realpath(__file__)) + '/../localTestFiles/'
-        sys.setrecursionlimit(10000000)
 
         os.system("echo .")
         os.system("pwd")
@@ -46,6 +49,633 @@ class NamedstructTestCase(unittest.TestCase):
                 f.write(pack(struct))
 
 
+def makePackingTestStruct():
+    return (Struct("packingTestStruct")
+            .addInt8("x", 3)
+            .addString("name", "some name")
+            .add("child", Struct("packingTestChild").addInt32("y", -7).addString("z", "zzz"))
+            .addReferenceArray("strings", ["a", None, "bcd"], referenceBitWidth=16)
+            .add("bits", BitFieldArray("packingTestBits", "a", "b").add([1, 2]).add([300, 0])))
+
+
+class ValuesTestCase(unittest.TestCase):
+    def test_compact_values(self):
+        struct = Struct("compactTestStruct").addInt8("x", 1).addInt32("y", 2).add("s", "s")
+        for value in struct.values + [struct, Int(3), Char("c")]:
+            self.assertFalse(hasattr(value, "__dict__"))
+            self.assertFalse(hasattr(value.getType(), "__dict__"))
+        self.assertIs(struct.values[2].getType(), n_types.INT32)
+        self.assertIs(Int(5, True, 8).getType(), n_types.UINT8)
+        self.assertEqual(values.Value.__slots__, ("type",))  # the packing bookkeeping is only kept by containers
+        self.assertIsNotNone(values.ConstantStringArray.__doc__)
+
+    def test_string_bytes(self):
+        string = String(u"h\u00e9")
+        self.assertEqual(string.values, b"h\xc3\xa9\0")
+        self.assertEqual(string.getPythonValue(), u"h\u00e9")
+        self.assertEqual(String("abc", omitTerminal=True).pack()[0], b"abc")
+        self.assertEqual(String(b"ab", fixedSize=4).pack()[0], b"ab\0\0")
+        self.assertIs(String("x").getType(), String("yz").getType())
+
+    def test_blob_bytes(self):
+        import array
+        bits = [0, 1, 1, 0, 1, 0, 0, 0, 1, 1]
+        blob = Blob(bits)
+        self.assertEqual(blob.values, b"\x16\x03")
+        self.assertEqual(list(blob.getPythonValue()), bits)
+        self.assertEqual(Blob(array.array("B", bits)).values, b"\x16\x03")
+        data = bytes(bytearray([0x16, 3]))
+        self.assertIs(Blob(data).values, data)  # bytes are kept as they are
+        with self.assertRaises(Exception):
+            Blob([0, 2])
+
+    def test_padding(self):
+        struct = Struct("paddingTestStruct").addInt8("a", 1).addInt32("b", 2).addInt8("c", 3).finalize()
+        self.assertEqual(struct.getType().names, ["a", "paddingBytes0", "b", "c", "paddingBytes3"])
+        self.assertEqual([v.getImmediateDataSize() for v in struct.values], [1, 3, 4, 1, 3])
+        data = bytearray(b"\xff" * 12)
+        namedstruct.pack_into(data, struct, addPadding=False)
+        self.assertEqual(bytes(data), b"\x01\0\0\0\x02\0\0\0\x03\0\0\0")
+
+    def test_buffer_arrays(self):
+        import array
+        expected = pack(Struct("bufferTestStruct").addArray("a", [1, -2, 3]))
+        for values in [array.array("i", [1, -2, 3]), memoryview(array.array("i", [1, -2, 3]))]:
+            struct = Struct("bufferTestStruct").addBufferArray("a", values)
+            self.assertIsInstance(struct.values[0].targetValue.values, memoryview)
+            self.assertEqual(pack(struct), expected)
+            values[0] = 5  # mutable buffers get copied
+            self.assertEqual(pack(struct), expected)
+            self.assertEqual(pack(Struct("bufferTestStruct").addArray("a", values)),
+                             pack(Struct("bufferTestStruct").addArray("a", [5, -2, 3])))
+        self.assertIs(getArrayValue(b"ab").getType().getElementType(), n_types.INT32)  # arrays infer int32 elements
+        self.assertEqual(getArrayValue(b"ab").pack(), getArrayValue([97, 98]).pack())
+        struct = Struct("bufferTestStruct").addArray("a", array.array("h", [1, -2, 3]))
+        self.assertIsInstance(struct.values[0].targetValue.values, memoryview)  # no value per element
+        self.assertEqual(pack(struct), expected)
+        self.assertEqual(getArrayValue(array.array("b", [1, 2])).getLiteral(), "{1, 2}")
+        with self.assertRaises(Exception):
+            getArrayValue(array.array("Q", [2 ** 31]))
+        self.assertIs(getBufferArrayValue(b"ab").getType().getElementType(), n_types.UINT8)
+        self.assertEqual(getBufferArrayValue(b"ab", n_types.INT16).pack()[0], b"a\0b\0")
+        with self.assertRaises(Exception):
+            getBufferArrayValue([1, 2])
+        self.assertEqual(SimpleArray(n_types.INT16, array.array("q", [1, -2])).pack()[0], b"\x01\0\xfe\xff")
+        with self.assertRaises(Exception):
+            SimpleArray(n_types.UINT8, array.array("q", [1, 256]))
+
+    def test_pack_optimized(self):
+        struct = Struct("optimizedTestStruct").addInt8("a", 1).addInt32("b", 2).addInt8("c", 3).addInt64("d", 4)
+        statistics = {}
+        struct.addCompatibilityBoundary().addInt8("e", 5).addInt16("f", 6).packOptimized(statistics)
+        self.assertEqual(statistics["savedPaddingBytes"], 10)
+        self.assertEqual(struct.getType().names, ["d", "b", "a", "c", "e", "paddingBytes0", "f"])
+        expected = (Struct("optimizedTestStruct").addInt64("d", 4).addInt32("b", 2).addInt8("a", 1).addInt8("c", 3)
+                    .addInt8("e", 5).addInt16("f", 6))
+        self.assertEqual(pack(struct), pack(expected))
+        with self.assertRaises(Exception):  # would reorder the type without the values
+            struct.getType().packOptimized()
+        self.assertEqual(n_types.StructType("optimizedTestType").int8("a").int32("b").packOptimized(), 3)
+
+
+class PackIntoTestCase(unittest.TestCase):
+    def test_pack_into_bytearray(self):
+        data = bytearray(b"header")
+        size = namedstruct.pack_into(data, makePackingTestStruct(), offset=len(data))
+        self.assertEqual(bytes(data), b"header" + pack(makePackingTestStruct()))
+        self.assertEqual(size, len(data) - len(b"header"))
+        data = bytearray(b"head")
+        namedstruct.pack_into(data, makePackingTestStruct(), offset=6)
+        self.assertEqual(bytes(data), b"head\0\0" + pack(makePackingTestStruct()))
+
+    def test_pack_into_memoryview(self):
+        expected = pack(makePackingTestStruct())
+        data = bytearray(b"\xff" * (len(expected) + 2))
+        namedstruct.pack_into(memoryview(data), makePackingTestStruct(), offset=1)
+        self.assertEqual(bytes(data), b"\xff" + expected + b"\xff")
+        with self.assertRaises(Exception):
+            namedstruct.pack_into(memoryview(bytearray(4)), makePackingTestStruct())
+
+    def test_pack_members(self):
+        struct = makePackingTestStruct()
+        immediate, referred = struct.values[struct.getType().members["name"]].pack(20)
+        self.assertEqual(immediate, b"\x14\x00\x00\x00")
+        self.assertEqual(referred, b"some name\x00")
+
+    def test_pack_to(self):
+        class Pipe(object):  # a non-seekable file object
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(bytes(data))
+
+        struct = makePackingTestStruct().addReferenceArray("many", ["string %d" % i * 7 for i in range(2000)])
+        expected = pack(struct)
+        seekable = io.BytesIO(b"head")
+        seekable.seek(4)
+        self.assertEqual(namedstruct.pack_to(seekable, struct), len(expected))
+        self.assertEqual(seekable.getvalue(), b"head" + expected)
+        pipe = Pipe()
+        self.assertEqual(namedstruct.pack_to(pipe, struct, padExtra=False), len(pack(struct, padExtra=False)))
+        self.assertEqual(b"".join(pipe.chunks), pack(struct, padExtra=False))
+        self.assertGreater(len(pipe.chunks), 1)
+
+    def test_layout(self):
+        struct = makePackingTestStruct()
+        data = pack(struct, addPadding=False)
+        layout = namedstruct.layout(struct)
+        self.assertEqual(layout.getSize(), len(data))
+        self.assertEqual(layout.getSize(struct), len(data))
+        self.assertEqual(layout.getImmediateSize(struct), struct.getImmediateDataSize())
+        for name in ["name", "child", "strings"]:
+            reference = struct.values[struct.getType().members[name]]
+            offset = layout.getOffset(reference)
+            target = reference.targetValue
+            self.assertEqual(layout.getOffset(target), int.from_bytes(data[offset:offset + 4], "little"))
+            self.assertEqual(data[layout.getOffset(target):][:layout.getSize(target)], b"".join(target.pack()))
+        self.assertEqual(layout.getReferredSize(struct), len(data) - struct.getImmediateDataSize())
+
+    def test_deep_tree(self):
+        depth = 20 * sys.getrecursionlimit()
+        struct = None
+        for i in range(depth):
+            struct = Struct("deepTestStruct").addInt32("value", i).add("next", struct)
+        data = pack(struct)
+        self.assertEqual(len(data), depth * 8 + 4)
+        self.assertEqual(data[-20:], b"\x01\x00\x00\x00\x08\x00\x00\x00" + b"\x00" * 12)
+        self.assertEqual(list(namedstruct.getAllTypes([struct.getType()]).keys()),
+                         ["int32_t", "void", "ref32->void", "deepTestStruct", "ref32->deepTestStruct"])
+        self.assertEqual(struct.getType().dotGraph().count("\n"), 3 * depth + 1)
+
+
+class ParallelPackingTestCase(unittest.TestCase):
+    def test_pack_parallel(self):
+        import array
+        struct = makePackingTestStruct()
+        struct.addReferenceArray("many", [Struct("parallelTestStruct").addInt16("i", i).addString("s", "s" * (i % 13))
+                                          for i in range(500)])
+        struct.add("deep", Struct("parallelTestChild").addReferenceArray("more", ["x" * i for i in range(300)]))
+        struct.add("buffers", Struct("parallelTestBuffers").addBufferArray("b", array.array("h", range(100))))
+        tracked = Struct("parallelTestTracked").addInt32("t", 1).addString("s", "tracked")
+        pack(tracked, trackChanges=True)
+        struct.add("tracked", tracked)
+        struct.add("records", Struct("parallelTestRecords").add(
+            "r", n_types.StructType("parallelTestRecord").int16("a").compile().getArrayValue([(1,), (2,)])))
+        self.assertEqual(pack(struct, workers=3), pack(struct))
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:  # an executor can be reused
+            self.assertEqual(pack(struct, workers=2, executor=executor), pack(struct))
+            self.assertEqual(pack(struct, executor=executor), pack(struct))
+
+
+class RepackTestCase(unittest.TestCase):
+    def test_repack(self):
+        struct = makePackingTestStruct()
+        child = struct.values[struct.getType().members["child"]].targetValue
+        other = Struct("repackTestOther").addInt8("x", 1).add("child", child)
+        data = pack(struct, trackChanges=True)
+        otherData = pack(other, trackChanges=True)
+        child.overwrite("y", Int(12))
+        struct.overwrite("name", Reference(getValue("other nam")))
+        data = namedstruct.repack(data, struct)
+        expected = makePackingTestStruct().overwrite("name", Reference(getValue("other nam")))
+        expected.overwrite("child", Reference(Struct("packingTestChild").addInt32("y", 12).addString("z", "zzz")))
+        self.assertEqual(data, pack(expected))
+        self.assertEqual(struct.packedLayout.changes, [])
+        # the changes are tracked per top level struct, so repacking one doesn't lose the changes of another
+        self.assertEqual(namedstruct.repack(otherData, other), pack(other))
+        oldChild = weakref.ref(child)
+        del child, other, otherData
+        struct.overwrite("child", Reference(Struct("packingTestChild").addInt32("y", 13).addString("z", "zzz")))
+        data = namedstruct.repack(data, struct)
+        self.assertEqual(data, pack(struct))
+        gc.collect()
+        self.assertIsNone(oldChild())  # the replaced values are released
+        child = struct.values[struct.getType().members["child"]].targetValue
+        child.overwrite("z", Reference(getValue("zz")))
+        struct.overwrite("x", Int(-1, bitWidth=8))
+        self.assertEqual(namedstruct.repack(data, struct), pack(struct))  # the size of z changed
+        self.assertEqual(namedstruct.repack(pack(struct), struct), pack(struct))
+        # changes other than overwrite are noticed as well, and the struct gets packed again
+        data = namedstruct.repack(data, struct)
+        child.addInt32("added", 5)
+        data = namedstruct.repack(data, struct)
+        self.assertEqual(data, pack(struct))
+        struct.values[struct.getType().members["bits"]].targetValue.add([3, 4])
+        self.assertEqual(namedstruct.repack(data, struct), pack(struct))
+        untracked = makePackingTestStruct()
+        pack(untracked)
+        untracked.overwrite("x", Int(-1, bitWidth=8))
+        self.assertIsNone(untracked.trackers)
+        with self.assertRaises(Exception):
+            pack(struct, trackChanges=True, dedupe=True)
+
+
+class DedupeTestCase(unittest.TestCase):
+    def test_pack_dedupe(self):
+        names = ["name %d" % (i % 3) for i in range(10)]
+        struct = Struct("dedupeTestStruct").addReferenceArray("names", names).addString("first", "name 0")
+        statistics = {}
+        data = pack(struct, dedupe=True, statistics=statistics)
+        self.assertEqual(statistics, {"dedupedReferences": 8, "dedupedBytes": 8 * 7})
+        self.assertLess(len(data), len(pack(struct)))
+        # the bytes saved are the actual difference in size, padding included
+        trips = Struct("dedupeTestTrips").addReferenceArray(
+            "trips", [Struct("dedupeTestTrip").addInt8("a", 1).addInt32("b", 2).addString("s", "s")
+                      for _ in range(50)])
+        for value in (struct, trips):
+            statistics = {}
+            deduped = pack(value, dedupe=True, statistics=statistics, addPadding=False)
+            self.assertEqual(statistics["dedupedBytes"], len(pack(value, addPadding=False)) - len(deduped))
+        arrayOffset = int.from_bytes(data[0:4], "little")
+        for i, name in enumerate(names + ["name 0"]):
+            slot, base = (arrayOffset + 4 * i, arrayOffset) if i < len(names) else (4, 0)
+            offset = base + int.from_bytes(data[slot:slot + 4], "little")
+            self.assertEqual(data[offset:offset + 7], name.encode() + b"\0")
+
+
+class InternedStringsTestCase(unittest.TestCase):
+    def test_interned_strings(self):
+        names = ["stop %d" % (i % 4) for i in range(50)]
+        struct = (Struct("internTestStruct").addInternedString("name", "stop 1")
+                  .addReferenceArray("stops", [Struct("internTestStop").addInt16("i", i).addInternedString("name", name)
+                                               for i, name in enumerate(names)]))
+        statistics = {}
+        data = pack(struct, statistics=statistics, addPadding=False)
+        self.assertEqual(statistics, {"internedReferences": 51, "internedHits": 47, "internedBytes": 47 * 7,
+                                      "internedHitRate": 47 / 51.0})
+        self.assertEqual(data[-28:], b"stop 1\0stop 0\0stop 2\0stop 3\0")
+        self.assertEqual(namedstruct.layout(struct).getSize(), len(data))
+        self.assertEqual(pack(struct, workers=2), pack(struct))
+        arrayOffset = int.from_bytes(data[4:8], "little")
+        for i, name in enumerate(names):
+            stopOffset = arrayOffset + int.from_bytes(data[arrayOffset + 4 * i:arrayOffset + 4 * i + 4], "little")
+            offset = stopOffset + int.from_bytes(data[stopOffset + 4:stopOffset + 8], "little")
+            self.assertEqual(data[offset:offset + 7], name.encode() + b"\0")
+
+
+class AutoReferencesTestCase(unittest.TestCase):
+    def test_auto_references(self):
+        struct = (Struct("autoTestStruct").addAutoRef("first", "x").addString("big", "z" * 300)
+                  .addAutoRef("far", "y").addReferenceArray("names", ["a", "b"], referenceBitWidth="auto"))
+        expected = (Struct("autoTestStruct").addRef8("first", "x").addString("big", "z" * 300)
+                    .addRef16("far", "y").addReferenceArray("names", ["a", "b"], referenceBitWidth=8))
+        self.assertEqual(pack(struct), pack(expected))
+        self.assertEqual([repr(t) for t in struct.getType().types], [repr(t) for t in expected.getType().types])
+        struct.overwrite("big", Reference(getValue("z" * 10)))
+        expected = (Struct("autoTestStruct").addRef8("first", "x").addString("big", "z" * 10)
+                    .addRef8("far", "y").addReferenceArray("names", ["a", "b"], referenceBitWidth=8))
+        self.assertEqual(pack(struct), pack(expected))  # all fit into 8 bits now
+        with self.assertRaises(Exception):
+            Struct("autoTestStruct").addAutoRef("first", "x").finalize()
+
+    def test_auto_references_shared(self):
+        def makeStruct(size):
+            return Struct("autoSharedTestStruct").addString("big", "z" * size).addAutoRef("far", "y")
+
+        small = makeStruct(10)
+        pack(small)
+        with self.assertRaises(Exception):  # the small struct was packed with 8 bit widths, the header needs 16
+            namedstruct.getHeaderTypes([makeStruct(300), small])
+        large, small = makeStruct(300), makeStruct(10)
+        headerTypes = namedstruct.getHeaderTypes([large, small])
+        structType = headerTypes["autoSharedTestStruct"]
+        self.assertEqual(structType.types[structType.members["far"]].referenceBitWidth, 16)
+        expected = Struct("autoSharedTestStruct").addString("big", "z" * 10).addRef16("far", "y")
+        self.assertEqual(pack(small), pack(expected))  # the widths are kept until the struct gets modified
+
+
+class BitFieldArrayTestCase(unittest.TestCase):
+    def test_bit_field_array_columns(self):
+        array = BitFieldArray("columnTestBits", "a", "b").add([5, 1]).add({"a": 2, "b": Blob([1, 0, 0, 1])})
+        self.assertEqual(array.getFieldLengths(), [3, 4])
+        self.assertEqual(array.get("a", -1), 2)
+        array.set("b", 1, 0)
+        array.set("a", 0, 1)
+        self.assertEqual(array.getFieldLengths(), [2, 1])
+        self.assertEqual(pack(array, addPadding=False),
+                         pack(BitFieldArray("columnTestBits", "a", "b").add([1, 1]).add([2, 0]), addPadding=False))
+        self.assertEqual(len(array), 2)
+        self.assertEqual(len(array.addColumns([[1, 2, 3], [4, 5, 6]])), 5)
+        self.assertEqual(len(BitFieldArray("columnTestBits", "a", "b")), 0)
+        with self.assertRaises(Exception):
+            BitFieldArray("noFieldsTestBits")
+
+    def test_bit_field_array_from_columns(self):
+        import array
+        expected = pack(BitFieldArray("bulkTestBits", "a", "b").add([1, 4]).add([2, 5]).add([3, 6]))
+        self.assertEqual(pack(BitFieldArray.fromColumns("bulkTestBits", [("a", [1, 2, 3]),
+                                                                         ("b", array.array("H", [4, 5, 6]))])),
+                         expected)
+        # any field name is possible, including "name"
+        self.assertEqual(BitFieldArray.fromColumns("nameTestBits", {"name": [1]}).type.getFields(), ("name",))
+        self.assertEqual(len(BitFieldArray("emptyTestBits", "a").addColumns([array.array("I")])), 0)
+        try:
+            import numpy
+            self.assertEqual(len(BitFieldArray("emptyTestBits", "a").addColumns([numpy.zeros(0, "uint32")])), 0)
+        except ImportError:
+            pass
+        rows = iter([(1, 4), (2, 5), (3, 6)])
+        self.assertEqual(pack(BitFieldArray.fromRows("bulkTestBits", ["a", "b"], rows, bufferSize=2)), expected)
+        withBlob = BitFieldArray.fromRows("bulkTestBits", ["a", "b"], [(1, 4), (2, Blob([1, 0, 1]))])
+        self.assertEqual(withBlob.getFieldLengths(), [2, 3])
+        with self.assertRaises(Exception):
+            BitFieldArray.fromColumns("bulkTestBits", [("a", [1, -2]), ("b", [1, 2])])
+        with self.assertRaises(Exception):
+            BitFieldArray.fromColumns("bulkTestBits", [("a", [1, 2 ** 31]), ("b", [1, 2])])
+        with self.assertRaises(Exception):
+            BitFieldArray.fromColumns("bulkTestBits", [("a", [1]), ("b", [1, 2])])
+        # errors of the bulk path are not hidden
+        with self.assertRaises(Exception):
+            BitFieldArray.fromRows("bulkTestBits", ["a", "b"], [(1, 2, 3), (4, 5, 6)])
+        with self.assertRaises(Exception):
+            BitFieldArray.fromRows("bulkTestBits", ["a", "b"], [(1, 2), (2 ** 31, 5)])
+
+
+class StructSchemaTestCase(unittest.TestCase):
+    def test_struct_schema(self):
+        schema = n_types.StructType("schemaTestRecord").int8("a").int32("b").char("c").uint16("d").compile()
+        self.assertEqual(schema.getWidth(), 12)
+
+        def makeRecord(a, b, c, d):
+            return Struct("schemaTestRecord").addInt8("a", a).addInt32("b", b).addChar("c", c).addUInt16("d", d)
+
+        record = schema.getValue({"a": 1, "b": -2, "c": b"x", "d": 3})
+        self.assertIs(record.getType(), schema.getType())
+        self.assertEqual(record.get("b"), -2)
+        self.assertEqual(pack(record, addPadding=False), pack(makeRecord(1, -2, "x", 3).finalize(), addPadding=False))
+        # records share their type, so only values of the same member type can be overwritten
+        other = schema.getValue((1, 2, b"x", 3))
+        self.assertEqual(record.overwrite("b", Int(7)).get("b"), 7)
+        with self.assertRaises(Exception):
+            record.overwrite("b", Int(7, unsigned=True))
+        self.assertEqual((record.get("b"), other.get("b")), (7, 2))
+        self.assertIs(other.getType().types[other.getType().members["b"]], n_types.INT32)
+
+        records = [(1, 2, b"x", 3), {"a": -4, "b": 5, "c": b"y", "d": 65535}]
+        array = schema.getArrayValue(records)
+        self.assertEqual(len(array), 2)
+        self.assertEqual(array.getPythonValue(), [(1, 2, b"x", 3), (-4, 5, b"y", 65535)])
+        expected = getArrayValue([makeRecord(1, 2, "x", 3).finalize(), makeRecord(-4, 5, "y", 65535).finalize()])
+        self.assertEqual(pack(array), pack(expected))
+        with self.assertRaises(Exception):
+            schema.pack([(1, 2, b"x", 65536)])
+        with self.assertRaises(Exception):
+            schema.getValue((1, 2))
+        with self.assertRaises(Exception):
+            n_types.StructType("schemaTestRecord").int8("a").int8("a")
+
+
+class MemoizeTestCase(unittest.TestCase):
+    def test_memoize(self):
+        def makeChild(y):
+            return Struct("memoTestChild").addInt32("y", y).addReferenceArray("s", ["str %d" % i for i in range(300)])
+
+        def getStrings(child):
+            return child.values[child.getType().members["s"]].targetValue
+
+        other = makeChild(1)
+        pack(other)
+        self.assertNotIn(getStrings(other), packing.memos)  # memoization is opt-in
+        child = makeChild(1)
+        data = pack(child, memoize=True)
+        memo = packing.memos[getStrings(child)]
+        self.assertIsInstance(memo.data, bytes)
+        self.assertIn(memo.data, data)
+        other.overwrite("y", Int(2))  # modifying another tree keeps the memo valid
+        self.assertTrue(memo.isValid(getStrings(child)))
+        parent = Struct("memoTestParent").addInt8("x", 1).add("child", child)
+        expected = pack(Struct("memoTestParent").addInt8("x", 1).add("child", makeChild(1)))
+        self.assertEqual(pack(parent, memoize=True), expected)
+        child.overwrite("y", Int(2))
+        self.assertIs(packing.memos[getStrings(child)], memo)
+        expected = pack(Struct("memoTestParent").addInt8("x", 1).add("child", makeChild(2)))
+        self.assertEqual(pack(parent, memoize=True), expected)
+        getStrings(child).setReferenceBitWidth(16)
+        self.assertFalse(memo.isValid(getStrings(child)))
+        expected = makeChild(2)
+        getStrings(expected).setReferenceBitWidth(16)
+        expected = pack(Struct("memoTestParent").addInt8("x", 1).add("child", expected))
+        self.assertEqual(pack(parent, memoize=True), expected)
+        with self.assertRaises(Exception):
+            pack(parent, memoize=True, dedupe=True)
+
+    def test_memoize_interned(self):
+        def makeParent(child):
+            return Struct("memoInternedParent").addInternedString("s", "hello" * 300).add("child", child)
+
+        def makeChild():
+            return Struct("memoInternedChild").addInternedString("s", "hello" * 300).addInt32("y", 1)
+
+        child = makeChild()
+        pack(child, memoize=True)  # the child and its pool must not be memoized
+        self.assertNotIn(child, packing.memos)
+        data = pack(makeParent(child), memoize=True)
+        self.assertEqual(data, pack(makeParent(makeChild())))
+        self.assertEqual(len(data), 1520)
+
+
+class HeaderTestCase(unittest.TestCase):
+    def test_write_header(self):
+        struct = makePackingTestStruct()
+        out = io.StringIO()
+        namedstruct.writeHeader(out, struct, namespace="writeTest", includeSetters=True)
+        chunks = []
+        namedstruct.writeHeader(chunks, struct, namespace="writeTest", includeSetters=True)
+        header = namedstruct.generateHeader(struct, namespace="writeTest", includeSetters=True)
+        self.assertEqual(out.getvalue(), header)
+        self.assertEqual("".join(chunks), header)
+
+    def test_shared_types(self):
+        # every level refers to the previous one 3 times, so the type tree has 3^40 paths
+        struct = Struct("sharedTestStruct0").addInt32("x", 1)
+        for i in range(1, 40):
+            struct = Struct("sharedTestStruct%d" % i).add("a", struct).add("b", struct).add("c", struct)
+        allTypes = namedstruct.getAllTypes([struct.getType()])
+        self.assertEqual(list(allTypes.keys())[:4],
+                         ["int32_t", "sharedTestStruct0", "ref32->sharedTestStruct0", "sharedTestStruct1"])
+        self.assertEqual(len(allTypes), 2 * 40)
+        self.assertIn("sharedTestStruct39", namedstruct.generateHeader(struct))
+
+    def test_schema_fingerprint(self):
+        import tempfile
+        fingerprint = namedstruct.getSchemaFingerprint(makePackingTestStruct())
+        self.assertEqual(namedstruct.getSchemaFingerprint(makePackingTestStruct()), fingerprint)
+        self.assertNotEqual(namedstruct.getSchemaFingerprint(makePackingTestStruct().addInt8("y", 1)), fingerprint)
+        self.assertNotEqual(namedstruct.getSchemaFingerprint(
+            Struct("packingTestStruct").addInt8("x", 3).addString("name", "n", referenceBitWidth=16)),
+            namedstruct.getSchemaFingerprint(Struct("packingTestStruct").addInt8("x", 3).addString("name", "n")))
+        self.assertIn("static constexpr uint64_t PACKINGTESTSTRUCT_SCHEMA_FINGERPRINT = 0x%016xULL;" % fingerprint,
+                      namedstruct.generateHeader(makePackingTestStruct(), fingerprint=True))
+
+        data = namedstruct.packWithFingerprint(makePackingTestStruct())
+        self.assertEqual(bytes(namedstruct.skipFingerprint(data, fingerprint)), pack(makePackingTestStruct()))
+        with self.assertRaises(Exception):
+            namedstruct.skipFingerprint(data, fingerprint + 1)
+        # the fingerprint of the header, generated for more than the packed struct
+        schema = [makePackingTestStruct(), Struct("fingerprintTestStruct").addInt8("x", 1)]
+        data = namedstruct.packWithFingerprint(makePackingTestStruct(), schema=schema)
+        self.assertEqual(bytes(namedstruct.skipFingerprint(data, namedstruct.getSchemaFingerprint(schema))),
+                         pack(makePackingTestStruct()))
+        self.assertEqual(namedstruct.packWithFingerprint(makePackingTestStruct(), schema=fingerprint),
+                         namedstruct.packWithFingerprint(makePackingTestStruct()))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "packingTest.h")
+            self.assertTrue(namedstruct.writeHeaderFile(path, makePackingTestStruct()))
+            with open(path) as f:
+                self.assertEqual(f.read().split("\n", 1)[1],
+                                 namedstruct.generateHeader(makePackingTestStruct(), fingerprint=True))
+            self.assertFalse(namedstruct.writeHeaderFile(path, makePackingTestStruct()))
+            self.assertTrue(namedstruct.writeHeaderFile(path, makePackingTestStruct(), namespace="other"))
+            self.assertTrue(namedstruct.writeHeaderFile(path, makePackingTestStruct().addInt8("y", 1),
+                                                        namespace="other"))
+
+
+class ReaderTestCase(unittest.TestCase):
+    def test_reader(self):
+        import mmap
+        import tempfile
+        from namedstruct import reader
+        gender = n_types.EnumType("readerTestGender", n_types.UINT8, {"MALE": 0, "FEMALE": 1})
+        party = n_types.IntEnumType("readerTestParty", {"A": -1, "B": -2})
+        schema = n_types.StructType("readerTestRecord").int16("a").uint8("b").compile()
+        struct = (makePackingTestStruct()
+                  .addInt64("big", -5).addChar("c", "q").add("gender", gender.FEMALE)
+                  .add("bitField", BitField("readerTestBits", 16).add("flag", 1).addSigned("delta", -3, 4)
+                       .addEnum("party", party.B))
+                  .addArray("numbers", [1, -2, 3]).addArray("fixed", [7, 8], 4)
+                  .addImmediate("immediate", Struct("readerTestImmediate").addInt16("y", 9).finalize())
+                  .addArray("elements", [Struct("readerTestElement").addInt8("i", i).addString("s", "e%d" % i)
+                                        .finalize() for i in range(3)])
+                  .add("records", schema.getArrayValue([(1, 2), (-3, 4)]))
+                  .add("none", None))
+        data = pack(struct)
+
+        view = reader.read(data, namedstruct.getHeaderTypes(struct)["packingTestStruct"])
+        self.assertEqual((view.x, view.name.getString(), view.child.y, view.child.z.getString()),
+                         (3, "some name", -7, "zzz"))
+        self.assertEqual((view.strings[0].getString(), view.strings[1], view.strings[2].getString()),
+                         ("a", None, "bcd"))
+        self.assertEqual([view.bits.get(field, i) for i in range(2) for field in "ab"], [1, 2, 300, 0])
+        self.assertEqual((view.big, view.c, view.gender), (-5, b"q", gender.FEMALE))
+        self.assertEqual((view.bitField.flag, view.bitField.delta, view.bitField.party), (1, -3, party.B))
+        self.assertEqual((view.numbers.getElements(3).tolist(), list(view.fixed), view.immediate.y),
+                         ([1, -2, 3], [7, 8, 0, 0], 9))
+        self.assertEqual([(view.elements[i].i, view.elements[i].s.getString()) for i in (0, 2)], [(0, "e0"), (2, "e2")])
+        self.assertEqual(view.records[1]._toDict(), {"a": -3, "b": 4})
+        self.assertIsNone(view.none)
+        with self.assertRaises(AttributeError):
+            view.missing
+
+        schemaData = reader.dumpSchema(struct)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = reader.read(mapped, reader.loadSchema(schemaData)["packingTestStruct"])
+            self.assertEqual((view.child.z.getString(), view.elements[1].s.getString()), ("zzz", "e1"))
+
+        # members named like the attributes of a view
+        named = (Struct("readerTestNamed").addInt8("type", 1).addInt8("memory", 2).addInt8("offset", 3)
+                 .addInt8("get", 4).addInt8("toDict", 5)
+                 .add("bitField", BitField("readerTestNamedBits", 8).add("type", 1).add("bits", 1).add("get", 1)))
+        view = reader.read(pack(named), namedstruct.getHeaderTypes(named)["readerTestNamed"])
+        self.assertEqual((view.type, view.memory, view.offset, view.get, view.toDict), (1, 2, 3, 4, 5))
+        self.assertEqual((view.bitField.type, view.bitField.bits, view.bitField.get), (1, 1, 1))
+
+    def test_reader_generated_tests(self):
+        from namedstruct import reader
+
+        # reads every member of the view, and the elements of the arrays whose length is known
+        def visit(view):
+            if isinstance(view, reader.StructView):
+                for i, name in enumerate(view._type.names):
+                    if not view._type.isPaddingMember(i):
+                        visit(getattr(view, name))
+            elif isinstance(view, (reader.ArrayView, reader.ReferenceArrayView)) and view.type.fixedSize is not None:
+                for element in view:
+                    visit(element)
+            elif isinstance(view, reader.BitFieldArrayView):
+                for field in view.type.getFields()[:view.getNumFields()]:
+                    view.getNumBits(field)
+
+        for struct in generateTests():
+            view = reader.read(pack(struct), namedstruct.getHeaderTypes(struct)[struct.getName()])
+            visit(view)
+            for i, value in enumerate(struct.values):
+                if isinstance(value, Int):
+                    self.assertEqual(view._get(struct.getType().names[i]), value.getPythonValue())
+
+    def test_numpy_dtype(self):
+        import importlib.util
+        from namedstruct import reader
+        gender = n_types.EnumType("dtypeTestGender", n_types.UINT8, {"MALE": 0, "FEMALE": 1})
+        elementType = n_types.StructType("dtypeTestRecord").int16("a").char("c")
+        elementType.addMember("gender", gender)
+        elementType.addMember("id", n_types.UINT32)
+        elementType.addMember("fixed", n_types.SimpleArrayType(n_types.UINT16, 2))
+        elementType.addMember("name", n_types.getCharArrayType(3))
+        elementType.finalize()
+        description = reader.getDtypeDescription(elementType)
+        self.assertEqual(description, {"names": ["a", "c", "gender", "id", "fixed", "name", "paddingBytes0"],
+                                       "formats": ["<i2", "S1", "<u1", "<u4", ("<u2", (2,)), "S3", "V1"],
+                                       "offsets": [0, 2, 3, 4, 8, 12, 15], "itemsize": 16})
+        if importlib.util.find_spec("numpy") is None:
+            with self.assertRaises(Exception):
+                reader.getDtype(elementType)
+            self.skipTest("numpy is not installed")
+
+        schema = n_types.StructType("dtypeTestRow").int16("a").char("c").uint32("id").compile()
+        struct = (Struct("dtypeTestStruct").addInt32("x", 5)
+                  .add("rows", schema.getArrayValue([(-i, b"x", 2 * i) for i in range(1000)])))
+        rows = reader.read(pack(struct), namedstruct.getHeaderTypes(struct)["dtypeTestStruct"]).rows
+        array = rows.getRecords(1000)
+        self.assertEqual(array.dtype, reader.getDtype(schema.getType()))
+        self.assertEqual(array.dtype.names, ("a", "c", "paddingBytes0", "id"))
+        self.assertEqual((int(array["a"].sum()), int(array["id"][999]), array["c"][5]), (-499500, 1998, b"x"))
+
+
+class PythonModuleTestCase(unittest.TestCase):
+    def test_python_module(self):
+        party = n_types.IntEnumType("moduleTestParty", {"A": -1, "B": -2})
+        struct = (makePackingTestStruct()
+                  .addInt64("big", -5).addChar("c", "q").addInt8("pass", 4)
+                  .add("bitField", BitField("moduleTestBits", 16).add("flag", 1).addSigned("delta", -3, 4)
+                       .addEnum("party", party.B))
+                  .addArray("numbers", [1, -2, 3]).addArray("fixed", [7, 8], 4)
+                  .addImmediate("immediate", Struct("moduleTestImmediate").addInt16("y", 9).finalize())
+                  .addArray("elements", [Struct("moduleTestElement").addInt8("i", i).addString("s", "e%d" % i)
+                                        .finalize() for i in range(3)])
+                  .add("none", None))
+        data = pack(struct)
+        module = {}
+        exec(namedstruct.generatePythonModule(struct), module)
+
+        view = module["packingTestStruct"](memoryview(data))
+        self.assertEqual((view.x, view.name.getString(), view.child.y, view.child.z.getString()),
+                         (3, "some name", -7, "zzz"))
+        self.assertEqual((view.strings[0].getString(), view.strings[1], view.strings[2].getString()),
+                         ("a", None, "bcd"))
+        self.assertEqual([view.bits.getA(i) for i in range(2)] + [view.bits.getB(i) for i in range(2)],
+                         [1, 300, 2, 0])
+        self.assertEqual((view.big, view.c, view.pass_), (-5, b"q", 4))
+        self.assertEqual((view.bitField.flag, view.bitField.delta, view.bitField.party), (1, -3, -2))
+        self.assertEqual(module["moduleTestParty"].B, -2)
+        self.assertEqual((view.numbers.getElements(3).tolist(), list(view.fixed), view.immediate.y),
+                         ([1, -2, 3], [7, 8, 0, 0], 9))
+        self.assertEqual([(view.elements[i].i, view.elements[i].s.getString()) for i in (0, 2)], [(0, "e0"), (2, "e2")])
+        self.assertIsNone(view.none)
+
+        # members named like the attributes of the generated classes get a trailing underscore
+        reserved = (Struct("moduleTestReserved").addInt8("_data", 1).addInt8("_offset", 2).addInt8("_read", 3)
+                    .add("bitField", BitField("moduleTestReservedBits", 8).add("bits", 5, 4)))
+        module = {}
+        exec(namedstruct.generatePythonModule(reserved), module)
+        view = module["moduleTestReserved"](pack(reserved))
+        self.assertEqual((view._data_, view._offset_, view._read_, view.bitField.bits_), (1, 2, 3, 5))
+
+
 def generateTests():
     testStructs = []
 
@@ -419,11 +1049,10 @@ def generateTests():
 
     pool = generateConstantPool()
 
-    header = namedstruct.generateHeader(testStructs, pool, includeSetters=True,
-                                        namespace="namedStructTest", define="__NAMEDSTRUCTTEST__",
-                                        headText="/* Testing structs generated by namedstructpy */")
     with open(os.path.dirname(os.path.realpath(__file__)) + "/../include/namedstruct/namedStructTests.h", "w") as f:
-        f.write(header)
+        namedstruct.writeHeader(f, testStructs, pool, includeSetters=True,
+                                namespace="namedStructTest", define="__NAMEDSTRUCTTEST__",
+                                headText="/* Testing structs generated by namedstructpy */")
 
     return testStructs
 
@@ -7,11 +7,16 @@ from builtins import object
 from builtins import bytes
 import array
 import collections
+import itertools
 import numbers
+import operator
+import struct
+import weakref
 
 import namedstruct.bithelper
 import namedstruct.constants
 import namedstruct.namedstruct
+import namedstruct.packing
 import namedstruct.stringhelper
 import namedstruct.n_types
 
@@ -24,6 +29,17 @@ if sys.version_info.major >= 3:
 
 PACK_IN_DECLARED_ORDER = 0
 
+# the references and reference arrays whose reference bit width gets chosen automatically when packing
+# (see Struct.addAutoRef and packing.resolveAutoWidths). Only used to skip choosing widths when there are none.
+autoWidthValues = weakref.WeakSet()
+
+
+# to be called before modifying a mutable value (a struct, reference array or bit field array). Increments the
+# version of the value, which invalidates the memoized packed data and the automatic widths chosen for all the trees
+# containing it (see packing.Memo and packing.AutoWidths)
+def markModified(value):
+    value.version += 1
+
 
 # given a python object, will return a reasonable Value for it
 # Value   -> returns the argument
@@ -47,8 +63,11 @@ def getValue(value):
 
 
 # given an array, will return a reasonable array value for it, i.e. makes a Value array by turning
-# every element into a value using "getValue"
+# every element into a value using "getValue". Integer buffers become int32 arrays as well (e.g. bytes), but their
+# elements get converted in one go, without a value per element - use getBufferArrayValue to keep their element type.
 def getArrayValue(arrayValues, fixedSize=None):
+    if getBufferIntType(arrayValues) is not None:
+        return SimpleArray(namedstruct.n_types.INT32, arrayValues, fixedSize)
     arrayValues = [getValue(v) for v in arrayValues]
     t = arrayValues[0].getType()
     for v in arrayValues[1:]:
@@ -61,10 +80,93 @@ def getArrayValue(arrayValues, fixedSize=None):
         return ReferenceArray(arrayValues, fixedSize)  # build reference array
 
 
+# given an integer buffer (array.array, bytes, memoryview, numpy array..), returns a simple array of the given int
+# type, or of the int type matching the buffer's format, which stores the elements in a single buffer rather than
+# as a value per element (see getBufferElements)
+def getBufferArrayValue(values, intType=None, fixedSize=None):
+    if intType is None:
+        intType = getBufferIntType(values)
+        if intType is None:
+            raise Exception("expecting an integer buffer, but received %s" % type(values).__name__)
+    elif getBufferIntType(values) is None:
+        raise Exception("expecting an integer buffer, but received %s" % type(values).__name__)
+    return SimpleArray(intType, values, fixedSize)
+
+
+# the format chars of the integer buffer formats, which are also array.array type codes
+_bufferFormatChars = "bhilqBHILQ"
+_bufferFormats = {}  # (unsigned, bitWidth) -> native format char
+for _formatChar in reversed(_bufferFormatChars):
+    _bufferFormats[(_formatChar.isupper(), struct.calcsize(_formatChar) * 8)] = _formatChar
+
+
+# returns a 1-dimensional memoryview of the given object if it supports the buffer protocol and has integer
+# elements, otherwise returns None. Also returns the format char, and whether the elements are little endian.
+def _getBufferView(values):
+    if isinstance(values, (list, tuple, str, Value)):
+        return None, None, None
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return None, None, None
+    byteOrder, formatChar = (view.format[:-1], view.format[-1:]) if len(view.format) > 1 else ("@", view.format)
+    if view.ndim != 1 or formatChar not in _bufferFormatChars or byteOrder not in ("@", "=", "<", ">", "!"):
+        return None, None, None
+    return view, formatChar, byteOrder == "<" or (byteOrder in ("@", "=") and sys.byteorder == "little")
+
+
+# returns the int type of the elements of an integer buffer (array.array, bytes, memoryview, numpy array..),
+# or None if values is not an integer buffer
+def getBufferIntType(values):
+    view, formatChar, _ = _getBufferView(values)
+    if view is None:
+        return None
+    return namedstruct.n_types.getIntType(formatChar.isupper(), view.itemsize * 8)
+
+
+# returns the elements of an integer buffer (array.array, bytes, memoryview, numpy array..) as a memoryview with
+# the native format of the given int type, or None if values is not an integer buffer.
+# If the buffer is read-only (e.g. bytes) and has the matching width, signedness and byte order, it is used without
+# copying. Mutable buffers get copied, so changing them later doesn't change the values built from them. Buffers
+# of other int types get their range checked using their min and max, and get converted.
+def getBufferElements(values, intType):
+    view, formatChar, littleEndian = _getBufferView(values)
+    if view is None:
+        return None
+    targetFormatChar = _bufferFormats[(intType.unsigned, intType.bitWidth)]
+    if view.itemsize * 8 == intType.bitWidth and formatChar.isupper() == intType.unsigned and littleEndian:
+        if not view.readonly or not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        return view.cast("B").cast(targetFormatChar)
+    if len(view) > 0:
+        if hasattr(values, "min") and hasattr(values, "astype"):  # numpy arrays
+            intType.assertValueHasType(int(values.min()))
+            intType.assertValueHasType(int(values.max()))
+            dtype = ("<u%d" if intType.unsigned else "<i%d") % (intType.bitWidth // 8)
+            return memoryview(values.astype(dtype)).cast("B").cast(targetFormatChar)
+        elements = view.tolist()
+        intType.assertValueHasType(min(elements))
+        intType.assertValueHasType(max(elements))
+        return memoryview(array.array(targetFormatChar, elements))
+    return memoryview(array.array(targetFormatChar))
+
+
 class Value(object):
+    # values may occur millions of times, so they don't have a __dict__. Their types are shared where possible.
+    __slots__ = ("type",)
+
     def __init__(self, valueType):
         self.type = valueType
 
+    # values get pickled by their slots, e.g. for the workers of parallel packing
+    def __getstate__(self):
+        return None, dict((name, getattr(self, name)) for cls in type(self).__mro__
+                          for name in getattr(cls, "__slots__", ()) if name != "__weakref__" and hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state[1].items():
+            setattr(self, name, value)
+
     def getType(self):
         return self.type
 
@@ -72,7 +174,27 @@ class Value(object):
     # the caller has to ensure proper alignment of the immediate data 
     # but the function will ensure alignment of the offseted data
     def pack(self, data_offset=None):
-        raise Exception()
+        buffer = namedstruct.packing.PackBuffer()
+        if data_offset is None:
+            namedstruct.packing.packValue(buffer, self)
+            return bytes(buffer.data), b""
+        immediateSize = self.getImmediateDataSize()
+        buffer.reserve(immediateSize)
+        # referred data starts right after the immediate data
+        pool = namedstruct.packing.StringPool()
+        namedstruct.packing.packReferences(buffer, self.packInto(buffer, 0, immediateSize - data_offset), pool)
+        pool.pack(buffer)
+        return bytes(buffer.data[:immediateSize]), bytes(buffer.data[immediateSize:])
+
+    # writes the immediate data at the given offset of the pack buffer. Byte offsets are relative to 'base'.
+    # returns the list of (reference, offset, base) whose targets have to be packed next. See the packing module.
+    def packInto(self, buffer, offset, base):
+        raise Exception("unimplemented for " + repr(self))
+
+    # returns a list of (value, offset) of all the values that are stored in the immediate data of this value,
+    # given the offset of this value
+    def getImmediateValues(self, offset):
+        return []
 
     def getPythonValue(self):  # will return a python value, basically what was used to create this
         raise Exception()
@@ -89,6 +211,8 @@ class Value(object):
 
 # primitive value
 class PrimitiveValue(Value):
+    __slots__ = ("pythonValue",)
+
     def __init__(self, valueType, pythonValue):
         Value.__init__(self, valueType)
         self.pythonValue = pythonValue
@@ -104,14 +228,17 @@ class PrimitiveValue(Value):
     def pretty(self):
         return repr(self.pythonValue)
 
-    def pack(self, data_offset=None):
-        return self.type.pack(self.pythonValue), b""
+    def packInto(self, buffer, offset, base):
+        self.type.packInto(buffer, offset, self.pythonValue)
+        return ()
 
 
 # integer value
 class Int(PrimitiveValue):
+    __slots__ = ()
+
     def __init__(self, intValue, unsigned=False, bitWidth=32):
-        valueType = namedstruct.n_types.IntType(unsigned, bitWidth)
+        valueType = namedstruct.n_types.getIntType(unsigned, bitWidth)
         valueType.assertValueHasType(intValue)
         PrimitiveValue.__init__(self, valueType, int(intValue))
 
@@ -119,17 +246,31 @@ class Int(PrimitiveValue):
         return str(self.getPythonValue())
 
 
-# padding byte
-class Padding(Int):
-    def __init__(self):
-        Int.__init__(self, 0, True, 8)
+# a run of padding bytes, packed as zeros
+class Padding(Value):
+    __slots__ = ()
+
+    def __init__(self, numBytes=1):
+        Value.__init__(self, namedstruct.n_types.getPaddingType(numBytes))
+
+    def getPythonValue(self):
+        return bytes(self.type.numBytes)
+
+    def pretty(self):
+        return "padding[%d]" % self.type.numBytes
+
+    def packInto(self, buffer, offset, base):
+        buffer.write(offset, bytes(self.type.numBytes))
+        return ()
 
 
 # a single char
 class Char(PrimitiveValue):
+    __slots__ = ()
+
     def __init__(self, char):
-        charType = namedstruct.n_types.CharType()
-        char = bytes(char, 'utf-8')
+        charType = namedstruct.n_types.CHAR
+        char = char if isinstance(char, bytes) else bytes(char, 'utf-8')
         PrimitiveValue.__init__(self, charType, char)
 
     def getLiteral(self):
@@ -138,6 +279,8 @@ class Char(PrimitiveValue):
 
 # an integer that acts as a bit field
 class BitField(Value):
+    __slots__ = ("values",)
+
     def __init__(self, name, bitWidth=32):
         super(BitField, self).__init__(namedstruct.n_types.BitFieldType(name, bitWidth))
         self.values = []
@@ -200,9 +343,9 @@ class BitField(Value):
             shift = shift + field.bitWidth
         return value
 
-    def pack(self, data_offset=None):
-        intPacked = self.packToInt()
-        return Int(intPacked, True, self.type.bitWidth).pack(data_offset)
+    def packInto(self, buffer, offset, base):
+        self.type.dataType.packInto(buffer, offset, self.packToInt())
+        return ()
 
     def __repr__(self):
         return (
@@ -218,6 +361,8 @@ class BitField(Value):
 
 
 class Null(Value):
+    __slots__ = ()
+
     def __init__(self):
         Value.__init__(self, namedstruct.n_types.NullType())
 
@@ -232,6 +377,8 @@ class Reference(Value):
     """
     Reference to another Value
     """
+    __slots__ = ("targetValue", "pack_order", "autoWidthKey", "autoWidthOwner", "__weakref__")
+    interned = False  # whether the target is packed in the string pool, see InternedReference
 
     def __init__(self, targetValue, referenceBitWidth=32, targetType=None, pack_order=PACK_IN_DECLARED_ORDER):
         """
@@ -252,6 +399,12 @@ class Reference(Value):
                                                          referenceBitWidth=referenceBitWidth))
         self.targetValue = targetValue
         self.pack_order = pack_order
+        # for references with automatic width, the key of the values which share the width, and the struct it's in
+        self.autoWidthKey = None
+        self.autoWidthOwner = None
+
+    def setReferenceBitWidth(self, referenceBitWidth):
+        self.type.setReferenceBitWidth(referenceBitWidth)
 
     def pretty(self):
         return ("->" +
@@ -265,23 +418,47 @@ class Reference(Value):
     def pack(self, data_offset=None):
         if data_offset is None:
             raise Exception("cannot pack reference without a data offset (is the reference not contained in a struct?)")
+        return Value.pack(self, data_offset)
+
+    def packInto(self, buffer, offset, base):
         if self.targetValue.getPythonValue() is None:
-            return self.type.referenceType.pack(0), b""
-        else:
-            # add padding bytes until data offset is aligned with target type
-            padding = int(((-data_offset) % self.type.targetType.getAlignment()))
-            packedReference = self.type.referenceType.pack(data_offset + padding)
-            packedData = b"\x00" * padding + namedstruct.namedstruct.pack(self.targetValue, addPadding=False)
-            return packedReference, packedData
+            self.type.referenceType.packInto(buffer, offset, 0)
+            return ()
+        return [(self, offset, base)]  # the byte offset is known once the target gets packed
+
+    # stores the byte offset to the end of the buffer, where the target will be packed.
+    # returns the offset of the target
+    def packOffsetInto(self, buffer, offset, base):
+        # add padding bytes until data offset is aligned with target type
+        data_offset = buffer.end - base
+        padding = int(((-data_offset) % self.type.targetType.getAlignment()))
+        self.type.referenceType.packInto(buffer, offset, data_offset + padding)
+        buffer.reserve(buffer.end + padding)
+        return buffer.end
+
+
+# a reference to a string that gets packed in the string pool, which is stored after all the other data of the
+# packed top level value. Interned strings with the same content are packed only once.
+class InternedReference(Reference):
+    __slots__ = ()
+    interned = True
+
+    def __init__(self, targetValue, referenceBitWidth=32):
+        if not isinstance(targetValue, String):
+            raise Exception("only strings can be interned, received " + repr(targetValue))
+        Reference.__init__(self, targetValue, referenceBitWidth)
 
 
 # all the array-like values
 class Array(Value):
+    __slots__ = ("elementsAreValueObjects", "values")
+
     def __init__(self, arrayType, values):
         Value.__init__(self, arrayType)
         # check correctness on values - either incoming values are python values or Value objects
         self.elementsAreValueObjects = (len(values) > 0 and isinstance(values[0], Value))
-        for v in values:
+        # the elements of int buffers were already checked by getBufferElements, strings are stored as bytes
+        for v in (values if not isinstance(values, (memoryview, bytes)) else ()):
             if self.elementsAreValueObjects:
                 assert (isinstance(v, Value))
                 arrayType.getElementType().merge(v.getType())
@@ -290,50 +467,78 @@ class Array(Value):
 
         self.values = values
 
+    # buffer elements (see getBufferElements) are pickled as bytes
+    def __getstate__(self):
+        state = Value.__getstate__(self)
+        if isinstance(self.values, memoryview):
+            state[1]["values"] = self.values.tobytes()
+            state[1]["bufferFormat"] = self.values.format
+        return state
+
+    def __setstate__(self, state):
+        slots = dict(state[1])
+        bufferFormat = slots.pop("bufferFormat", None)
+        Value.__setstate__(self, (None, slots))
+        if bufferFormat is not None:
+            self.values = memoryview(self.values).cast(bufferFormat)
+
     def getPythonValue(self):
         return self.values
 
-    # will pack the elements
-    def pack(self, data_offset=None, elementOffsetsRelativeToElement=True):
-        if data_offset is None:
-            data_offset = self.getImmediateDataSize()
-        immediateData = []
-        offsetedData = []
-        immediateLen = 0
+    # will pack the elements, the remaining immediate data (of fixed size arrays) is left as zero bytes
+    def packInto(self, buffer, offset, base, elementOffsetsRelativeToElement=True):
+        position = offset
+        references = []
+        if self.elementsAreValueObjects:
+            for value in self.values:
+                # offset is relative to element
+                references.extend(value.packInto(buffer, position,
+                                                 base + (position - offset) if elementOffsetsRelativeToElement else base))
+                position += value.getImmediateDataSize()
+        elif isinstance(self.values, bytes):  # the chars of strings and blobs
+            buffer.write(position, self.values)
+        elif isinstance(self.values, memoryview):  # buffer elements (see getBufferElements) are packed in one go
+            buffer.write(position, self.values.cast("B"))
+        else:
+            elementType = self.type.getElementType()
+            width = elementType.getWidth()
+            for value in self.values:
+                elementType.packInto(buffer, position, value)
+                position += width
+        return references
+
+    def getImmediateValues(self, offset):
+        if not self.elementsAreValueObjects:
+            return []
+        result = []
         for value in self.values:
-            if self.elementsAreValueObjects:
-                immediate, referred = value.pack(data_offset -
-                                                 (immediateLen
-                                                  if elementOffsetsRelativeToElement else
-                                                  0))  # offset is relative to element
-                data_offset += len(referred)
-                immediateData.append(immediate)
-                offsetedData.append(referred)
-                immediateLen += len(immediateData[-1])
-            else:
-                immediateData.append(self.type.getElementType().pack(value))
-                immediateLen += len(immediateData[-1])
-        immediateString = b"".join(immediateData)
-        offsetedString = b"".join(offsetedData)
-        return immediateString, offsetedString
+            result.append((value, offset))
+            offset += value.getImmediateDataSize()
+        return result
 
     def pretty(self):
         maxChars = 500
         minResults = 2
-        results = [v.pretty() if self.elementsAreValueObjects else str(v) for v in self.values]
+        results = []  # only pretty print the elements that are shown
         chars = 0
-        i = 0
-        while (chars <= maxChars or i < minResults) and i < len(results):
-            chars += len(results[i])
-            i += 1
-        return "[" + ", ".join(results[:i]) + (",..." if i < len(results) else "") + "]"
+        while (chars <= maxChars or len(results) < minResults) and len(results) < len(self.values):
+            v = self.values[len(results)]
+            results.append(v.pretty() if self.elementsAreValueObjects else str(v))
+            chars += len(results[-1])
+        return "[" + ", ".join(results) + (",..." if len(results) < len(self.values) else "") + "]"
 
 
 # c array - either variable length, or fixed length
 class SimpleArray(Array):
+    __slots__ = ("fixedSize",)
+
     def __init__(self, elementType, values, fixedSize=None, byteAlignment=None):
         if isinstance(elementType, namedstruct.n_types.ReferenceType):
             raise Exception("simple arrays cannot store references")
+        if type(elementType) is namedstruct.n_types.IntType:
+            elements = getBufferElements(values, elementType)
+            if elements is not None:
+                values = elements
         if fixedSize is not None:
             assert (len(values) <= fixedSize)
         self.fixedSize = fixedSize
@@ -344,28 +549,24 @@ class SimpleArray(Array):
         return int((self.type.getElementType().getWidth()
                     * (len(self.values) if self.fixedSize is None else self.fixedSize)))
 
-    def pack(self, data_offset=None, elementOffsetsRelativeToElement=True):
-        immediateData, offsetData = Array.pack(self, data_offset)  # call super pack
-        if self.fixedSize is not None:
-            # fill the data with zero bytes 
-            immediateData = (immediateData
-                             + b"\x00" * (self.getImmediateDataSize() - len(immediateData)))
-        if data_offset is None:
-            return immediateData + offsetData, b""
-        else:
-            return immediateData, offsetData
-
     def getLiteral(self):
-        return '{%s}' % ', '.join([value.getLiteral() for value in self.values])
+        return '{%s}' % ', '.join([value.getLiteral() if self.elementsAreValueObjects else str(value)
+                                   for value in self.values])
 
 
 # c array of chars - arbitrary strings get converted to utf-8
 class String(SimpleArray):
+    __slots__ = ("string",)
+
+    # the chars are stored as a single bytes object
     def __init__(self, string="", fixedSize=None, omitTerminal=False):
-        chars = namedstruct.stringhelper.stringToChars(string)
+        chars = namedstruct.stringhelper.stringToCString(string)
         if omitTerminal:
             chars = chars[:-1]
-        SimpleArray.__init__(self, namedstruct.n_types.CharType(), chars, fixedSize)
+        if fixedSize is not None:
+            assert (len(chars) <= fixedSize)
+        self.fixedSize = fixedSize
+        Array.__init__(self, namedstruct.n_types.getCharArrayType(fixedSize), chars)
         self.string = string
 
     def pretty(self):
@@ -383,28 +584,43 @@ blobStrings = []
 
 
 class Blob(SimpleArray):
-    # the alignment is 4 bytes by default, which can be overridden
+    __slots__ = ("numBits",)
+
+    # the alignment is 4 bytes by default, which can be overridden.
+    # The chars are stored as a single bytes object: strings and bytes are used as they are, sequences of bits
+    # (lists, array.array, numpy arrays..) get packed in one go
     def __init__(self, blob, fixedSize=None, byteAlignment=4):
         global blobStrings
         blobStrings.append(blob)
-        if isinstance(blob, (str, unicode, bytes)):
-            bitArrays = [namedstruct.bithelper.toBits(namedstruct.compat.ord_if_needed(c), numBits=8) for c in blob]
-            blob = []
-            for bitArray in bitArrays:
-                blob.extend(bitArray)
-        blob = array.array('B', blob)  # turn blob into an actual binary array - if it's not a string
-        SimpleArray.__init__(self, namedstruct.n_types.CharType(), namedstruct.bithelper.packBitsToChars(blob),
-                             fixedSize, byteAlignment)
-        self.blob = blob
+        if isinstance(blob, bytes):
+            chars = blob
+        elif isinstance(blob, (str, unicode)):
+            try:
+                chars = blob.encode("latin-1")
+            except UnicodeEncodeError:
+                raise Exception("blob strings must be made of 8-bit chars, but found " + repr(blob))
+        else:
+            bitBytes = getBufferElements(blob, namedstruct.n_types.UINT8)
+            try:
+                bitBytes = bytes(bitBytes if bitBytes is not None else blob)
+            except ValueError:
+                raise Exception("blobs can only be made from sequences of 0,1 values")
+            chars = namedstruct.bithelper.packBitBytes(bitBytes)
+        self.numBits = len(chars) * 8 if isinstance(blob, (str, unicode, bytes)) else len(bitBytes)
+        SimpleArray.__init__(self, namedstruct.n_types.CHAR, chars, fixedSize, byteAlignment)
 
     def pretty(self):
-        return namedstruct.stringhelper.cutStringIfTooLong("[" + ''.join(str(b) for b in self.blob[0:200]) + "]",
-                                                           length=len(self.blob))
+        bits = namedstruct.bithelper.unpackBitBytes(self.values[:25], min(self.numBits, 200))
+        return namedstruct.stringhelper.cutStringIfTooLong("[" + ''.join(str(b) for b in bits) + "]",
+                                                           length=self.numBits)
 
+    # returns the bits of the blob as an array of 0/1 values
     def getPythonValue(self):
-        return self.blob
+        return array.array('B', namedstruct.bithelper.unpackBitBytes(self.values, self.numBits))
 
 class Matrix(SimpleArray):
+    __slots__ = ()
+
     def __init__(self, elementType, nRows, nCols, values, byteAlignment=None):
         assert(len(values) == nRows)
         assert(all(len(row) == nCols for row in values))
@@ -414,6 +630,8 @@ class Matrix(SimpleArray):
 
 class ConstantStringArray(Array):
     """Special case: An array of const char * pointers, to statically allocated C strings"""
+    __slots__ = ()
+
     def __init__(self, values, fixedSize=None, byteAlignment=None):
         values_as_strings = [namedstruct.String(value) for value in values]
         elementType = namedstruct.n_types.ConstCharPointerType()
@@ -422,7 +640,7 @@ class ConstantStringArray(Array):
     def getImmediateDataSize(self):
         raise NotImplementedError('This type is available for constant arrays only')
 
-    def pack(self, data_offset=None, elementOffsetsRelativeToElement=True):
+    def packInto(self, buffer, offset, base, elementOffsetsRelativeToElement=True):
         raise NotImplementedError('This type is available for constant arrays only')
 
     def getLiteral(self):
@@ -431,8 +649,18 @@ class ConstantStringArray(Array):
 
 # reference array
 class ReferenceArray(Array):
+    __slots__ = ("fixedSize", "autoWidthKey", "autoWidthOwner", "version", "__weakref__")
+
     # construct reference array from a sequence of values - those may be values, or will be turned into values
+    # referenceBitWidth may be 'auto', to use the narrowest width that fits all elements, see Struct.addAutoRef
     def __init__(self, values, fixedSize=None, referenceBitWidth=32):
+        self.autoWidthKey = None  # see Reference
+        self.autoWidthOwner = None
+        self.version = 0  # see markModified
+        if referenceBitWidth == 'auto':
+            referenceBitWidth = 8
+            self.autoWidthKey = (id(self),)
+            autoWidthValues.add(self)
         if len(values) == 0:
             raise Exception("reference array values cannot be empty")
         if fixedSize is not None:
@@ -457,29 +685,24 @@ class ReferenceArray(Array):
         return int((self.type.getElementType().getWidth()
                     * (len(self.values) if self.fixedSize is None else self.fixedSize)))
 
-    def pack(self, data_offset=None, elementOffsetsRelativeToElement=True):
-        if data_offset is None:
-            data_offset = self.getImmediateDataSize()
-            combine = True
-        else:
-            combine = False
-        immediateData, offsetData = Array.pack(self, data_offset, elementOffsetsRelativeToElement=False)
-        if self.fixedSize is not None:
-            # fill the data with zero bytes 
-            immediateData = (immediateData
-                             + b"\x00" * (self.getImmediateDataSize() - len(immediateData)))
-        if combine:
-            return immediateData + offsetData, ""
-        else:
-            return immediateData, offsetData
+    def packInto(self, buffer, offset, base, elementOffsetsRelativeToElement=False):
+        return Array.packInto(self, buffer, offset, base, elementOffsetsRelativeToElement=False)
+
+    def setReferenceBitWidth(self, referenceBitWidth):
+        markModified(self)
+        self.type.setReferenceBitWidth(referenceBitWidth)
+        for reference in self.values:
+            reference.setReferenceBitWidth(referenceBitWidth)
 
 
 # reserved is just a set of bytes reserved for future use
 class ReservedValue(SimpleArray):
-    pass  # TODO?
+    __slots__ = ()
 
 
 class EnumValue(Value):
+    __slots__ = ("name",)
+
     def __init__(self, enumType, name):
         assert isinstance(enumType, namedstruct.n_types.EnumType)
         assert name in enumType.mapping
@@ -502,8 +725,8 @@ class EnumValue(Value):
     def getImmediateDataSize(self):
         return int(self.type.getEnumType().getWidth())
 
-    def pack(self, data_offset=None):
-        return self.type.mapping[self.name].pack()
+    def packInto(self, buffer, offset, base):
+        return self.type.mapping[self.name].packInto(buffer, offset, base)
 
     def __repr__(self):
         return "%s.%s" % (self.type, self.name)
@@ -512,10 +735,33 @@ class EnumValue(Value):
 # struct value
 # structs don't have fixed width unless they are closed/finished
 class Struct(Value, namedstruct.constants.AddConstantFunctions):
+    __slots__ = ("values", "version", "trackers", "packedLayout", "__weakref__")
+
     def __init__(self, name):
         structType = namedstruct.n_types.StructType(name)
+        structType.hasValues = True
         Value.__init__(self, structType)
         self.values = []  # list of member values
+        self.version = 0  # see markModified
+        self.trackers = None  # weak references to the layouts of packed data that track overwrites, see addTracker
+        self.packedLayout = None  # the layout of the data this was last packed to with trackChanges, see 'repack'
+
+    # returns a struct of the given finalized struct type, with the given values for all its members (including
+    # padding). The type is shared rather than copied, e.g. by all the records built by a StructSchema.
+    @staticmethod
+    def fromMemberValues(structType, values):
+        if structType.mutable:
+            raise Exception("can only share finalized struct types, but %s is not finalized" % structType.name)
+        if len(values) != len(structType.types):
+            raise Exception("struct %s has %d members, but received %d values"
+                            % (structType.name, len(structType.types), len(values)))
+        struct = Struct.__new__(Struct)
+        Value.__init__(struct, structType)
+        struct.values = list(values)
+        struct.version = 0
+        struct.trackers = None
+        struct.packedLayout = None
+        return struct
 
     def __repr__(self):
         structType = self.type
@@ -640,11 +886,23 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
         return self.addReference(name, value, referenceBitWidth=referenceBitWidth, targetType=targetType,
                                  pack_order=pack_order)
 
+    # adds a reference to the value, using the narrowest reference bit width that fits the byte offset. The width
+    # gets chosen when packing (see packing.resolveAutoWidths), and is the same for all the structs with this name.
+    # Structs with such references cannot be finalized.
+    def addAutoRef(self, name, value, pack_order=PACK_IN_DECLARED_ORDER):
+        reference = Reference(dictGet(value, name), 8, pack_order=pack_order)
+        reference.autoWidthKey = (self.type.name, name)
+        reference.autoWidthOwner = self
+        autoWidthValues.add(reference)
+        return self.addImmediate(name, reference)
+
     # will add the value
     def addImmediate(self, name, value):
         value = getValue(dictGet(value, name))
+        markModified(self)
         padBytes = self.getType().addMember(name, value.getType())
-        self.values.extend([Padding()] * padBytes)
+        if padBytes > 0:
+            self.values.append(Padding(padBytes))
         self.values.append(value)
         return self
 
@@ -710,6 +968,15 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
             self.addReference(name, String(string, fixedWidth, omitTerminal), referenceBitWidth, pack_order=pack_order)
         return self
 
+    # adds a reference to a variable length string like addString, but the string gets stored in the string pool,
+    # so all the interned strings with the same content are only stored once.
+    # returns self
+    def addInternedString(self, name, string, omitTerminal=False, referenceBitWidth=32):
+        string = dictGet(string, name)
+        if string is None:
+            return self.addString(name, None)
+        return self.addImmediate(name, InternedReference(String(string, None, omitTerminal), referenceBitWidth))
+
     # will add an array of values to the struct.
     # if value is a dictionary, will add value[name]
     # if the value is an array of Value objects, will add an array with the val
@@ -725,6 +992,20 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
             self.addReference(name, value, pack_order=pack_order)
         return self
 
+    # will add an array of ints from an integer buffer (array.array, bytes, memoryview, numpy array..), using the
+    # given int type, or the one matching the buffer's format (e.g. uint8_t for bytes), see getBufferArrayValue.
+    # The elements get copied, unless the buffer is read-only.
+    def addBufferArray(self, name, values, intType=None, fixedSize=None, pack_order=PACK_IN_DECLARED_ORDER):
+        values = dictGet(values, name)
+        value = getBufferArrayValue(values, intType, fixedSize)
+        if value.getType().isImmediate():
+            if pack_order != 0:
+                raise Exception("pack_order cannot be used when the array type is immediate.")
+            self.addImmediate(name, value)
+        else:
+            self.addReference(name, value, pack_order=pack_order)
+        return self
+
     # will add a reference array to the struct.
     # if value is a dictionary, will add value[name]
     # if the value is an array of Value objects, will add an array with the val
@@ -734,6 +1015,9 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
         arrayValues = dictGet(arrayValues, name)
         arrayValues = [getValue(v) for v in arrayValues]
         array = ReferenceArray(arrayValues, fixedSize, referenceBitWidth)
+        if array.autoWidthKey is not None:
+            array.autoWidthKey = (self.type.name, name, "[]")
+            array.autoWidthOwner = self
         if array.getType().isImmediate():
             if pack_order != 0:
                 raise Exception('pack_order cannot be used when the array type is immediate.')
@@ -745,8 +1029,44 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
     # this will finalize type of this struct. The Struct may never grow in size from this point on.
     # returns self.
     def finalize(self, byteAlignment=4):
+        if any(getattr(value, "autoWidthKey", None) is not None for value in self.values):
+            raise Exception("cannot finalize struct %s with automatic width references" % self.getName())
         padBytes = self.getType().finalize(byteAlignment)
-        self.values.extend([Padding()] * padBytes)
+        markModified(self)
+        if padBytes > 0:
+            self.values.append(Padding(padBytes))
+        return self
+
+    # recomputes the offsets and padding bytes of the members, after the width of some members changed
+    def relayout(self):
+        structType = self.type
+        return self._setMemberOrder([i for i in range(len(structType.names)) if not structType.isPaddingMember(i)])
+
+    # reorders the members to minimize the padding bytes, keeping the declared order of the members added after the
+    # compatibility boundary (see StructType.getOptimizedOrder). This changes the C++ layout, so it should be done
+    # before the struct layout is published. If statistics is a dict, the number of bytes saved is stored as
+    # 'savedPaddingBytes'. Returns self.
+    def packOptimized(self, statistics=None):
+        structType = self.type
+        width = structType.getCurrentWidth()
+        self._setMemberOrder(structType.getOptimizedOrder())
+        if statistics is not None:
+            statistics["savedPaddingBytes"] = width - structType.getCurrentWidth()
+        return self
+
+    # see StructType.addCompatibilityBoundary. Returns self.
+    def addCompatibilityBoundary(self):
+        self.type.addCompatibilityBoundary()
+        return self
+
+    def _setMemberOrder(self, indices):
+        members = [self.values[i] for i in indices]
+        markModified(self)
+        self.values = []
+        for padBytes, value in zip(self.type.setMemberOrder(indices), members):
+            if padBytes > 0:
+                self.values.append(Padding(padBytes))
+            self.values.append(value)
         return self
 
     def overwrite(self, key, value):
@@ -756,10 +1076,37 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
         # This check is intended to ensure the new value will not cause any pointers to shift
         assert old_type.getAlignment() == new_value.getType().getAlignment()
         assert old_type.getWidth() == new_value.getType().getWidth()
+        # records created by fromMemberValues share their type, so changing a member type would change all of them
+        if not self.type.hasValues and new_value.getType() is not old_type:
+            raise Exception("cannot overwrite member %s of struct %s with a value of type %s, as the struct type is "
+                            "shared by other records" % (key, self.type.name, new_value.getType()))
+        markModified(self)
+        if self.trackers is not None:
+            trackers = []
+            for tracker in self.trackers:
+                layout = tracker()
+                if layout is not None:
+                    layout.addChange(self, index, self.values[index])
+                    trackers.append(tracker)
+            self.trackers = trackers if len(trackers) > 0 else None
         self.type.types[index] = new_value.getType()
         self.values[index] = new_value
         return self
 
+    # the packed layouts stay in this process, a pickled struct isn't tracked
+    def __getstate__(self):
+        state = Value.__getstate__(self)
+        state[1]["trackers"] = None
+        state[1]["packedLayout"] = None
+        return state
+
+    # makes overwrite record its changes in the given layout (see packing.Layout.addChange), as long as the
+    # layout exists. Used for the structs in packed data that can be updated by 'repack'.
+    def addTracker(self, layout):
+        trackers = [tracker for tracker in self.trackers or [] if tracker() is not None]
+        trackers.append(weakref.ref(layout))
+        self.trackers = trackers
+
 
     def pretty(self):
         result = "struct " + self.type.getName() + " {"
@@ -785,60 +1132,33 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
 
         return sorted(enumerate(self.values), key=key)
 
-    def pack(self, data_offset=None):
-        if data_offset is None:
-            data_offset = self.getImmediateDataSize()
-            combine = True
-        else:
-            combine = False
-
+    def packInto(self, buffer, offset, base):
         # Referred data (the actual content) is packed using the pack_order.
         # The data_offsets, and thus the value of the generated immediates (the references/pointers) to the data reflect
         # this order.
         # Immediate data (the pointers to structs) is packed using the defined order, to respect the data type and padding.
         # If pack_order is inappropriately specified, you should get an exception. If I did it wrong, then it'll just
         # get silently ignored and won't corrupt the data.
-
-        pack_ordered_values = self.__pack_ordered_values()
-
-        immediate_blobs = []
-        referred_blobs = []
-
-        for original_order, value in pack_ordered_values:
-            immediate, referred = value.pack(data_offset)
-
-            if isinstance(referred, str):
-                # TODO: Deal with this odd edge-case
-                referred = bytes(referred, 'utf-8')
-
-            data_offset += len(referred)
-            immediate_blobs.append((original_order, immediate))
-            referred_blobs.append(referred)
-
-        immediate_blobs_original_order = [blob for _, blob in sorted(immediate_blobs, key=lambda item: item[0])]
-        immediate_blob = b''.join(immediate_blobs_original_order)
-        padding = self.getImmediateDataSize() - len(immediate_blob)
-        immediate_blob += b'\x00' * padding
-
-        referred_blob = b''.join(referred_blobs)
-
-        if combine:
-            return immediate_blob + referred_blob, b''
-        else:
-            return immediate_blob, referred_blob
+        immediateValues = self.getImmediateValues(offset)
+        references = []
+        for original_order, value in self.__pack_ordered_values():
+            references.extend(value.packInto(buffer, immediateValues[original_order][1], base))
+        return references
+
+    def getImmediateValues(self, offset):
+        result = []
+        for value in self.values:
+            result.append((value, offset))
+            offset += value.getImmediateDataSize()
+        return result
 
     # prints the sizes of every member
     # indent allows indenting the printing result by 'indent' spaces
     def printSizes(self, indent=0):
         # collect names/sizes
-        names = []
-        sizes = []
-        data_offset = self.getImmediateDataSize()
-        for i, value in enumerate(self.values):
-            immediate, referred = value.pack(data_offset)
-            names.append(self.type.getMember(i)[2])
-            sizes.append(len(immediate) + len(referred))
-            data_offset += len(referred)
+        layout = namedstruct.packing.computeLayout(self)
+        names = [self.type.getMember(i)[2] for i in range(len(self.values))]
+        sizes = [layout.getSize(value) for value in self.values]
         total = "total:"
         maxNameLen = max([len(total)] + [len(name) for name in names]) + 1
         numLen = len(str(sum(sizes)))
@@ -852,17 +1172,138 @@ class Struct(Value, namedstruct.constants.AddConstantFunctions):
         print(" " * indent + total + (" " * (maxNameLen - len(total))) + (numFormat % sum(sizes)))
 
 
+# a compiled struct type, which builds and packs many records of the same shape: the member offsets and a
+# struct.Struct format are computed once, and every record is packed with a single struct call. Create it using
+# StructType.compile(), e.g. StructType("Trip").int32("id").uint8("kind").compile().
+# Records are either tuples of the member values in member order (excluding the padding members), or dicts from
+# member names to values. Char members take bytes of length 1.
+class StructSchema(object):
+    __slots__ = ("type", "names", "packer", "getMemberValues")
+
+    def __init__(self, structType):
+        if structType.mutable:
+            raise Exception("cannot compile non-finalized struct type " + structType.name)
+        formats = []
+        for memberType, name in zip(structType.types, structType.names):
+            if isinstance(memberType, namedstruct.n_types.PaddingType):
+                formats.append("%dx" % memberType.numBytes)
+            elif isinstance(memberType, namedstruct.n_types.IntType):  # includes chars
+                formats.append(memberType.getFormatChar())
+            else:
+                raise Exception("cannot compile member %s of struct %s: only int and char members are supported, "
+                                "but found %s" % (name, structType.name, repr(memberType)))
+        self.type = structType
+        self.names = [name for i, name in enumerate(structType.names) if not structType.isPaddingMember(i)]
+        self.packer = struct.Struct("<" + "".join(formats))  # members are already aligned by their offsets
+        assert self.packer.size == structType.getWidth()
+        getter = operator.itemgetter(*self.names)
+        self.getMemberValues = getter if len(self.names) > 1 else (lambda record: (getter(record),))
+
+    def __repr__(self):
+        return "<StructSchema:" + str(self.type.name) + ">"
+
+    # the struct format can't be pickled, so it gets compiled again
+    def __reduce__(self):
+        return StructSchema, (self.type,)
+
+    def getType(self):
+        return self.type
+
+    # returns the width of a single record in bytes
+    def getWidth(self):
+        return self.packer.size
+
+    def _getRecordTuples(self, records):
+        getMemberValues = self.getMemberValues
+        return (getMemberValues(record) if isinstance(record, dict) else record for record in records)
+
+    # returns the packed records, back to back, as bytes
+    def pack(self, records):
+        try:
+            return b"".join(itertools.starmap(self.packer.pack, self._getRecordTuples(records)))
+        except struct.error as e:
+            raise Exception("cannot pack record of struct %s: %s" % (self.type.name, e))
+
+    # packs a single record into the buffer at the given offset
+    def packInto(self, buffer, offset, record):
+        try:
+            self.packer.pack_into(buffer, offset, *(self.getMemberValues(record) if isinstance(record, dict)
+                                                    else record))
+        except struct.error as e:
+            raise Exception("cannot pack record of struct %s: %s" % (self.type.name, e))
+
+    # returns the record as a Struct value, which shares the compiled struct type
+    def getValue(self, record):
+        memberValues = next(self._getRecordTuples([record]))
+        if len(memberValues) != len(self.names):
+            raise Exception("struct %s has %d members, but received %s" % (self.type.name, len(self.names), record))
+        memberValues = iter(memberValues)
+        values = [Padding(memberType.numBytes) if isinstance(memberType, namedstruct.n_types.PaddingType)
+                  else memberType.makeValue(next(memberValues))
+                  for memberType in self.type.types]
+        return Struct.fromMemberValues(self.type, values)
+
+    # returns an array of all the records, which are packed right away (see RecordArray)
+    def getArrayValue(self, records, fixedSize=None):
+        return RecordArray(self, self.pack(records), fixedSize)
+
+    # returns the records packed in the given data as tuples of member values
+    def unpack(self, data):
+        return list(self.packer.iter_unpack(data))
+
+
+# an array of structs that were packed by a StructSchema. The packed records are stored as a single bytes object,
+# so that the array doesn't hold a Value per record
+class RecordArray(SimpleArray):
+    __slots__ = ("schema", "numRecords")
+
+    def __init__(self, schema, data, fixedSize=None, byteAlignment=None):
+        if len(data) % schema.getWidth() != 0:
+            raise Exception("record data of %d bytes is not a multiple of the %d byte %s records"
+                            % (len(data), schema.getWidth(), schema.getType().name))
+        self.schema = schema
+        self.numRecords = len(data) // schema.getWidth()
+        if fixedSize is not None:
+            assert (self.numRecords <= fixedSize)
+        self.fixedSize = fixedSize
+        Array.__init__(self, namedstruct.n_types.SimpleArrayType(schema.getType(), fixedSize, byteAlignment),
+                       bytes(data))
+
+    def __len__(self):
+        return self.numRecords
+
+    def getImmediateDataSize(self):
+        return int(self.schema.getWidth() * (self.numRecords if self.fixedSize is None else self.fixedSize))
+
+    # returns the records as tuples of member values
+    def getPythonValue(self):
+        return self.schema.unpack(self.values)
+
+    def pretty(self):
+        records = self.schema.unpack(self.values[:self.schema.getWidth() * 10])
+        return ("[" + ", ".join(str(record) for record in records)
+                + (",..." if len(records) < self.numRecords else "") + "]")
+
+
 # an array of bitfield values, with variable number of bits
 class BitFieldArray(Value):
+    __slots__ = ("columns", "blobs", "fieldLengths", "numEntries", "version", "__weakref__")
+
     def __init__(self, name, *fields):
         super(BitFieldArray, self).__init__(namedstruct.n_types.BitFieldArrayType(name, fields))
-        self.entries = []  # each entry is an array of (isBlob,value)
+        # the entries are stored by field: an array of ints per field, and a dict of entry index -> Blob per field,
+        # for the entries that store blobs (their int is 0)
+        self.columns = [array.array('I') for _ in fields]
+        self.blobs = [{} for _ in fields]
+        self.fieldLengths = [0] * len(fields)  # the bit length of every field, None if it has to be recomputed
+        self.numEntries = 0  # the number of entries, kept separately from the columns
+        self.version = 0  # see markModified
 
     def __repr__(self):
         return "<BitFieldArray:%s with %d fields>" % (self.type.getName(), len(self.type.getFields()))
 
     def __len__(self):
-        return len(self.entries)
+        return self.numEntries
 
     # adds a new entry to the bit field array
     # the fieldValues may be a dictionary of field-value, or a sequence of values in the same order as the fields
@@ -877,17 +1318,28 @@ class BitFieldArray(Value):
             fieldValues = [fieldValues[field] for field in fields]
         entry = []
         for value in fieldValues:
-            if isinstance(value, Blob):
-                entry.append((True, value))
-            else:
+            if not isinstance(value, Blob):
                 if not isinstance(value, numbers.Integral):
                     raise Exception(
                         "attempting to add " + repr(value) + ", but bitFieldArray only supports int or blobValue.")
                 if not (0 <= value < 2 ** 31):
                     raise Exception(
                         "bitFieldArray only supports values between 0 (incl) and 2^31 (excl), received " + repr(value))
-                entry.append((False, int(value)))
-        self.entries.append(entry)
+                value = int(value)
+            entry.append(value)
+        markModified(self)
+        index = len(self)
+        for fieldIndex, value in enumerate(entry):
+            if isinstance(value, Blob):
+                self.blobs[fieldIndex][index] = value
+                self.columns[fieldIndex].append(0)
+                length = value.numBits
+            else:
+                self.columns[fieldIndex].append(value)
+                length = value.bit_length()
+            if self.fieldLengths is not None and length > self.fieldLengths[fieldIndex]:
+                self.fieldLengths[fieldIndex] = length
+        self.numEntries += 1
         return self
 
     # calls add on all elements of a sequence, returns self
@@ -896,6 +1348,77 @@ class BitFieldArray(Value):
             self.add(entry)
         return self
 
+    # adds entries given as columns: one sequence or int buffer (array.array, numpy array..) per field, all with
+    # the same length. Only ints are supported. The range of every column is checked once, using its max.
+    # returns self
+    def addColumns(self, columns):
+        fields = self.type.getFields()
+        if len(columns) != len(fields):
+            raise Exception("expecting %d columns, received %d" % (len(fields), len(columns)))
+        if len(set(len(column) for column in columns)) > 1:
+            raise Exception("the columns of bitFieldArray %s have different lengths" % self.type.getName())
+        newColumns = []
+        for field, column in zip(fields, columns):
+            elements = getBufferElements(column, namedstruct.n_types.UINT32)  # ensures 0 <= value < 2^32
+            if elements is None:
+                try:
+                    elements = array.array('I', column)
+                except (TypeError, OverflowError):
+                    raise Exception("bitFieldArray column %s can only contain ints between 0 (incl) and 2^31 (excl)"
+                                    % field)
+            if len(elements) == 0:
+                maxValue = 0
+            elif hasattr(column, "max") and hasattr(column, "astype"):  # numpy arrays
+                maxValue = int(column.max())
+            else:
+                maxValue = max(elements)
+            if maxValue >= 2 ** 31:
+                raise Exception("bitFieldArray only supports values between 0 (incl) and 2^31 (excl), received "
+                                + repr(maxValue))
+            newColumns.append((elements, maxValue.bit_length()))
+        markModified(self)
+        for fieldIndex, (elements, length) in enumerate(newColumns):
+            if isinstance(elements, array.array):
+                self.columns[fieldIndex].extend(elements)
+            else:
+                self.columns[fieldIndex].frombytes(elements.cast("B"))
+            if self.fieldLengths is not None and length > self.fieldLengths[fieldIndex]:
+                self.fieldLengths[fieldIndex] = length
+        self.numEntries += len(columns[0]) if len(columns) > 0 else 0
+        return self
+
+    # adds the entries of an iterable of row tuples, which are turned into columns (see addColumns) bufferSize rows
+    # at a time, so the rows can be streamed. Rows that are not only ints (e.g. blobs) are added using add.
+    # returns self
+    def addRows(self, rows, bufferSize=65536):
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, bufferSize))
+            if len(chunk) == 0:
+                return self
+            if len(set(map(len, chunk))) == 1:
+                try:
+                    columns = [array.array('I', column) for column in zip(*chunk)]
+                except (TypeError, OverflowError):
+                    columns = None  # not only ints, e.g. blobs, or negative ints
+                if columns is not None:
+                    self.addColumns(columns)
+                    continue
+            self.addAll(chunk)  # one by one, which raises the right exception for a bad row
+
+    # creates a bit field array from columns, given as a dict (or a sequence of pairs) of field -> column, in field
+    # order, see addColumns. e.g.
+    #   BitFieldArray.fromColumns("Stops", collections.OrderedDict([("x", xs), ("y", ys)]))
+    @staticmethod
+    def fromColumns(name, columns):
+        columns = collections.OrderedDict(columns)
+        return BitFieldArray(name, *columns.keys()).addColumns(list(columns.values()))
+
+    # creates a bit field array with the given fields from an iterable of row tuples, see addRows
+    @staticmethod
+    def fromRows(name, fields, rows, bufferSize=65536):
+        return BitFieldArray(name, *fields).addRows(rows, bufferSize)
+
     @staticmethod
     def hasFixedWidth():
         return False
@@ -904,45 +1427,61 @@ class BitFieldArray(Value):
         return self
 
     def get(self, fieldName, index):  # returns the value of the field name at the given index
-        return self.entries[index][self.type.getFields().index(fieldName)][1]
+        fieldIndex = self.type.getFields().index(fieldName)
+        blob = self.blobs[fieldIndex].get(range(len(self))[index])
+        return blob if blob is not None else self.columns[fieldIndex][index]
 
     def set(self, fieldName, index, value):  # sets the value of the field name at the given index
-        tupleIndex = self.type.getFields().index(fieldName)
-        oldTuple = self.entries[index][tupleIndex]
-        self.entries[index][tupleIndex] = oldTuple[0:1] + (value,) + oldTuple[2:]
+        fieldIndex = self.type.getFields().index(fieldName)
+        index = range(len(self))[index]
+        markModified(self)
+        self.blobs[fieldIndex].pop(index, None)
+        if isinstance(value, Blob):
+            self.blobs[fieldIndex][index] = value
+            self.columns[fieldIndex][index] = 0
+        else:
+            self.columns[fieldIndex][index] = value
+        self.fieldLengths = None
 
     # for every field, returns the bit length of it
     def getFieldLengths(self):
-        fields = self.type.getFields()
-        if len(self.entries) == 0:
-            return [0] * len(fields)
-        return [
-            max(len(entry[fieldIndex][1].getPythonValue())
-                if entry[fieldIndex][0] else
-                namedstruct.bithelper.requiredBits(entry[fieldIndex][1])
-                for entry in self.entries)
-            for fieldIndex in range(len(fields))]
+        if self.fieldLengths is None:
+            self.fieldLengths = [max([max(column).bit_length() if len(column) > 0 else 0]
+                                     + [blob.numBits for blob in blobs.values()])
+                                 for column, blobs in zip(self.columns, self.blobs)]
+        return self.fieldLengths
+
+    # returns the values of the field with the given index as ints, blobs are turned into the int with their bits
+    def _getColumnInts(self, fieldIndex):
+        column = self.columns[fieldIndex]
+        if len(self.blobs[fieldIndex]) == 0:
+            return column
+        column = column.tolist()
+        for index, blob in self.blobs[fieldIndex].items():
+            column[index] = int.from_bytes(blob.values, "little")
+        return column
 
     def pretty(self):
         fields = self.type.getFields()
         fieldLengths = self.getFieldLengths()
-        result = "bitFieldArray[{length}x{numBits}]{{".format(length=len(self.entries), numBits=sum(fieldLengths))
+        numEntries = len(self)
+        result = "bitFieldArray[{length}x{numBits}]{{".format(length=numEntries, numBits=sum(fieldLengths))
         rows = [namedstruct.stringhelper.indent + s + ":" for s in namedstruct.stringhelper.getColumn(fields)]
         rows = [rows[i] + s + " = [" for i, s in enumerate(namedstruct.stringhelper.getColumn(fieldLengths))]
         maxColumnWidth = 80
         maxEntryWidth = 12
-        numEntries = len(self.entries)
-        for i, entry in enumerate(self.entries):
+        for i in range(numEntries):
             # build column values
             values = []
-            for isBlob, value in entry:
-                if isBlob:
-                    blob = ''.join(str(v) for v in value.getPythonValue())
+            for fieldIndex in range(len(fields)):
+                blob = self.blobs[fieldIndex].get(i)
+                if blob is not None:
+                    blob = ''.join(str(v) for v in blob.getPythonValue())
                     if len(blob) > maxEntryWidth:
                         blob = blob[0:maxEntryWidth - 2] + ".."
                     values.append(blob)
                 else:
-                    values.append(value)
+                    values.append(self.columns[fieldIndex][i])
             strings = namedstruct.stringhelper.getColumn(values)
             # stop if rows grow too big
             if len(rows[0]) + 1 + len(strings[0]) > maxColumnWidth:
@@ -959,26 +1498,16 @@ class BitFieldArray(Value):
 
     def getImmediateDataSize(self):
         fieldLengths = self.getFieldLengths()
-        return int((len(fieldLengths) + 2) * 2 + (sum(fieldLengths) * len(self.entries) + 7) / 8)
+        return int((len(fieldLengths) + 2) * 2 + (sum(fieldLengths) * len(self) + 7) // 8)
 
-    def pack(self, data_offset=None):
+    def packInto(self, buffer, offset, base):
         fieldLengths = self.getFieldLengths()
-        offset = (len(fieldLengths) + 2) * 16
-        headerValues = [sum(fieldLengths)] + [offset + sum(fieldLengths[:i]) for i in range(len(fieldLengths) + 1)]
-        header = namedstruct.pack(SimpleArray(namedstruct.n_types.UINT16, headerValues), addPadding=False)
-        # create data blob
-        blob = array.array('B', [])
-        for entry in self.entries:
-            for i, (isBlob, value) in enumerate(entry):
-                if isBlob:
-                    b = value.getPythonValue()
-                    blob.extend(b)
-                    blob.extend((fieldLengths[i] - len(b)) * array.array('B', [0]))
-                else:
-                    blob.extend(array.array('B', namedstruct.bithelper.toBits(value, fieldLengths[i])))
-        data = namedstruct.pack(Blob(blob), addPadding=False)
-        assert (len(blob) == sum(fieldLengths) * len(self.entries))
-        return header + data, ""
+        bitOffset = (len(fieldLengths) + 2) * 16
+        headerValues = [sum(fieldLengths)] + [bitOffset + sum(fieldLengths[:i]) for i in range(len(fieldLengths) + 1)]
+        buffer.packInto("<%dH" % len(headerValues), offset, *headerValues)
+        columns = [self._getColumnInts(fieldIndex) for fieldIndex in range(len(fieldLengths))]
+        buffer.write(offset + len(headerValues) * 2, namedstruct.bithelper.packBitFieldColumns(columns, fieldLengths))
+        return ()
 
 
 def map_bitfieldarray(typename, iterator, map_fn=lambda x: x, debug=True, non_varargs=False):
@@ -993,13 +1522,14 @@ def map_bitfieldarray(typename, iterator, map_fn=lambda x: x, debug=True, non_va
     :param non_varargs: Do not automatically spread iterable arguments
     :return: A BitFieldArray
     """
-    structs = list(map(lambda elm: collections.OrderedDict(call_map_varargs(map_fn, elm, non_varargs)), iterator))
-
-    if not structs:
+    structs = (collections.OrderedDict(call_map_varargs(map_fn, elm, non_varargs)) for elm in iterator)
+    first = next(structs, None)
+    if first is None:
         return Reference(None)
 
-    array = (BitFieldArray(typename, *structs[0].keys())
-             .addAll([struct.values() for struct in structs]))
+    # the entries are streamed into the array, see BitFieldArray.addRows
+    array = (BitFieldArray(typename, *first.keys())
+             .addRows(tuple(struct.values()) for struct in itertools.chain([first], structs)))
 
     if debug:
         print("  " + array.pretty().replace("\n", "\n  "))